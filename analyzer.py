@@ -1,18 +1,81 @@
+import array
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 import backtrader as bt
+from backtrader.utils import AutoOrderedDict
 from datetime import datetime, timedelta
+from logger import to_timestamp
+
+class RunningStats:
+    """
+    Welford 在线算法累计均值和方差，常数内存
+    """
+    __slots__ = ('count', 'mean', '_m2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def std(self, ddof=1):
+        """标准差，ddof=1 为样本标准差，样本不足时为 None"""
+        return math.sqrt(self._m2 / (self.count - ddof)) if self.count > max(ddof, 0) else None
+
 
 class TradingMetricsAnalyzer(bt.Analyzer):
+    """
+    流式交易统计：只保存累计和、计数、极值和 Welford 均值/方差，内存占用与交易数无关，
+    get_analysis 可在回测中任意一根K线调用（如提前终止规则），计算量为常数。
+    净值新高按每根K线的账户价值判断。
+    """
+
     def __init__(self):
         self.trade_count = 0
         self.profit_trade_count = 0  # 盈利交易次数
-        self.profits = []
-        self.losses = []
+        self.loss_trade_count = 0
+        self.total_profit = 0.0
+        self.total_loss = 0.0
+        self.max_profit = 0.0
+        self.max_loss = 0.0
+        self.trade_pnl = RunningStats()  # 每笔交易的净盈亏
         self.total_pnl = 0.0  # 累计净利润百分比
-        self.max_net_worth = 0.0  # 记录净值新高
-        self.max_net_worth_times = []  # 记录净值创新高的时间点
         self.first_trade_time = None  # 记录第一次交易的时间
         self.last_trade_time = None  # 记录最后一次交易的时间
 
+        self.max_net_worth = 0.0  # 记录净值新高
+        self.new_high_count = 0  # 净值创新高的次数
+        self.last_new_high = None  # 最近一次创新高的时间（backtrader 日期数值）
+        self.new_high_days = 0.0  # 相邻两次创新高的间隔天数之和
+        self.bar_returns = RunningStats()  # 逐K线收益率
+        self.last_value = None
+        self.first_bar = None
+        self.last_bar = None
+
+    def notify_cashvalue(self, cash, value):
+        now = self.strategy.datetime[0]
+        if self.last_value:
+            self.bar_returns.add(value / self.last_value - 1)
+        else:
+            self.first_bar = now
+        self.last_value = value
+        self.last_bar = now
+
+        if value > self.max_net_worth:
+            self.max_net_worth = value
+            if self.last_new_high is not None:
+                self.new_high_days += now - self.last_new_high
+            self.last_new_high = now
+            self.new_high_count += 1
+
     def notify_trade(self, trade):
         if trade.isclosed:
             self.trade_count += 1
@@ -23,19 +86,17 @@ class TradingMetricsAnalyzer(bt.Analyzer):
             if account_value > 0:
                 # 累计总盈利百分比（基于账户总值）
                 self.total_pnl += (pnl / account_value) * 100
+                self.trade_pnl.add(pnl)
 
                 # 更新盈利和亏损
                 if pnl > 0:
                     self.profit_trade_count += 1
-                    self.profits.append(pnl)
+                    self.total_profit += pnl
+                    self.max_profit = max(self.max_profit, pnl)
                 else:
-                    self.losses.append(abs(pnl))
-
-                # 记录净值新高及其时间
-                current_time = self.strategy.data.datetime.datetime(0)
-                if account_value > self.max_net_worth:
-                    self.max_net_worth = account_value
-                    self.max_net_worth_times.append(current_time)
+                    self.loss_trade_count += 1
+                    self.total_loss += abs(pnl)
+                    self.max_loss = max(self.max_loss, abs(pnl))
 
             # 记录第一次和最后一次交易的时间
             if self.first_trade_time is None:
@@ -43,54 +104,586 @@ class TradingMetricsAnalyzer(bt.Analyzer):
             self.last_trade_time = self.strategy.data.datetime.datetime(0)
 
     def get_analysis(self):
+        return self.trading_analysis()
+
+    def trading_analysis(self):
         total_trades = self.trade_count
-        total_profit = sum(self.profits)
-        total_loss = sum(self.losses)
 
-        avg_profit = total_profit / len(self.profits) if self.profits else 0
-        avg_loss = total_loss / len(self.losses) if self.losses else 0
+        avg_profit = self.total_profit / self.profit_trade_count if self.profit_trade_count else 0
+        avg_loss = self.total_loss / self.loss_trade_count if self.loss_trade_count else 0
 
         profit_loss_ratio = (avg_profit / avg_loss) if avg_loss != 0 else None
 
         win_rate = (self.profit_trade_count / total_trades) * 100 if total_trades > 0 else 0
 
-        max_profit = max(self.profits, default=0)
-        max_loss = max(self.losses, default=0)
-
         # 计算交易频率（交易次数 / 时间段）
         trade_duration = (self.last_trade_time - self.first_trade_time).days + 1 if self.first_trade_time and self.last_trade_time else 1
         trade_frequency = total_trades / trade_duration if trade_duration > 0 else 0
 
         # 计算平均净值创新高时间
-        if len(self.max_net_worth_times) > 1:
-            intervals = [(self.max_net_worth_times[i] - self.max_net_worth_times[i-1]).days for i in range(1, len(self.max_net_worth_times))]
-            avg_new_high_time = sum(intervals) / len(intervals)
-        else:
-            avg_new_high_time = None
+        avg_new_high_time = self.new_high_days / (self.new_high_count - 1) if self.new_high_count > 1 else None
+
+        # SQN：交易净盈亏均值 / 标准差 × √交易数，与 backtrader 的 SQN 分析器一样使用总体标准差
+        pnl_std = self.trade_pnl.std()
+        population_std = self.trade_pnl.std(ddof=0)
+        sqn = math.sqrt(self.trade_pnl.count) * self.trade_pnl.mean / population_std if population_std else None
+
+        # 按实际经过的时间把逐K线收益的夏普比率年化
+        return_std = self.bar_returns.std()
+        sharpe = None
+        if return_std and self.last_bar > self.first_bar:
+            bars_per_year = self.bar_returns.count / ((self.last_bar - self.first_bar) / 365)
+            sharpe = self.bar_returns.mean / return_std * math.sqrt(bars_per_year)
 
         return {
             'total_trades': total_trades,
-            'total_profit': total_profit,
-            'total_loss': total_loss,
+            'total_profit': self.total_profit,
+            'total_loss': self.total_loss,
             'profit_loss_ratio': profit_loss_ratio,
             'average_profit': avg_profit,
             'average_loss': avg_loss,
             'total_pnl_percent': self.total_pnl,
             'win_rate': win_rate,
-            'max_profit_trade': max_profit,
-            'max_loss_trade': max_loss,
+            'max_profit_trade': self.max_profit,
+            'max_loss_trade': self.max_loss,
             'trade_frequency_per_day': trade_frequency,  # 交易频率
-            'average_new_high_time': avg_new_high_time,  # 平均净值创新高时间
+            'average_new_high_time': avg_new_high_time,  # 平均净值创新高时间（天）
+            'new_highs': self.new_high_count,
+            'pnl_mean': self.trade_pnl.mean,
+            'pnl_std': pnl_std,
+            'sqn': sqn,
+            'sharpe': sharpe,  # 年化夏普比率（无风险利率为0）
         }
 
-def add_analyzers(cerebro):
-    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='Drawdown')
-    cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='TradeAnalyzer')
-    cerebro.addanalyzer(bt.analyzers.Returns, _name='Returns')
-    cerebro.addanalyzer(bt.analyzers.AnnualReturn, _name='AnnualReturn')
-    cerebro.addanalyzer(bt.analyzers.GrossLeverage, _name='GrossLeverage')
-    cerebro.addanalyzer(bt.analyzers.SQN, _name='SQN')
-    cerebro.addanalyzer(TradingMetricsAnalyzer, _name='TradingMetrics')
+
+def funding_summary(broker):
+    """FuturesBroker 累计的资金费、利息和结算次数"""
+    return {
+        'total_funding': getattr(broker, 'funding_paid', 0.0),
+        'total_interest': getattr(broker, 'interest_paid', 0.0),
+        'settlements': getattr(broker, 'settlements', 0),
+        'funding_by_data': {data._name: funding for data, funding in getattr(broker, 'd_funding', {}).items()},
+    }
+
+
+def liquidation_summary(broker):
+    """FuturesBroker 的强平次数和明细"""
+    events = list(getattr(broker, 'liquidations', []))
+    return {'liquidations': len(events), 'events': events}
+
+
+class FundingAnalyzer(bt.Analyzer):
+    """
+    汇总 FuturesBroker 在结算时刻计提的资金费和利息（正数为支出，负数为收入）
+    """
+
+    def stop(self):
+        self.rets.update(funding_summary(self.strategy.broker))
+
+
+class SafeReturns(bt.analyzers.Returns):
+    """
+    爆仓后账户权益被保险基金托底为0时，backtrader 的 Returns 会对0取对数报错，此时收益按负无穷处理
+    """
+
+    def stop(self):
+        broker = self.strategy.broker
+        value = broker.fundvalue if self._fundmode else broker.getvalue()
+        if value > 0:
+            return super().stop()
+        self._value_end = value
+        for key in ('rtot', 'ravg', 'rnorm', 'rnorm100'):
+            self.rets[key] = float('-inf')
+
+
+class LiquidationAnalyzer(bt.Analyzer):
+    """
+    汇总 FuturesBroker 的强平记录
+    """
+
+    def stop(self):
+        self.rets.update(liquidation_summary(self.strategy.broker))
+
+
+# Returns 按数据源周期统计子周期数，秒/分钟/日线周期直接由日期数值换算，不必每根K线转换为 datetime
+_UNITS_PER_DAY = {bt.TimeFrame.Seconds: 86400, bt.TimeFrame.Minutes: 1440, bt.TimeFrame.Days: 1}
+
+
+class SafeGrossLeverage(bt.analyzers.GrossLeverage):
+    """
+    爆仓后账户权益被保险基金托底为0时，backtrader 的 GrossLeverage 会除以0报错，此时总杠杆按0处理
+    """
+
+    def leverage(self):
+        return (self._value - self._cash) / self._value if self._value else 0.0
+
+    def next(self):
+        self.rets[self.data0.datetime.datetime()] = self.leverage()
+
+
+class DailyGrossLeverage(SafeGrossLeverage):
+    """
+    按日采样的 GrossLeverage：每天只保留最后一根K线的总杠杆，键为日期。
+    结果条数随天数而非K线数增长，exactbars 流式回测时代替逐K线记录的 GrossLeverage
+    """
+
+    def next(self):
+        self.rets[self.data0.datetime.date()] = self.leverage()
+
+
+class FusedAnalyzer(TradingMetricsAnalyzer):
+    """
+    合并 DrawDown、TradeAnalyzer、Returns、AnnualReturn、GrossLeverage、SQN、TradingMetrics、Funding 和
+    Liquidation：每根K线只在 notify_cashvalue 中处理一次账户价值，每笔交易只在 notify_trade 中处理一次，
+    回撤峰值、净值新高和交易盈亏等状态由各项指标共用。
+    get_analysis 返回 {分析器名称: 结果}，结果与对应的 backtrader 分析器相同，其中 TradeAnalyzer
+    只保留常用字段，GrossLeverage 在调用时才由数组转换为按时间索引的字典。
+    exactbars 流式回测时 GrossLeverage 与 DailyGrossLeverage 相同按日采样，内存不随K线数增长。
+    """
+    params = (
+        ('timeframe', None),  # Returns 的统计周期，默认与数据源相同
+        ('compression', None),
+        ('daily_leverage', None),  # GrossLeverage 按日采样，None 时在 exactbars 模式下启用
+    )
+
+    def __init__(self):
+        super().__init__()
+        # 回撤，峰值使用 max_net_worth
+        self.drawdown = 0.0
+        self.moneydown = 0.0
+        self.drawdown_len = 0
+        self.max_drawdown = 0.0
+        self.max_moneydown = 0.0
+        self.max_drawdown_len = 0
+        # 对数收益
+        self.value_start = None
+        self.period_count = 0
+        self._period = None
+        # 年度收益
+        self.annual = OrderedDict()
+        self._year = None
+        self._next_year = float('-inf')  # 下一年1月1日的日期数值
+        self._year_start = None
+        self._year_value = None
+        # 逐K线总杠杆
+        self._leverage_dt = array.array('d')
+        self._leverage = array.array('d')
+        # 全部交易（TradeAnalyzer / SQN 不按账户价值过滤）
+        self.opened_trades = 0
+        self.open_trades = 0
+        self.closed_pnl = RunningStats()
+        self.gross_pnl = 0.0
+        self.won = self.lost = 0
+        self.won_pnl = self.lost_pnl = 0.0
+        self.won_max = self.lost_min = 0.0
+        self.won_streak = self.lost_streak = 0
+        self.longest_won = self.longest_lost = 0
+        self.sides = {'long': [0, 0.0, 0], 'short': [0, 0.0, 0]}  # 交易数、净盈亏、盈利交易数
+        self.bars_total = 0
+        self.bars_max = 0
+        self.bars_min = None
+
+    def start(self):
+        super().start()
+        self.value_start = self.strategy.broker.getvalue()
+        self.daily_leverage = self.p.daily_leverage
+        if self.daily_leverage is None:
+            self.daily_leverage = self.strategy.cerebro.p.exactbars > 0
+        timeframe = self.p.timeframe or self.data._timeframe
+        self.timeframe = timeframe
+        self.compression = self.p.compression or self.data._compression
+        self.tann = bt.analyzers.Returns._TANN.get(timeframe) or bt.analyzers.Returns._TANN.get(
+            self.data._timeframe, 1.0)
+        units = _UNITS_PER_DAY.get(timeframe)
+        if units:
+            step = self.compression if timeframe != bt.TimeFrame.Days else 1
+            # 加一个极小量，避免日期数值的浮点误差把整点K线算到上一个周期
+            self._period_key = lambda now: int(now * units + 1e-6) // step
+        else:
+            self._period_key = lambda now: self._get_dt_cmpkey(bt.num2date(now))[0]
+
+    _get_dt_cmpkey = bt.TimeFrameAnalyzerBase._get_dt_cmpkey
+
+    def notify_cashvalue(self, cash, value):
+        super().notify_cashvalue(cash, value)
+        now = self.last_bar
+
+        self.moneydown = moneydown = self.max_net_worth - value
+        self.drawdown = drawdown = 100.0 * moneydown / self.max_net_worth if self.max_net_worth else 0.0
+        if moneydown > self.max_moneydown:
+            self.max_moneydown = moneydown
+        if drawdown > self.max_drawdown:
+            self.max_drawdown = drawdown
+        self.drawdown_len = self.drawdown_len + 1 if drawdown else 0
+        if self.drawdown_len > self.max_drawdown_len:
+            self.max_drawdown_len = self.drawdown_len
+
+        period = self._period_key(now)
+        if period != self._period:
+            self._period = period
+            self.period_count += 1
+
+        if now >= self._next_year:
+            # 与 AnnualReturn 相同：首年以第一根K线的价值为起点，之后以上一年最后一根K线的价值为起点
+            if self._year is None:
+                self._year_start = value
+            else:
+                self.annual[self._year] = self._year_value / self._year_start - 1.0
+                self._year_start = self._year_value
+            self._year = bt.num2date(now).year
+            self._next_year = bt.date2num(datetime(self._year + 1, 1, 1))
+        self._year_value = value
+
+        leverage = (value - cash) / value if value else 0.0
+        if self.daily_leverage and self._leverage_dt and int(self._leverage_dt[-1]) == int(now):
+            # 同一天内覆盖当天的记录，只保留最后一根K线
+            self._leverage_dt[-1] = now
+            self._leverage[-1] = leverage
+        else:
+            self._leverage_dt.append(now)
+            self._leverage.append(leverage)
+
+    def notify_trade(self, trade):
+        super().notify_trade(trade)
+        if trade.justopened:
+            self.opened_trades += 1
+            self.open_trades += 1
+        elif trade.status == trade.Closed:
+            pnl = trade.pnlcomm
+            self.open_trades -= 1
+            self.closed_pnl.add(pnl)
+            self.gross_pnl += trade.pnl
+            won = pnl >= 0.0  # 与 TradeAnalyzer 相同，净盈亏为0记为盈利
+            if won:
+                self.won += 1
+                self.won_pnl += pnl
+                self.won_max = max(self.won_max, pnl)
+                self.won_streak += 1
+                self.lost_streak = 0
+                self.longest_won = max(self.longest_won, self.won_streak)
+            else:
+                self.lost += 1
+                self.lost_pnl += pnl
+                self.lost_min = min(self.lost_min, pnl)
+                self.lost_streak += 1
+                self.won_streak = 0
+                self.longest_lost = max(self.longest_lost, self.lost_streak)
+            side = self.sides['long' if trade.long else 'short']
+            side[0] += 1
+            side[1] += pnl
+            side[2] += won
+            self.bars_total += trade.barlen
+            self.bars_max = max(self.bars_max, trade.barlen)
+            self.bars_min = trade.barlen if self.bars_min is None else min(self.bars_min, trade.barlen)
+
+    def drawdown_analysis(self):
+        r = AutoOrderedDict()
+        r.len = self.drawdown_len
+        r.drawdown = self.drawdown
+        r.moneydown = self.moneydown
+        r.max.len = self.max_drawdown_len
+        r.max.drawdown = self.max_drawdown
+        r.max.moneydown = self.max_moneydown
+        r._close()
+        return r
+
+    def returns_analysis(self):
+        value_end = self.strategy.broker.getvalue()
+        rtot = math.log(value_end / self.value_start) if value_end > 0 else float('-inf')
+        ravg = rtot / self.period_count if self.period_count else 0.0
+        rnorm = math.expm1(ravg * self.tann) if ravg > float('-inf') else ravg
+        return OrderedDict(rtot=rtot, ravg=ravg, rnorm=rnorm, rnorm100=rnorm * 100.0)
+
+    def annual_analysis(self):
+        annual = OrderedDict(self.annual)
+        if self._year is not None:
+            annual[self._year] = self._year_value / self._year_start - 1.0
+        return annual
+
+    def leverage_analysis(self):
+        tz = self.data._tz
+        if self.daily_leverage:
+            return OrderedDict((bt.num2date(dt, tz).date(), leverage)
+                               for dt, leverage in zip(self._leverage_dt, self._leverage))
+        return OrderedDict((bt.num2date(dt, tz), leverage) for dt, leverage in zip(self._leverage_dt, self._leverage))
+
+    def sqn_analysis(self):
+        r = AutoOrderedDict()
+        count = self.closed_pnl.count
+        if count > 1:
+            std = self.closed_pnl.std(ddof=0)
+            r.sqn = math.sqrt(count) * self.closed_pnl.mean / std if std else None
+        else:
+            r.sqn = 0
+        r.trades = count
+        return r
+
+    def trade_analysis(self):
+        r = AutoOrderedDict()
+        r.total.total = self.opened_trades
+        r.total.open = self.open_trades
+        closed = self.closed_pnl.count
+        if closed:
+            r.total.closed = closed
+            r.streak.won.current = self.won_streak
+            r.streak.won.longest = self.longest_won
+            r.streak.lost.current = self.lost_streak
+            r.streak.lost.longest = self.longest_lost
+            net_pnl = self.won_pnl + self.lost_pnl
+            r.pnl.gross.total = self.gross_pnl
+            r.pnl.gross.average = self.gross_pnl / closed
+            r.pnl.net.total = net_pnl
+            r.pnl.net.average = net_pnl / closed
+            for name, count, total, extreme in (('won', self.won, self.won_pnl, self.won_max),
+                                                ('lost', self.lost, self.lost_pnl, self.lost_min)):
+                r[name].total = count
+                r[name].pnl.total = total
+                r[name].pnl.average = total / (count or 1.0)
+                r[name].pnl.max = extreme
+            for name, (count, total, won) in self.sides.items():
+                r[name].total = count
+                r[name].pnl.total = total
+                r[name].pnl.average = total / (count or 1.0)
+                r[name].won = won
+                r[name].lost = count - won
+            r.len.total = self.bars_total
+            r.len.average = self.bars_total / closed
+            r.len.max = self.bars_max
+            r.len.min = self.bars_min
+        r._close()
+        return r
+
+    def get_analysis(self):
+        broker = self.strategy.broker
+        return {
+            'Drawdown': self.drawdown_analysis(),
+            'TradeAnalyzer': self.trade_analysis(),
+            'Returns': self.returns_analysis(),
+            'AnnualReturn': self.annual_analysis(),
+            'GrossLeverage': self.leverage_analysis(),
+            'SQN': self.sqn_analysis(),
+            'TradingMetrics': self.trading_analysis(),
+            'Funding': funding_summary(broker),
+            'Liquidation': liquidation_summary(broker),
+        }
+
+
+# collect_analysis 在叠加模式下读取的分析器名称
+ANALYZER_NAMES = ('Drawdown', 'TradeAnalyzer', 'Returns', 'AnnualReturn', 'GrossLeverage', 'SQN', 'TradingMetrics',
+                  'Funding', 'Liquidation')
+
+
+def collect_analysis(strat):
+    """
+    返回 {分析器名称: 结果}，add_analyzers 使用 fused=True 与否结果形式相同
+    """
+    fused = getattr(strat.analyzers, 'Metrics', None)
+    if fused is not None:
+        return fused.get_analysis()
+    return {name: getattr(strat.analyzers, name).get_analysis() for name in ANALYZER_NAMES}
+
+
+class ColumnBuffer:
+    """
+    按列预分配的 NumPy 数组，追加一行为逐列赋值，容量不足时翻倍扩容
+    """
+
+    def __init__(self, dtypes, capacity=1024):
+        self._arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in dtypes}
+        self._columns = list(self._arrays.values())
+        self.size = 0
+
+    def append(self, *values):
+        if self.size == len(self._columns[0]):
+            self._arrays = {name: np.resize(array, 2 * len(array)) for name, array in self._arrays.items()}
+            self._columns = list(self._arrays.values())
+        for column, value in zip(self._columns, values):
+            column[self.size] = value
+        self.size += 1
+
+    def columns(self):
+        return {name: array[:self.size] for name, array in self._arrays.items()}
+
+
+# 订单表：每条订单状态通知一行（提交通知除外），成交量和成交价为截至该通知的累计成交
+ORDER_COLUMNS = (
+    ('ts', np.int64),  # 通知时所在K线的时间（毫秒时间戳）
+    ('ref', np.int64),
+    ('data', np.int16),  # 数据源序号，对应 data_names
+    ('side', np.int8),  # 1 买入，-1 卖出
+    ('exectype', np.int8),  # 对应 exectype_names
+    ('status', np.int8),  # 对应 status_names
+    ('created_price', np.float64),
+    ('created_size', np.float64),
+    ('executed_price', np.float64),
+    ('executed_size', np.float64),
+    ('executed_value', np.float64),
+    ('commission', np.float64),
+    ('liquidation', np.bool_),
+)
+# 交易表：每笔平仓交易一行
+TRADE_COLUMNS = (
+    ('ts_open', np.int64),
+    ('ts_close', np.int64),
+    ('ref', np.int64),
+    ('data', np.int16),
+    ('long', np.bool_),
+    ('price', np.float64),  # 开仓均价
+    ('pnl', np.float64),
+    ('pnlcomm', np.float64),
+    ('commission', np.float64),
+    ('barlen', np.int64),
+)
+# 类别列以整数编码存储，名称表随文件保存
+CATEGORIES = {'status': list(bt.Order.Status), 'exectype': list(bt.Order.ExecTypes)}
+
+
+class JournalAnalyzer(bt.Analyzer):
+    """
+    将每条订单通知和每笔平仓交易记录到按列预分配的数组中，回测结束时写入 path：
+    .npz 使用 NumPy 压缩格式；.parquet 或 .arrow 需要安装 pyarrow，订单表和交易表分别写为
+    <文件名>.orders.parquet 和 <文件名>.trades.parquet（或 .arrow）。读取见 load_journal / load_journals。
+    """
+    params = (
+        ('path', None),  # None 时只在 get_analysis 中返回，不写文件
+    )
+
+    def start(self):
+        self._orders = ColumnBuffer(ORDER_COLUMNS)
+        self._trades = ColumnBuffer(TRADE_COLUMNS)
+        self._data_index = {data: i for i, data in enumerate(self.strategy.datas)}
+
+    def notify_order(self, order):
+        if order.status == order.Submitted:
+            return
+        self._orders.append(
+            to_timestamp(order.data.datetime[0]), order.ref, self._data_index.get(order.data, -1),
+            1 if order.isbuy() else -1, order.exectype, order.status,
+            order.created.price or np.nan, order.created.size,
+            order.executed.price, order.executed.size, order.executed.value, order.executed.comm,
+            bool(order.info.get('liquidation', False)))
+
+    def notify_trade(self, trade):
+        if not trade.isclosed:
+            return
+        self._trades.append(
+            to_timestamp(trade.dtopen), to_timestamp(trade.dtclose), trade.ref, self._data_index.get(trade.data, -1),
+            trade.long, trade.price, trade.pnl, trade.pnlcomm, trade.commission, trade.barlen)
+
+    def stop(self):
+        self.rets['orders'] = self._orders.columns()
+        self.rets['trades'] = self._trades.columns()
+        self.rets['data_names'] = [data._name for data in self.strategy.datas]
+        if self.p.path:
+            write_journal(self.p.path, self.rets['orders'], self.rets['trades'], self.rets['data_names'])
+
+
+def _journal_paths(path):
+    """Parquet/Arrow 格式的订单表和交易表文件路径"""
+    root, suffix = os.path.splitext(path)
+    return f'{root}.orders{suffix}', f'{root}.trades{suffix}'
+
+
+def write_journal(path, orders, trades, data_names):
+    """
+    按文件后缀写出订单表和交易表，后缀为 .npz、.parquet 或 .arrow
+    """
+    suffix = os.path.splitext(path)[1]
+    if suffix == '.npz':
+        arrays = {f'orders.{name}': values for name, values in orders.items()}
+        arrays.update((f'trades.{name}', values) for name, values in trades.items())
+        np.savez_compressed(path, data_names=np.array(data_names),
+                            **{f'{name}_names': np.array(names) for name, names in CATEGORIES.items()}, **arrays)
+        return
+    if suffix not in ('.parquet', '.arrow'):
+        raise ValueError(f"Unsupported journal format: {suffix}")
+    try:
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as parquet
+    except ImportError:
+        raise ImportError("Writing Parquet/Arrow journals requires pyarrow; use a .npz path instead.") from None
+
+    categories = dict(CATEGORIES, data=data_names)
+    for table, path in zip((orders, trades), _journal_paths(path)):
+        # 类别列写为字典编码的字符串列，编码 -1（未知数据源）写为空值
+        table = pa.table({
+            name: pa.DictionaryArray.from_arrays(pa.array(values.astype(np.int32), mask=values < 0), categories[name])
+            if name in categories else values
+            for name, values in table.items()
+        })
+        if suffix == '.parquet':
+            parquet.write_table(table, path)
+        else:
+            feather.write_feather(table, path)
+
+
+def load_journal(path):
+    """
+    读取 JournalAnalyzer 写出的文件，返回 {'orders': DataFrame, 'trades': DataFrame}，
+    时间列为 datetime64，数据源、订单状态和订单类型为类别列
+    """
+    suffix = os.path.splitext(path)[1]
+    if suffix == '.npz':
+        with np.load(path) as npz:
+            categories = {name: npz[f'{name}_names'].tolist() for name in CATEGORIES}
+            categories['data'] = npz['data_names'].tolist()
+            tables = {table: pd.DataFrame({key.split('.', 1)[1]: npz[key] for key in npz.files
+                                           if key.startswith(f'{table}.')})
+                      for table in ('orders', 'trades')}
+        for frame in tables.values():
+            for name, names in categories.items():
+                if name in frame:
+                    frame[name] = pd.Categorical.from_codes(frame[name], names)
+    else:
+        read = pd.read_parquet if suffix == '.parquet' else pd.read_feather
+        tables = dict(zip(('orders', 'trades'), (read(path) for path in _journal_paths(path))))
+
+    for frame in tables.values():
+        for name in ('ts', 'ts_open', 'ts_close'):
+            if name in frame:
+                frame[name] = pd.to_datetime(frame[name], unit='ms')
+    return tables
+
+
+def load_journals(paths, table='trades'):
+    """
+    读取多次回测（如参数优化各任务）的日志并纵向拼接为一张表，run 列为各文件名（不含后缀）
+    """
+    frames = []
+    for path in paths:
+        frame = load_journal(path)[table]
+        frame.insert(0, 'run', os.path.basename(path).split('.')[0])
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def add_analyzers(cerebro, journal_path=None, fused=False):
+    """
+    fused=True 时以一个 FusedAnalyzer（名称 Metrics）代替逐个叠加的分析器，每根K线只处理一次账户价值，
+    也不再需要 Broker 观察者；各项结果统一通过 collect_analysis 读取
+    """
+    if fused:
+        cerebro.addanalyzer(FusedAnalyzer, _name='Metrics')
+    else:
+        cerebro.addanalyzer(bt.analyzers.DrawDown, _name='Drawdown')
+        cerebro.addanalyzer(bt.analyzers.TradeAnalyzer, _name='TradeAnalyzer')
+        cerebro.addanalyzer(SafeReturns, _name='Returns')
+        if cerebro.p.exactbars > 0:
+            # exactbars 模式下K线不全量保留，AnnualReturn 需要在结束时回溯全部K线，改用逐根累计的 TimeReturn 按年统计；
+            # 逐K线的 GrossLeverage 随回测区间增长，改为按日采样
+            cerebro.addanalyzer(bt.analyzers.TimeReturn, timeframe=bt.TimeFrame.Years, _name='AnnualReturn')
+            cerebro.addanalyzer(DailyGrossLeverage, _name='GrossLeverage')
+        else:
+            cerebro.addanalyzer(bt.analyzers.AnnualReturn, _name='AnnualReturn')
+            cerebro.addanalyzer(SafeGrossLeverage, _name='GrossLeverage')
+        cerebro.addanalyzer(bt.analyzers.SQN, _name='SQN')
+        cerebro.addanalyzer(TradingMetricsAnalyzer, _name='TradingMetrics')
+        cerebro.addanalyzer(FundingAnalyzer, _name='Funding')
+        cerebro.addanalyzer(LiquidationAnalyzer, _name='Liquidation')
+    if journal_path:
+        # 订单和交易明细写入列式文件，供回测后向量化分析
+        cerebro.addanalyzer(JournalAnalyzer, path=journal_path, _name='Journal')
 
 def print_result(results, output_file='results.txt'):
     try:
@@ -105,7 +698,8 @@ def print_result(results, output_file='results.txt'):
                         f.write(f"{param_name}: {param_value}\n")
                     f.write("=" * 40 + "\n")
 
-                    trading_metrics = strat.analyzers.TradingMetrics.get_analysis()
+                    analysis = collect_analysis(strat)
+                    trading_metrics = analysis['TradingMetrics']
                     f.write(f"总盈利: {trading_metrics['total_profit']:.2f} USDT\n")
                     f.write(f"总亏损: {trading_metrics['total_loss']:.2f} USDT\n")
                     f.write(f"最大盈利单笔交易: {trading_metrics['max_profit_trade']:.2f} USDT\n")
@@ -123,7 +717,7 @@ def print_result(results, output_file='results.txt'):
                     f.write("=" * 40 + "\n")
                     f.write("=" * 40 + "\n")
 
-                    drawdown = strat.analyzers.Drawdown.get_analysis()
+                    drawdown = analysis['Drawdown']
 
                     # 使用 drawdown.max.len
                     max_drawdown_days = drawdown.max.len /6
@@ -133,6 +727,16 @@ def print_result(results, output_file='results.txt'):
                     f.write(f"最长回撤天数: {max_drawdown_days:.1f}\n")
                     f.write("=" * 40 + "\n")
 
+                    funding = analysis['Funding']
+                    f.write(f"累计资金费: {funding['total_funding']:.2f} USDT\n")
+                    f.write(f"累计持仓利息: {funding['total_interest']:.2f} USDT\n")
+                    f.write(f"资金费结算次数: {funding['settlements']}\n")
+                    liquidation = analysis['Liquidation']
+                    f.write(f"强平次数: {liquidation['liquidations']}\n")
+                    for event in liquidation['events']:
+                        f.write(f"  {event['datetime']} {event['data']} 持仓 {event['size']:.4f} 强平价格 {event['price']:.2f}\n")
+                    f.write("=" * 40 + "\n")
+
             print("结果导出成功")
     except Exception as e:
         print(f"Error writing to file: {e}")
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""
+性能基准：用随机游走合成K线，对比指标在逐根（next）与批量（once）模式下的耗时，
+以及叠加的多个分析器与合并分析器（FusedAnalyzer）的逐K线开销
+"""
+import time
+import numpy as np
+import backtrader as bt
+from data_loader import NumpyData
+from strategy import PriceCluster
+from broker import configure_broker
+from sizer import configure_sizer
+from analyzer import add_analyzers
+
+
+def synthetic_klines(bars=50000, seed=0):
+    """生成1分钟随机游走K线，返回 {列名: 数组} 字典"""
+    rng = np.random.default_rng(seed)
+    close = 40000 * np.exp(np.cumsum(rng.normal(0, 0.0015, bars)))
+    open_ = np.r_[close[0], close[:-1]]
+    return {
+        'datetime': np.datetime64('2024-01-01', 'ns').astype(np.int64) + np.arange(bars, dtype=np.int64) * 60 * 10 ** 9,
+        'open': open_,
+        'high': np.maximum(open_, close) * (1 + np.abs(rng.normal(0, 0.0007, bars))),
+        'low': np.minimum(open_, close) * (1 - np.abs(rng.normal(0, 0.0007, bars))),
+        'close': close,
+        'volume': rng.gamma(2, 50, bars),
+    }
+
+
+class _IndicatorHolder(bt.Strategy):
+    params = dict(indicator=None, indicator_params=None)
+
+    def __init__(self):
+        self.p.indicator(**self.p.indicator_params)
+
+
+def benchmark_indicator(indicator=PriceCluster, bars=50000, repeat=3, **params):
+    """
+    分别以 runonce=False（逐根 next）和 runonce=True（批量 once）运行只包含该指标的回测，
+    返回两种模式的最短耗时（秒）和加速比。
+    """
+    columns = synthetic_klines(bars)
+    timings = {}
+    for runonce in (False, True):
+        best = float('inf')
+        for _ in range(repeat):
+            cerebro = bt.Cerebro(runonce=runonce, stdstats=False)
+            cerebro.adddata(NumpyData(dataname=columns))
+            cerebro.addstrategy(_IndicatorHolder, indicator=indicator, indicator_params=params)
+            start = time.perf_counter()
+            cerebro.run()
+            best = min(best, time.perf_counter() - start)
+        timings['once' if runonce else 'next'] = best
+
+    timings['speedup'] = timings['next'] / timings['once']
+    print(f"{indicator.__name__} {params} | next: {timings['next']:.3f}s | once: {timings['once']:.3f}s "
+          f"| 加速比: {timings['speedup']:.2f}x")
+    return timings
+
+
+class _AlternatingTrader(bt.Strategy):
+    """每隔 hold 根K线开仓或平仓一次，使分析器同时处理K线和交易事件"""
+    params = dict(hold=20)
+
+    def next(self):
+        if len(self) % self.p.hold == 0:
+            if self.position:
+                self.close()
+            else:
+                self.buy()
+
+
+def benchmark_analyzers(bars=50000, repeat=5, hold=20):
+    """
+    分别以不加分析器、叠加分析器（add_analyzers 默认）和合并分析器（fused=True）运行同一回测，
+    返回各模式的最短耗时（秒）以及两种分析器模式相对不加分析器时每根K线增加的耗时（微秒）。
+    """
+    columns = synthetic_klines(bars)
+    timings = dict.fromkeys(('none', 'stacked', 'fused'), float('inf'))
+    # 各模式轮流运行，机器负载的波动对三种模式影响相同
+    for _ in range(repeat):
+        for mode in timings:
+            cerebro = bt.Cerebro(stdstats=False)
+            cerebro.adddata(NumpyData(dataname=columns))
+            cerebro.addstrategy(_AlternatingTrader, hold=hold)
+            configure_broker(cerebro)
+            configure_sizer(cerebro)
+            if mode != 'none':
+                add_analyzers(cerebro, fused=mode == 'fused')
+            if mode == 'stacked':
+                # AnnualReturn 分析器依赖 Broker 观察者
+                cerebro.addobserver(bt.observers.Broker)
+            start = time.perf_counter()
+            cerebro.run()
+            timings[mode] = min(timings[mode], time.perf_counter() - start)
+
+    for mode in ('stacked', 'fused'):
+        timings[f'{mode}_us_per_bar'] = (timings[mode] - timings['none']) / bars * 1e6
+    timings['speedup'] = timings['stacked_us_per_bar'] / timings['fused_us_per_bar']
+    print(f"分析器 {bars} 根K线 | 无: {timings['none']:.3f}s | 叠加: {timings['stacked']:.3f}s "
+          f"({timings['stacked_us_per_bar']:.1f}us/bar) | 合并: {timings['fused']:.3f}s "
+          f"({timings['fused_us_per_bar']:.1f}us/bar) | 开销降低: {timings['speedup']:.2f}x")
+    return timings
+
+
+if __name__ == '__main__':
+    benchmark_indicator(PriceCluster, period=100, bins=20)
+    benchmark_indicator(PriceCluster, period=1000, bins=20)
+    benchmark_analyzers()
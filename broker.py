@@ -49,24 +49,49 @@ import backtrader as bt
 #     cerebro.broker.set_cash(10000.0)  # 设置初始资金
 
 
+import bisect
+import collections
+import math
+import numpy as np
+import pandas as pd
 import backtrader as bt
+from data_loader import NS_PER_DAY, _to_epoch_ns
+from logger import EPOCH_ORDINAL
+
+
+# 永续合约按持仓名义价值分档的维持保证金率（参考币安 BTCUSDT）：(名义价值下限 USDT, 维持保证金率)
+MAINTENANCE_BRACKETS = (
+    (0, 0.004),
+    (50_000, 0.005),
+    (250_000, 0.01),
+    (3_000_000, 0.025),
+    (15_000_000, 0.05),
+    (30_000_000, 0.10),
+    (80_000_000, 0.125),
+    (100_000_000, 0.15),
+    (200_000_000, 0.25),
+    (300_000_000, 0.50),
+)
 
 
 class CustomFuturesCommissionInfo(bt.CommInfoBase):
     """
-    自定义期货佣金信息类，动态调整杠杆和维持保证金率
+    自定义期货佣金信息类，动态调整杠杆和维持保证金率。
+    保证金和佣金系数在构造时按杠杆预先计算，Broker 每次检查订单和计算账户价值时只做一次乘法。
     """
     params = (
         ('maker_commission', 0.0002),
         ('taker_commission', 0.0005),
+        ('liquidity', 'maker'),  # 佣金按挂单(maker)还是吃单(taker)费率收取
         ('mult', 1.0),
         ('commtype', bt.CommInfoBase.COMM_PERC),
         ('stocklike', False),
         ('percabs', True),
-        ('interest', 0.02),
+        ('interest', 0.0),  # 年化利率，默认不计息（永续合约的持仓成本由资金费体现）
         ('interest_long', False),
         ('leverage', 1),
         ('automargin', True),
+        ('brackets', MAINTENANCE_BRACKETS),  # 维持保证金分档
     )
 
     # 杠杆对应的维持保证金率
@@ -85,65 +110,403 @@ class CustomFuturesCommissionInfo(bt.CommInfoBase):
         125: 0.004,
     }
 
+    def __init__(self):
+        # 显式传入的 margin 优先，否则按杠杆查表（父类会把空的 margin 改为 1.0，需在其之前读取）
+        margin_rate = self.p.margin or self.leverage_margin_map.get(self.p.leverage, 0.5)  # 默认1倍杠杆对应50%保证金率
+        super().__init__()
+        if self.p.liquidity not in ('maker', 'taker'):
+            raise ValueError("liquidity must be 'maker' or 'taker'.")
+
+        self.margin_rate = margin_rate
+        # 单位价格对应的保证金和佣金系数
+        self._margin_coef = self.p.mult * margin_rate
+        self._commission_rate = self.p.maker_commission if self.p.liquidity == 'maker' else self.p.taker_commission
+
+        # 分档维持保证金：速算扣除数 cum_i = cum_{i-1} + 下限_i * (费率_i - 费率_{i-1})，使各档边界处连续
+        floors, rates = zip(*self.p.brackets)
+        self._bracket_floors = np.asarray(floors, dtype=np.float64)
+        self._bracket_rates = np.asarray(rates, dtype=np.float64)
+        self._bracket_cums = np.r_[0.0, np.cumsum(self._bracket_floors[1:] * np.diff(self._bracket_rates))]
+        self._bracket_floor_list = list(floors)
+
     def get_margin(self, price):
         """
-        根据杠杆动态调整保证金
+        根据杠杆动态调整保证金，返回单手保证金
         """
-        leverage = self.p.leverage
-        # 根据杠杆获取对应的维持保证金率
-        margin_rate = self.leverage_margin_map.get(leverage, 0.5)  # 默认1倍杠杆对应50%保证金率
-
-        # 根据当前价格和维持保证金率计算单手保证金
-        return price * self.p.mult * margin_rate
+        return price * self._margin_coef
 
     def get_leverage(self):
         """
-        获取杠杆倍数
+        保证金系数已按杠杆折算，backtrader 计算现金和账户价值时不应再按杠杆缩放，
+        否则开多只扣除 1/杠杆 的保证金，浮动盈亏也会在现金之外被重复计入账户价值。
+        配置的杠杆倍数见 p.leverage
         """
-        return self.p.leverage
+        return 1
 
-    def _getcommission(self, size, price, pseudoexec):
+    def getoperationcost(self, size, price):
+        return abs(size) * price * self._margin_coef
+
+    def getvaluesize(self, size, price):
+        return abs(size) * price * self._margin_coef
+
+    def getvalue(self, position, price):
         """
-        根据订单类型动态计算佣金。
-        假设市场订单为吃单，限价订单为挂单。
+        持仓价值为按开仓均价占用的保证金。浮动盈亏已由 cashadjust 逐根计入现金，
+        若按当前价格估值，价格变动会在保证金里再计一次
         """
-        if pseudoexec:  # 判断是否为限价单
-            return abs(size) * price * self.p.maker_commission
-        else:  # 市价单默认为吃单
-            return abs(size) * price * self.p.taker_commission
+        return abs(position.size) * position.price * self._margin_coef
 
-    def get_margin(self, price):
+    def _getcommission(self, size, price, pseudoexec):
         """
-        保留默认的get_margin方法，根据源码计算保证金。
+        按预先选定的费率计算佣金。
+        Backtrader 实际扣费时以 pseudoexec=True 调用，无法区分订单类型，因此费率由 liquidity 参数决定。
         """
-        if not self.p.automargin:
-            return self.p.margin
-        elif self.p.automargin < 0:
-            return price * self.p.mult
-        return price * self.p.automargin  # int/float expected
+        return abs(size) * price * self._commission_rate
 
     def calculate_total_margin(self, price, size):
         """
-        新增一个函数来计算总保证金，基于每单位保证金计算总量。
+        计算持仓的总保证金，price/size 可以是标量或 NumPy 数组（逐元素计算）。
+        """
+        return np.abs(size) * price * self._margin_coef
+
+    def get_maintenance_margin(self, price, size):
+        """
+        按持仓名义价值所在档位计算维持保证金：名义价值 * 维持保证金率 - 速算扣除数
+        """
+        notional = abs(size) * price * self.p.mult
+        tier = bisect.bisect_right(self._bracket_floor_list, notional) - 1
+        return notional * self._bracket_rates[tier] - self._bracket_cums[tier]
+
+    def get_liquidation_price(self, size, price, equity):
+        """
+        计算强平价格：当前价格为 price、可用于该持仓的权益为 equity 时，价格变动到多少会使权益等于维持保证金。
+        维持保证金档位按当前名义价值确定；无法被强平（如权益足以覆盖全部名义价值）时返回 None。
+        """
+        notional = abs(size) * price * self.p.mult
+        tier = bisect.bisect_right(self._bracket_floor_list, notional) - 1
+        rate, cum = self._bracket_rates[tier], self._bracket_cums[tier]
+        quantity = abs(size) * self.p.mult
+        if size > 0:
+            # equity + q * (P - price) = q * P * rate - cum
+            liquidation = (notional - equity - cum) / (quantity * (1 - rate))
+            return liquidation if liquidation > 0 else None
+        # equity - q * (P - price) = q * P * rate - cum
+        return (equity + notional + cum) / (quantity * (1 + rate))
+
+    def calculate_maintenance_margin(self, price, size):
+        """
+        get_maintenance_margin 的向量化版本，price/size 可以是标量或 NumPy 数组。
         """
-        return self.get_margin(price) * abs(size)
+        notional = np.abs(size) * np.asarray(price, dtype=np.float64) * self.p.mult
+        tier = np.searchsorted(self._bracket_floors, notional, side='right') - 1
+        return notional * self._bracket_rates[tier] - self._bracket_cums[tier]
 
     def calculate_interest(self, size, price, days_held):
         """
-        计算持仓的利息成本，假设按天计算利息。
+        计算持仓的利息成本，interest 为年化利率，按天计息；空头按 interest 计息，多头仅在 interest_long 时计息。
         :param size: 持仓量
         :param price: 当前价格
         :param days_held: 持仓时间（天）
         :return: 持仓利息
         """
-        if self.p.interest_long and size > 0:
-            return abs(size) * price * self.p.interest * days_held
+        if size > 0 and not self.p.interest_long:
+            return 0.0
+        return abs(size) * price * self.p.mult * self._creditrate * days_held
+
+    def calculate_funding(self, size, price, rate):
+        """
+        计算一次资金费结算的支出：多头在费率为正时支付、为负时收取，空头相反
+        """
+        return size * price * self.p.mult * rate
+
+    def get_credit_interest(self, data, pos, dt):
+        """
+        不使用 Backtrader 逐根K线按天计息，利息由 FuturesBroker 在结算时刻通过 calculate_interest 计提
+        """
+        return 0.0
+
+
+def intrabar_fill_offset(order, highs, lows):
+    """
+    返回订单在上层K线内首次可以成交的1分钟K线序号（highs/lows 为该K线内各1分钟K线的最高/最低价）：
+    市价单为第一根，限价单和止损单为首次触及价格的一根，本根K线内不会成交时返回 None；
+    其他订单类型返回 -1，仍按整根K线撮合
+    """
+    exectype = order.exectype
+    if exectype == bt.Order.Market:
         return 0
+    price = order.created.price
+    if exectype == bt.Order.Limit:
+        hit = lows <= price if order.isbuy() else highs >= price
+    elif exectype == bt.Order.Stop:
+        hit = highs >= price if order.isbuy() else lows <= price
+    else:
+        return -1
+    offset = int(hit.argmax())
+    return offset if hit[offset] else None
+
+
+class FuturesBroker(bt.brokers.BackBroker):
+    """
+    永续合约 Broker：在资金费结算时刻按历史资金费率向持仓收付资金费，并计提持仓利息。
+    结算时刻预先排好序，每根K线只比较一次当前时间与下一个结算时刻，只有到达结算时刻才遍历持仓。
+
+    同时模拟全仓强平：各持仓的强平价格只在成交、结算或强平后重新计算，
+    每根K线在处理完订单后用最高/最低价检查是否触及强平价格，触及时撤销该数据源的挂单并按强平价格平仓。
+
+    数据源带有1分钟K线索引（configure_data(intrabar=True)）时，限价、止损和市价单按本根K线内
+    首次触及价格的1分钟K线撮合，同一根K线内的订单按触发先后成交，括号单的止盈止损不再依赖提交顺序。
+    """
+    params = (
+        ('funding_rates', None),  # 历史资金费率 pd.Series（索引为结算时间），或 {数据源名称: pd.Series}
+        ('settlement_hours', 8),  # 没有资金费率数据或数据用完后按此间隔（UTC 0/8/16点）结算利息
+        ('liquidation', True),  # 是否模拟强平
+        ('stop_on_liquidation', False),  # 发生强平后立即结束回测（参数优化时用于提前淘汰爆仓的参数）
+        ('intrabar', True),  # 数据源带有1分钟K线索引时按1分钟K线撮合
+        # 账户价值通过 getvalue(持仓, 价格) 按开仓均价计算保证金；shortcash=True 时 backtrader 改用
+        # getvaluesize(数量, 当前价格)，拿不到开仓均价。成交时两者的现金变动相同
+        ('shortcash', False),
+    )
 
+    def start(self):
+        super().start()
+        self.liquidations = []  # 强平记录
+        self._liquidation_prices = {}  # {数据源: 强平价格}
+        self._filled = set()  # 本根K线内有成交的数据源
+        self._owners = {}  # 各数据源最近一次成交订单所属的策略，强平单通知给该策略
+        self._stop_requested = False
+        self._intrabar_fills = {}  # {订单编号: 本根K线内成交的1分钟K线下标}
+        self.funding_paid = 0.0  # 累计资金费支出，负数表示收入
+        self.interest_paid = 0.0  # 累计利息支出
+        self.settlements = 0  # 有持仓参与的结算次数
+        self.d_funding = collections.defaultdict(float)
 
-def configure_broker(cerebro, leverage=10, margin=0.05, cash=10000.0, slippage=0.1):
+        rates = self.p.funding_rates
+        if rates is None:
+            rates = {}
+        elif isinstance(rates, pd.Series):
+            rates = {None: rates}  # 所有数据源使用同一组费率
+        # {数据源名称: {结算时间(纳秒): 费率}}
+        self._funding = {
+            name: dict(zip(_to_epoch_ns(series.index).tolist(), series.to_numpy(dtype=np.float64).tolist()))
+            for name, series in rates.items()
+        }
 
-    comm_info = CustomFuturesCommissionInfo(leverage=leverage, margin=margin)
+        # 结算时刻按与数据源相同的日期数值表示，便于直接比较
+        self._schedule_ns = sorted(set().union(*self._funding.values()))
+        self._schedule = [EPOCH_ORDINAL + t // NS_PER_DAY + (t % NS_PER_DAY) / NS_PER_DAY for t in self._schedule_ns]
+        self._step = self.p.settlement_hours / 24
+        self._index = 0
+        self._last_settlement = None
+        # 按固定间隔结算时，第一根K线到来后再确定下一个结算时刻
+        self._next_settlement = self._schedule[0] if self._schedule else -math.inf
+
+    def next(self):
+        if self._stop_requested:
+            # 上一根K线发生强平，策略和分析器已收到强平成交的通知，在此结束回测
+            self.cerebro.runstop()
+            return
+        if self.p.intrabar:
+            self._schedule_intrabar()
+        super().next()
+        if self._liquidation_prices:
+            self._check_liquidation()
+
+        datas = self.cerebro.datas
+        if datas and len(datas[0]):
+            now = datas[0].datetime[0]
+            if now >= self._next_settlement - 1e-9:
+                self._settle(now)
+
+        if self._filled:
+            self._update_liquidation_prices()
+
+    def _schedule_intrabar(self):
+        """
+        计算各订单在本根K线内首次成交的1分钟K线，并按此先后重新排列待处理订单
+        """
+        # 与 BackBroker.next 开头相同：先激活括号单的子订单、接收新提交的订单，使它们参与排序
+        while self._toactivate:
+            self._toactivate.popleft().activate()
+        if self.p.checksubmit:
+            self.check_submitted()
+
+        self._intrabar_fills.clear()
+        keys = {}
+        for order in self.pending:
+            index = getattr(order.data, 'intrabar', None)
+            if index is None or not order.active():
+                continue
+            bounds = index.locate(order.data.datetime[0])
+            if bounds is None:
+                continue
+            lo, hi = bounds
+            offset = intrabar_fill_offset(order, index.high[lo:hi], index.low[lo:hi])
+            if offset is None:
+                keys[order.ref] = hi - lo  # 本根K线内不会成交，排在最后
+            elif offset >= 0:
+                keys[order.ref] = offset
+                self._intrabar_fills[order.ref] = lo + offset
+        if keys:
+            # 稳定排序，不使用1分钟K线的订单保持原有顺序排在最前
+            orders = sorted(self.pending, key=lambda order: keys.get(order.ref, -1))
+            self.pending.clear()
+            self.pending.extend(orders)
+
+    def _try_exec(self, order):
+        minute = self._intrabar_fills.pop(order.ref, None)
+        if minute is None:
+            return super()._try_exec(order)
+        # BackBroker._try_exec 优先使用数据源的 tick_* 价格，临时替换为成交所在1分钟K线的价格
+        data = order.data
+        index = data.intrabar
+        names = ('tick_open', 'tick_high', 'tick_low', 'tick_close')
+        saved = [getattr(data, name, None) for name in names]
+        for name, values in zip(names, (index.open, index.high, index.low, index.close)):
+            setattr(data, name, values[minute])
+        try:
+            super()._try_exec(order)
+        finally:
+            for name, value in zip(names, saved):
+                setattr(data, name, value)
+
+    def _execute(self, order, ago=None, price=None, cash=None, position=None, dtcoc=None):
+        result = super()._execute(order, ago, price, cash, position, dtcoc)
+        if ago is not None and self.p.liquidation:
+            # 真实成交（非保证金检查的预执行），本根K线结束时重新计算强平价格
+            self._filled.add(order.data)
+            self._owners[order.data] = order.owner
+        return result
+
+    def _equity(self):
+        """
+        账户权益：现金（浮动盈亏已按收盘价逐根计入现金）加上各持仓按开仓均价占用的保证金
+        """
+        return self.cash + sum(self.getcommissioninfo(data).getoperationcost(pos.size, pos.price)
+                               for data, pos in self.positions.items() if pos)
+
+    def _update_liquidation_prices(self):
+        """
+        按当前账户权益重新计算所有持仓的强平价格：
+        每个持仓可用的权益为账户权益减去其他持仓的维持保证金（假设其他持仓价格不变）
+        """
+        self._filled.clear()
+        equity = self._equity()
+        maintenance = {}
+        for data, pos in self.positions.items():
+            if pos:
+                maintenance[data] = self.getcommissioninfo(data).get_maintenance_margin(data.close[0], pos.size)
+        total = sum(maintenance.values())
+
+        self._liquidation_prices = {}
+        for data, margin in maintenance.items():
+            comminfo = self.getcommissioninfo(data)
+            price = comminfo.get_liquidation_price(self.positions[data].size, data.close[0], equity - total + margin)
+            if price is not None:
+                self._liquidation_prices[data] = price
+
+    def _check_liquidation(self):
+        """
+        用本根K线的最高/最低价检查各持仓是否触及强平价格，本根K线内刚成交的持仓从下一根K线开始检查
+        """
+        for data, price in list(self._liquidation_prices.items()):
+            if data in self._filled:
+                continue
+            size = self.positions[data].size
+            if size > 0 and data.low[0] <= price:
+                # 跳空低开时按开盘价成交
+                self._liquidate(data, min(price, data.open[0]))
+            elif size < 0 and data.high[0] >= price:
+                self._liquidate(data, max(price, data.open[0]))
+
+    def _liquidate(self, data, price):
+        """
+        强制平仓：撤销该数据源的全部挂单（包括括号单的止盈止损子单），按强平价格以市价单平掉全部持仓
+        """
+        for order in [order for order in self.pending if order.data is data]:
+            self.cancel(order)
+
+        size = self.positions[data].size
+        owner = self._owners.get(data) or self.cerebro.runningstrats[0]
+        order_class = bt.SellOrder if size > 0 else bt.BuyOrder
+        order = order_class(owner=owner, data=data, size=abs(size), price=price, exectype=bt.Order.Market)
+        order.addcomminfo(self.getcommissioninfo(data))
+        order.addinfo(liquidation=True)
+        self._ocoize(order, None)
+        order.submit(self)
+        order.accept(self)
+        self.orders.append(order)
+        self._execute(order, ago=0, price=price)
+
+        self.liquidations.append(dict(datetime=data.datetime.datetime(0), data=data._name, size=size, price=price))
+        equity = self._equity()
+        if equity < 0:
+            # 跳空导致穿仓时，超出账户权益的亏损由交易所保险基金承担，账户权益归零
+            self.cash -= equity
+        self._get_value()
+        self._stop_requested = self.p.stop_on_liquidation
+
+    def _settle(self, now):
+        """
+        依次处理所有不晚于 now 的结算时刻
+        """
+        while now >= self._next_settlement - 1e-9:
+            at = self._next_settlement
+            if at != -math.inf:
+                self._apply_settlement(at)
+                self._last_settlement = at
+            self._next_settlement = self._following(now if at == -math.inf else at)
+        self._get_value()  # 结算改变了现金，更新账户价值
+
+    def _following(self, at):
+        """
+        返回 at 之后的下一个结算时刻：有资金费率数据时取数据中的下一条，没有数据或数据用完后按固定间隔
+        """
+        if self._index < len(self._schedule):
+            self._index += 1
+            if self._index < len(self._schedule):
+                return self._schedule[self._index]
+        return (math.floor(at / self._step + 1e-9) + 1) * self._step
+
+    def _apply_settlement(self, at):
+        """
+        对所有持仓结算一次资金费和自上次结算以来的利息
+        """
+        days = at - self._last_settlement if self._last_settlement is not None else self._step
+        key = self._schedule_ns[self._index] if self._index < len(self._schedule_ns) else None
+        settled = False
+        for data, pos in self.positions.items():
+            if not pos:
+                continue
+            comminfo = self.getcommissioninfo(data)
+            price = data.close[0]
+            rates = self._funding.get(data._name, self._funding.get(None))
+            funding = comminfo.calculate_funding(pos.size, price, rates.get(key, 0.0)) if rates else 0.0
+            interest = comminfo.calculate_interest(pos.size, price, days)
+            self.cash -= funding + interest
+            self.funding_paid += funding
+            self.interest_paid += interest
+            self.d_funding[data] += funding
+            settled = True
+        self.settlements += settled
+        if settled and self.p.liquidation:
+            # 结算改变了账户权益，强平价格随之变化
+            self._filled.add(None)
+
+
+def configure_broker(cerebro, leverage=10, margin=None, cash=10000.0, slippage=0.1, funding_rates=None,
+                     liquidation=True, stop_on_liquidation=False, intrabar=True, interest=0.0, interest_long=False):
+    """
+    配置 Broker，margin 为 None 时按杠杆查表确定保证金率；
+    funding_rates 为 load_funding_rates 读取的历史资金费率（或 {数据源名称: 费率} 字典），在结算时刻收付资金费；
+    interest 为结算时计提的年化利率，默认不计息，interest_long=True 时多头也计息；
+    liquidation 控制是否模拟强平，stop_on_liquidation=True 时发生强平后立即结束回测；
+    intrabar=False 时即使数据源带有1分钟K线索引也按整根K线撮合。
+    """
+    cerebro.broker = FuturesBroker(funding_rates=funding_rates, liquidation=liquidation,
+                                   stop_on_liquidation=stop_on_liquidation, intrabar=intrabar)
+    comm_info = CustomFuturesCommissionInfo(leverage=leverage, margin=margin, interest=interest,
+                                            interest_long=interest_long)
 
     # 配置 Broker
     cerebro.broker.addcommissioninfo(comm_info)
@@ -1,27 +1,637 @@
+import bisect
+import contextlib
 import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, reduce
+from itertools import repeat
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
 import pandas as pd
 import backtrader as bt
+from logger import EPOCH_ORDINAL
 
 
-def configure_data(cerebro, kline_file_path, start_date, end_date, timeframe=bt.TimeFrame.Minutes, compression=5):
+# 缓存版本号，缓存格式变化时递增，旧缓存自动失效
+CACHE_VERSION = 3
+CACHE_DIR_NAME = '.kline_cache'
+KLINE_COLUMNS = ('open', 'high', 'low', 'close', 'volume')
+NS_PER_DAY = 86400 * 10 ** 9
+# backtrader 默认的交易时段结束时间 23:59:59.999990，日线重新采样以当天该时刻标记K线
+SESSION_END_NS = NS_PER_DAY - 10 ** 4
+
+# 当前进程已挂载的共享内存数据 {共享内存名称: (SharedMemory, 各列数组)}
+_attached_windows = {}
+
+
+def _cache_root(kline_file_path, cache_dir=None):
     """
-    优化后的数据加载和重新采样函数，支持CSV文件输入，并通过时间范围过滤数据。
+    根据源文件路径、修改时间和大小生成缓存目录，源文件变化后自动使用新目录。
+    """
+    source = os.path.abspath(kline_file_path)
+    stat = os.stat(source)
+    key = hashlib.sha1(f'{source}|{stat.st_mtime_ns}|{stat.st_size}|{CACHE_VERSION}'.encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(source))[0]
+    base = cache_dir or os.path.join(os.path.dirname(source), CACHE_DIR_NAME)
+    return os.path.join(base, f'{stem}-{key}')
+
+
+def _to_epoch_ns(values):
+    """将时间列/时间对象统一转换为 int64 纳秒时间戳"""
+    return np.asarray(pd.to_datetime(values)).astype('datetime64[ns]').view('int64')
+
+
+def _write_shards(target, columns, source):
     """
-    # 使用分块读取，避免大文件内存问题
-    chunk_list = []
-    for chunk in pd.read_csv(kline_file_path, chunksize=10000,
+    将按时间排序的各列数据按月切分，先写入临时目录，完成后再原子替换，避免中断留下半成品缓存。
+    """
+    tmp_target = f'{target}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_target, ignore_errors=True)
+    manifest = {'version': CACHE_VERSION, 'source': source, 'months': {}}
+
+    month_ids = columns['datetime'].view('datetime64[ns]').astype('datetime64[M]')
+    bounds = np.flatnonzero(np.r_[True, month_ids[1:] != month_ids[:-1], True])
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        month = str(month_ids[lo])
+        os.makedirs(os.path.join(tmp_target, month))
+        has_nan = False
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_target, month, f'{name}.npy'), values[lo:hi])
+            has_nan = has_nan or (name != 'datetime' and bool(np.isnan(values[lo:hi]).any()))
+        manifest['months'][month] = {'rows': int(hi - lo), 'nan': has_nan}
+    with open(os.path.join(tmp_target, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(tmp_target, target)
+    except OSError:
+        # 其他进程已经写好了同一份缓存，保留已有的缓存
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        if not os.path.exists(os.path.join(target, 'manifest.json')):
+            raise
+
+
+def _remove_stale_caches(root):
+    """
+    删除同一源文件的过期缓存目录和稀疏索引文件，只匹配 <文件名>-<16位哈希> 形式的名称，
+    不会误删文件名以该前缀开头的其他源文件的缓存
+    """
+    parent, name = os.path.split(root)
+    if not os.path.isdir(parent):
+        return
+    stem = name.rsplit('-', 1)[0]
+    pattern = re.compile(re.escape(stem) + r'-[0-9a-f]{16}(\.index\.npz)?')
+    for entry in os.listdir(parent):
+        if not pattern.fullmatch(entry) or entry in (name, f'{name}.index.npz'):
+            continue
+        path = os.path.join(parent, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+def build_kline_cache(kline_file_path, cache_dir=None, chunksize=100000):
+    """
+    将K线CSV按月切分为列式 .npy 分片缓存，只在首次（或源文件变化后）全量解析一次。
+    返回缓存目录路径。
+    """
+    root = _cache_root(kline_file_path, cache_dir)
+    if os.path.exists(os.path.join(root, 'manifest.json')):
+        return root
+
+    # 分块解析整个文件
+    parts = []
+    for chunk in pd.read_csv(kline_file_path, chunksize=chunksize,
                              usecols=['open_time', 'open', 'high', 'low', 'close', 'volume']):
-        # 转换时间并过滤所需的时间段
-        chunk['open_time'] = pd.to_datetime(chunk['open_time'])
-        chunk_filtered = chunk[(chunk['open_time'] >= start_date) & (chunk['open_time'] <= end_date)]
-        chunk_list.append(chunk_filtered)
+        columns = {'datetime': _to_epoch_ns(chunk['open_time'])}
+        for name in KLINE_COLUMNS:
+            columns[name] = chunk[name].to_numpy(dtype=np.float64)
+        parts.append(columns)
 
-    # 合并所有分块数据
-    if chunk_list:
-        kline_dataframe = pd.concat(chunk_list)
+    if not parts:
+        raise ValueError("No data loaded. Please check the file path and date range.")
+
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    order = np.argsort(columns['datetime'], kind='stable')
+    columns = {name: values[order] for name, values in columns.items()}
+
+    # 清理同一源文件的过期缓存
+    _remove_stale_caches(root)
+
+    _write_shards(root, columns, os.path.abspath(kline_file_path))
+    return root
+
+
+def _period_bounds(datetimes, minutes):
+    """
+    按 minutes 分钟周期划分1分钟K线，返回 (各周期K线的时间, 各周期第一根K线的下标)，与 cerebro.resampledata 一致：
+    日内周期把K线时间视为收盘时间，(右边界 - 周期, 右边界] 内的K线以右边界标记；
+    日线按自然日 [00:00, 24:00) 划分，以当天交易时段结束时间 23:59:59.99999 标记。
+    """
+    if minutes > 1440:
+        # backtrader 的多日K线从数据的第一天开始计数，无法按固定边界划分
+        raise ValueError("Only periods up to one day are supported.")
+    period = minutes * 60 * 10 ** 9
+    if minutes == 1440:
+        labels = datetimes // period * period + SESSION_END_NS
+    else:
+        labels = -(-datetimes // period) * period
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    return labels[starts], starts
+
+
+def _period_range(timestamp, minutes):
+    """时间戳所在周期覆盖的纳秒时间范围 [first, last]，划分方式同 _period_bounds"""
+    period = minutes * 60 * 10 ** 9
+    if minutes == 1440:
+        first = timestamp // period * period
+    else:
+        first = -(-timestamp // period) * period - period + 1
+    return first, first + period - 1
+
+
+def resample_ohlcv(columns, minutes):
+    """
+    向量化地将1分钟K线聚合为 minutes 分钟K线。
+    与 cerebro.resampledata 一致，K线时间视为收盘时间，每根聚合K线以区间右边界时间标记。
+    """
+    labels, starts = _period_bounds(columns['datetime'], minutes)
+    ends = np.r_[starts[1:], len(columns['datetime'])] - 1
+    return {
+        'datetime': labels,
+        'open': columns['open'][starts],
+        'high': np.maximum.reduceat(columns['high'], starts),
+        'low': np.minimum.reduceat(columns['low'], starts),
+        'close': columns['close'][ends],
+        'volume': np.add.reduceat(columns['volume'], starts),
+    }
+
+
+def build_resampled_cache(kline_file_path, minutes, cache_dir=None):
+    """
+    在原始缓存目录下建立 minutes 分钟周期的预聚合缓存（同样按月分片），返回其目录路径。
+    """
+    root = build_kline_cache(kline_file_path, cache_dir)
+    if minutes == 1:
+        return root
+    if NS_PER_DAY % (minutes * 60 * 10 ** 9):
+        raise ValueError("Pre-resampling only supports periods that divide one day evenly.")
+
+    target = os.path.join(root, f'{minutes}m')
+    if os.path.exists(os.path.join(target, 'manifest.json')):
+        return target
+
+    with open(os.path.join(root, 'manifest.json')) as f:
+        months = sorted(json.load(f)['months'])
+    columns = {name: np.concatenate([np.load(os.path.join(root, month, f'{name}.npy')) for month in months])
+               for name in ('datetime',) + KLINE_COLUMNS}
+    _write_shards(target, resample_ohlcv(columns, minutes), os.path.abspath(kline_file_path))
+    return target
+
+
+def iter_kline_segments(kline_file_path, start_date, end_date, cache_dir=None, minutes=1):
+    """
+    按时间顺序逐个产出[start_date, end_date]区间内的月份分片（内存映射，不复制数据），
+    只有迭代到某个月份时才打开对应的分片文件。
+    minutes 大于1时读取对应周期的预聚合缓存；区间首尾不完整的周期由区间内的1分钟K线重新聚合，
+    不混入区间外的数据，结果与对区间内1分钟K线调用 resampledata 一致。
+    每段为 {列名: np.memmap} 字典，datetime 列为 int64 纳秒时间戳。
+    """
+    root = build_resampled_cache(kline_file_path, minutes, cache_dir)
+    start, end = _to_epoch_ns([start_date, end_date])
+    if minutes == 1:
+        yield from _iter_shards(root, start, end)
+        return
+
+    head_first, head_last = _period_range(start, minutes)
+    tail_first, tail_last = _period_range(end, minutes)
+    # [full_start, full_end] 为完整包含在区间内的周期
+    full_start = start if head_first == start else head_last + 1
+    full_end = end if tail_last == end else tail_first - 1
+    if full_start > full_end:
+        yield from _resample_window(kline_file_path, start, end, cache_dir, minutes)
+        return
+    if full_start > start:
+        yield from _resample_window(kline_file_path, start, full_start - 1, cache_dir, minutes)
+    labels, _ = _period_bounds(np.array([full_start, full_end]), minutes)
+    yield from _iter_shards(root, labels[0], labels[-1])
+    if full_end < end:
+        yield from _resample_window(kline_file_path, full_end + 1, end, cache_dir, minutes)
+
+
+def _iter_shards(root, start, end):
+    """
+    逐个产出缓存目录中K线时间在 [start, end]（纳秒时间戳）内的月份分片
+    """
+    with open(os.path.join(root, 'manifest.json')) as f:
+        manifest = json.load(f)
+    first_month, last_month = (str(month) for month in np.array([start, end]).view('datetime64[ns]').astype('datetime64[M]'))
+
+    for month in sorted(manifest['months']):
+        if not first_month <= month <= last_month:
+            continue
+        shard = {name: np.load(os.path.join(root, month, f'{name}.npy'), mmap_mode='r')
+                 for name in ('datetime',) + KLINE_COLUMNS}
+        # 分片内按时间有序，用二分查找截取首尾月份
+        lo = np.searchsorted(shard['datetime'], start, side='left')
+        hi = np.searchsorted(shard['datetime'], end, side='right')
+        if hi <= lo:
+            continue
+        segment = {name: values[lo:hi] for name, values in shard.items()}
+        if manifest['months'][month]['nan'] and any(np.isnan(segment[name]).any() for name in KLINE_COLUMNS):
+            raise ValueError("Data contains NaN values. Please clean your data.")
+        yield segment
+
+
+def _resample_window(kline_file_path, start, end, cache_dir, minutes):
+    """由 [start, end] 内的1分钟K线聚合出 minutes 分钟K线，没有数据时不产出"""
+    window = load_kline_window(kline_file_path, start, end, cache_dir)
+    if len(window['datetime']):
+        yield resample_ohlcv(window, minutes)
+
+
+def load_kline_segments(kline_file_path, start_date, end_date, cache_dir=None, minutes=1):
+    """
+    以内存映射方式读取[start_date, end_date]区间的数据，不复制数据。
+    返回按时间排序的分段列表，每段对应一个月份分片，格式同 iter_kline_segments。
+    """
+    return list(iter_kline_segments(kline_file_path, start_date, end_date, cache_dir, minutes))
+
+
+def load_kline_window(kline_file_path, start_date, end_date, cache_dir=None, minutes=1):
+    """
+    从列式缓存中读取[start_date, end_date]区间的数据，只加载与区间重叠的月份分片。
+    返回 {列名: np.ndarray} 字典，datetime 列为 int64 纳秒时间戳。
+    """
+    segments = load_kline_segments(kline_file_path, start_date, end_date, cache_dir, minutes)
+    names = ('datetime',) + KLINE_COLUMNS
+    if not segments:
+        return {name: np.empty(0, dtype=np.int64 if name == 'datetime' else np.float64) for name in names}
+    return {name: np.concatenate([segment[name] for segment in segments]) for name in names}
+
+
+def load_funding_rates(funding_file_path):
+    """
+    读取历史资金费率CSV（币安数据格式 calc_time/last_funding_rate，或接口格式 fundingTime/fundingRate），
+    返回以结算时间为索引、按时间排序的资金费率 pd.Series。
+    """
+    frame = pd.read_csv(funding_file_path)
+    time_column = next((name for name in ('calc_time', 'fundingTime', 'funding_time') if name in frame), None)
+    rate_column = next((name for name in ('last_funding_rate', 'fundingRate', 'funding_rate') if name in frame), None)
+    if time_column is None or rate_column is None:
+        raise ValueError("Unrecognized funding rate file format.")
+
+    times = frame[time_column]
+    times = pd.to_datetime(times, unit='ms') if pd.api.types.is_numeric_dtype(times) else pd.to_datetime(times)
+    # 交易所记录的结算时间可能有毫秒级偏差，对齐到整分钟
+    index = pd.DatetimeIndex(times).round('min')
+    return pd.Series(frame[rate_column].to_numpy(dtype=np.float64), index=index, name='funding_rate').sort_index()
+
+
+def symbol_name(kline_file_path):
+    """从K线文件名中提取交易对名称，如 F-BTCUSDT-1m-202001-202408.csv 得到 BTCUSDT"""
+    stem = os.path.splitext(os.path.basename(kline_file_path))[0]
+    return next((part for part in stem.split('-') if len(part) > 1 and not part[0].isdigit()), stem)
+
+
+def prepare_kline_caches(kline_file_paths, cache_dir=None, minutes=1, max_workers=None):
+    """
+    在进程池中并行为多个K线文件建立（预聚合）缓存，已有缓存的文件直接跳过。
+    CSV 解析是 CPU 密集型操作，多进程可使首次建立缓存的耗时不随品种数线性增长。
+    """
+    missing = []
+    for path in kline_file_paths:
+        root = _cache_root(path, cache_dir)
+        target = root if minutes == 1 else os.path.join(root, f'{minutes}m')
+        if not os.path.exists(os.path.join(target, 'manifest.json')):
+            missing.append(path)
+    if len(missing) <= 1:
+        for path in missing:
+            build_resampled_cache(path, minutes, cache_dir)
+        return
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(build_resampled_cache, missing, repeat(minutes), repeat(cache_dir)))
+
+
+def _frame_window(kline_dataframe):
+    """将CSV读取的 DataFrame 转换为 {列名: 数组} 字典"""
+    kline_dataframe = kline_dataframe.sort_values('open_time', kind='stable')
+    window = {'datetime': _to_epoch_ns(kline_dataframe['open_time'])}
+    for name in KLINE_COLUMNS:
+        window[name] = kline_dataframe[name].to_numpy(dtype=np.float64)
+    if any(np.isnan(window[name]).any() for name in KLINE_COLUMNS):
+        raise ValueError("Data contains NaN values. Please clean your data.")
+    return window
+
+
+def _csv_window(kline_file_path, start_date, end_date, cache_dir=None):
+    """借助稀疏索引读取CSV中[start_date, end_date]区间的1分钟K线，返回 {列名: 数组} 字典"""
+    return _frame_window(_read_csv_window(kline_file_path, start_date, end_date, cache_dir))
+
+
+def load_kline_windows(kline_file_paths, start_date, end_date, cache_dir=None, minutes=1, use_cache=True,
+                       max_workers=None):
+    """
+    并发读取多个品种[start_date, end_date]区间的K线并对齐到共同的时间索引。
+    use_cache=True 时先在进程池中并行建立缓存，再在线程池中读取内存映射分片；
+    use_cache=False 时在线程池中借助稀疏索引读取CSV（仅支持1分钟数据）。
+    返回 {交易对名称: {列名: np.ndarray}} 字典，顺序与 kline_file_paths 一致。
+    """
+    symbols = [symbol_name(path) for path in kline_file_paths]
+    if len(set(symbols)) != len(symbols):
+        raise ValueError("Kline files must belong to different symbols.")
+
+    if use_cache:
+        prepare_kline_caches(kline_file_paths, cache_dir, minutes, max_workers)
+        load = partial(load_kline_window, start_date=start_date, end_date=end_date, cache_dir=cache_dir,
+                       minutes=minutes)
+    elif minutes == 1:
+        load = partial(_csv_window, start_date=start_date, end_date=end_date, cache_dir=cache_dir)
     else:
+        raise ValueError("Pre-resampled data requires use_cache=True.")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        windows = dict(zip(symbols, pool.map(load, kline_file_paths)))
+    return align_kline_windows(windows)
+
+
+def align_kline_windows(windows):
+    """
+    将多个品种的K线对齐到共同的时间索引：截取所有品种都有数据的重叠区间，以各品种时间戳的并集为索引，
+    缺失的K线用前一根收盘价补齐（开高低收相同、成交量为0），使各数据源逐根同步推进。
+    """
+    for symbol, window in windows.items():
+        if not len(window['datetime']):
+            raise ValueError(f"No data loaded for {symbol}. Please check the file path and date range.")
+    start = max(window['datetime'][0] for window in windows.values())
+    end = min(window['datetime'][-1] for window in windows.values())
+    if start > end:
+        raise ValueError("Kline files have no overlapping time range.")
+
+    trimmed = {}
+    for symbol, window in windows.items():
+        lo = np.searchsorted(window['datetime'], start, side='left')
+        hi = np.searchsorted(window['datetime'], end, side='right')
+        trimmed[symbol] = {name: values[lo:hi] for name, values in window.items()}
+    index = reduce(np.union1d, (window['datetime'] for window in trimmed.values()))
+
+    aligned = {}
+    for symbol, window in trimmed.items():
+        times = window['datetime']
+        if len(times) == len(index):
+            # 时间戳与并集完全一致，无需补齐
+            aligned[symbol] = window
+            continue
+        position = np.maximum(np.searchsorted(times, index, side='right') - 1, 0)
+        exact = times[position] == index
+        # 重叠区间开头的缺失K线用第一根K线的开盘价补齐
+        fill = np.where(index < times[0], window['open'][0], window['close'][position])
+        aligned[symbol] = {'datetime': index, 'volume': np.where(exact, window['volume'][position], 0.0)}
+        for name in ('open', 'high', 'low', 'close'):
+            aligned[symbol][name] = np.where(exact, window[name][position], fill)
+    return aligned
+
+
+class NumpyData(bt.feed.DataBase):
+    """
+    直接从 NumPy 数组（可为内存映射）逐根读取K线的数据源，不构建 DataFrame。
+    dataname 为 {列名: 数组} 字典或其列表（多段按顺序拼接），datetime 列为 int64 纳秒时间戳；
+    也可以是返回分段迭代器的可调用对象（如生成器函数），此时分段在回测推进时才逐段读取。
+    """
+
+    def start(self):
+        super(NumpyData, self).start()
+        segments = self.p.dataname
+        if isinstance(segments, dict):
+            segments = [segments]
+        elif callable(segments):
+            segments = segments()
+        self._segments = iter(segments)
+        self._idx = 0
+        self._size = 0
+
+    def _next_segment(self):
+        # 跳过空分段，读取到下一段有数据的分段
+        for segment in self._segments:
+            if not len(segment['datetime']):
+                continue
+            self._dt = segment['datetime']
+            self._open = segment['open']
+            self._high = segment['high']
+            self._low = segment['low']
+            self._close = segment['close']
+            self._volume = segment['volume']
+            self._idx = 0
+            self._size = len(self._dt)
+            return True
+        return False
+
+    def _load(self):
+        if self._idx >= self._size and not self._next_segment():
+            return False
+
+        i = self._idx
+        self._idx += 1
+        self.lines.open[0] = self._open[i]
+        self.lines.high[0] = self._high[i]
+        self.lines.low[0] = self._low[i]
+        self.lines.close[0] = self._close[i]
+        self.lines.volume[0] = self._volume[i]
+
+        # 纳秒时间戳直接换算为 backtrader 日期数值，结果与 date2num 一致
+        days, remainder = divmod(int(self._dt[i]), NS_PER_DAY)
+        self.lines.datetime[0] = (EPOCH_ORDINAL + days) + remainder / NS_PER_DAY
+        return True
+
+
+class IntrabarIndex:
+    """
+    上层周期K线内部的1分钟K线及逐根索引，Broker 据此按1分钟K线的先后顺序撮合上层K线内的订单。
+    columns 为1分钟K线的 {列名: 数组} 字典或分段列表，minutes 为上层周期的分钟数。
+    """
+
+    def __init__(self, columns, minutes):
+        if not isinstance(columns, dict):
+            columns = {name: np.concatenate([segment[name] for segment in columns])
+                       for name in ('datetime',) + KLINE_COLUMNS}
+        self.open = np.ascontiguousarray(columns['open'], dtype=np.float64)
+        self.high = np.ascontiguousarray(columns['high'], dtype=np.float64)
+        self.low = np.ascontiguousarray(columns['low'], dtype=np.float64)
+        self.close = np.ascontiguousarray(columns['close'], dtype=np.float64)
+        # labels[i] 为第 i 根上层K线的时间（取整到秒，日线的 23:59:59.99999 记为次日零点），
+        # 其1分钟K线为 bounds[i]:bounds[i + 1]
+        labels, starts = _period_bounds(np.asarray(columns['datetime'], dtype=np.int64), minutes)
+        self.labels = ((labels + 5 * 10 ** 8) // 10 ** 9).tolist()
+        self.bounds = np.r_[starts, len(self.open)].tolist()
+        self._cursor = 0
+
+    def locate(self, dt):
+        """
+        返回 backtrader 日期数值 dt 对应的上层K线在1分钟数组中的下标范围 (lo, hi)，没有对应的1分钟K线时返回 None。
+        回测按时间推进，先检查上次位置及其下一根，找不到时再二分查找。
+        """
+        second = round((dt - EPOCH_ORDINAL) * 86400)
+        labels = self.labels
+        i = self._cursor
+        if not (i < len(labels) and labels[i] == second):
+            i += 1
+            if not (i < len(labels) and labels[i] == second):
+                i = bisect.bisect_left(labels, second)
+                if not (i < len(labels) and labels[i] == second):
+                    return None
+        self._cursor = i
+        return self.bounds[i], self.bounds[i + 1]
+
+
+def share_kline_window(window, minutes=1):
+    """
+    将K线数据（{列名: 数组} 字典或分段列表）复制到一块共享内存中，只占用一份内存。
+    返回 (SharedMemory, 描述信息)，描述信息可序列化传给工作进程，调用方负责在结束后 close/unlink。
+    """
+    segments = [window] if isinstance(window, dict) else window
+    rows = sum(len(segment['datetime']) for segment in segments)
+    names = ('datetime',) + KLINE_COLUMNS
+    shm = shared_memory.SharedMemory(create=True, size=max(rows * 8 * len(names), 1))
+
+    descriptor = {'name': shm.name, 'rows': rows, 'minutes': minutes}
+    columns = _shared_columns(shm, rows)
+    position = 0
+    for segment in segments:
+        size = len(segment['datetime'])
+        for name in names:
+            columns[name][position:position + size] = segment[name]
+        position += size
+    del columns
+    return shm, descriptor
+
+
+def _shared_columns(shm, rows):
+    """在共享内存上按列构造数组视图，datetime 为 int64，其余为 float64"""
+    columns = {}
+    for i, name in enumerate(('datetime',) + KLINE_COLUMNS):
+        dtype = np.int64 if name == 'datetime' else np.float64
+        columns[name] = np.ndarray((rows,), dtype=dtype, buffer=shm.buf, offset=i * rows * 8)
+    return columns
+
+
+def attach_kline_window(descriptor):
+    """
+    在工作进程中按名称挂载共享内存中的K线数据，同一进程内只挂载一次。
+    挂载时 SharedMemory 会把共享内存登记到本进程的 resource_tracker：进程池工作进程与主进程共用一个 tracker，
+    登记只是重复；独立启动的进程会新建自己的 tracker，进程退出时会删除主进程仍在使用的共享内存，因此取消登记。
+    """
+    name = descriptor['name']
+    if name not in _attached_windows:
+        # 挂载前尚未连接 tracker 时，挂载会启动本进程自己的 tracker
+        own_tracker = resource_tracker._resource_tracker._fd is None
+        shm = shared_memory.SharedMemory(name=name)
+        if own_tracker:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        _attached_windows[name] = (shm, _shared_columns(shm, descriptor['rows']))
+    return _attached_windows[name][1]
+
+
+def release_kline_window(descriptor):
+    """
+    释放当前进程对共享内存K线数据的挂载
+    """
+    shm, columns = _attached_windows.pop(descriptor['name'], (None, None))
+    if shm is not None:
+        del columns
+        shm.close()
+
+
+def build_csv_index(kline_file_path, cache_dir=None, step=10000):
+    """
+    为时间有序的K线CSV建立稀疏的 时间→字节偏移 索引（每 step 行记录一次）并持久化。
+    返回 (times, offsets)，times 为 int64 纳秒时间戳。
+    """
+    index_path = _cache_root(kline_file_path, cache_dir) + '.index.npz'
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            return index['times'], index['offsets']
+
+    offsets = []
+    stamps = []
+    with open(kline_file_path, 'rb') as f:
+        header = f.readline()
+        column = header.decode().strip().split(',').index('open_time')
+        position = len(header)
+        for i, line in enumerate(f):
+            if i % step == 0:
+                offsets.append(position)
+                stamps.append(line.split(b',')[column].decode())
+            position += len(line)
+
+    times = _to_epoch_ns(stamps) if stamps else np.empty(0, dtype=np.int64)
+    if np.any(np.diff(times) < 0):
+        raise ValueError("Kline file is not sorted by open_time, use the cache instead.")
+
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f'{index_path}.tmp{os.getpid()}.npz'
+    np.savez(tmp_path, times=times, offsets=np.asarray(offsets, dtype=np.int64))
+    os.replace(tmp_path, index_path)
+    return times, np.asarray(offsets, dtype=np.int64)
+
+
+def _iter_csv_chunks(kline_file_path, start_date, end_date, cache_dir=None, chunksize=10000):
+    """
+    不使用缓存时，借助稀疏索引直接定位到起始位置分块读取CSV，逐块产出过滤后的 DataFrame，读过 end_date 后停止。
+    """
+    times, offsets = build_csv_index(kline_file_path, cache_dir)
+    if not len(offsets):
         raise ValueError("No data loaded. Please check the file path and date range.")
 
+    # 找到最后一个早于 start_date 的采样行，从该行开始读取
+    start, end = _to_epoch_ns([start_date, end_date])
+    position = max(np.searchsorted(times, start, side='left') - 1, 0)
+
+    with open(kline_file_path, 'rb') as f:
+        names = f.readline().decode().strip().split(',')
+        f.seek(offsets[position])
+        # 使用分块读取，避免大文件内存问题
+        for chunk in pd.read_csv(f, chunksize=chunksize, header=None, names=names,
+                                 usecols=['open_time', 'open', 'high', 'low', 'close', 'volume']):
+            # 转换时间并过滤所需的时间段
+            chunk['open_time'] = pd.to_datetime(chunk['open_time'])
+            chunk_filtered = chunk[(chunk['open_time'] >= start_date) & (chunk['open_time'] <= end_date)]
+            if len(chunk_filtered):
+                yield chunk_filtered
+            if chunk['open_time'].iloc[-1] > end_date:
+                break
+
+
+def _read_csv_window(kline_file_path, start_date, end_date, cache_dir=None):
+    """
+    不使用缓存时读取CSV中[start_date, end_date]区间的数据，返回 DataFrame。
+    """
+    chunk_list = list(_iter_csv_chunks(kline_file_path, start_date, end_date, cache_dir))
+
+    # 合并所有分块数据
+    if chunk_list:
+        return pd.concat(chunk_list)
+    raise ValueError("No data loaded. Please check the file path and date range.")
+
+
+def iter_csv_window(kline_file_path, start_date, end_date, cache_dir=None, chunksize=10000):
+    """
+    流式读取CSV中[start_date, end_date]区间的数据，逐块产出 {列名: 数组} 字典，任意时刻只持有一个分块。
+    """
+    for chunk in _iter_csv_chunks(kline_file_path, start_date, end_date, cache_dir, chunksize):
+        yield _frame_window(chunk)
+
+
+def _dataframe_feed(kline_dataframe):
+    """
+    将CSV读取的 DataFrame 转换为 Backtrader 的 PandasData 数据源。
+    """
     # 重命名列以符合Backtrader要求
     kline_dataframe.rename(columns={
         'open_time': 'datetime',
@@ -41,19 +651,204 @@ def configure_data(cerebro, kline_file_path, start_date, end_date, timeframe=bt.
         raise ValueError("Data contains NaN values. Please clean your data.")
 
     # 将数据加载到Backtrader
-    kline_data = bt.feeds.PandasData(
+    return bt.feeds.PandasData(
         dataname=kline_dataframe,
         timeframe=bt.TimeFrame.Minutes,
         compression=1,
     )
-    # 添加1分钟数据到cerebro
-    # cerebro.adddata(kline_data, name='1M')
 
-    cerebro.resampledata(kline_data, timeframe=bt.TimeFrame.Minutes, compression=5, name='5M')
 
-    # cerebro.resampledata(kline_data, timeframe=bt.TimeFrame.Minutes, compression=60, name='1H')
+def configure_portfolio_data(cerebro, kline_file_paths, start_date, end_date, timeframe=bt.TimeFrame.Minutes,
+                             compression=5, use_cache=True, cache_dir=None, preresample=False, shared=None,
+                             max_workers=None, streaming=False, intrabar=False):
+    """
+    多品种数据加载：并发读取各K线文件并对齐到共同的时间索引，每个品种以交易对名称（如 BTCUSDT）作为数据源名称加入，
+    策略中可通过 self.datas 遍历或 self.getdatabyname('BTCUSDT') 获取。
+    shared 为 {交易对名称: 共享内存描述信息} 字典时直接挂载主进程发布的数据。
+    streaming=True 时各品种分别以流式数据源加入（先并行建立缓存），不做缺失K线补齐，由 Backtrader 按时间同步。
+    intrabar=True 时各品种附加对齐后的1分钟K线索引，见 configure_data。
+    """
+    minutes = _period_minutes(timeframe, compression)
+    native = preresample and use_cache
+    if streaming:
+        if use_cache:
+            prepare_kline_caches(kline_file_paths, cache_dir, minutes if native else 1, max_workers)
+        for path in kline_file_paths:
+            feed = _streaming_feed(path, start_date, end_date, timeframe, compression, use_cache, cache_dir,
+                                   preresample)
+            if native:
+                cerebro.adddata(feed, name=symbol_name(path))
+            else:
+                cerebro.resampledata(feed, timeframe=timeframe, compression=compression, name=symbol_name(path))
+        return
 
+    if shared is not None:
+        start, end = _to_epoch_ns([start_date, end_date])
+        windows = {}
+        for symbol, descriptor in shared.items():
+            window = attach_kline_window(descriptor)
+            lo = np.searchsorted(window['datetime'], start, side='left')
+            hi = np.searchsorted(window['datetime'], end, side='right')
+            windows[symbol] = {name: values[lo:hi] for name, values in window.items()}
+        source_minutes = {descriptor['minutes'] for descriptor in shared.values()}
+        if source_minutes != {minutes} and source_minutes != {1}:
+            raise ValueError("Shared data timeframe does not match the requested timeframe.")
+        native = source_minutes == {minutes}
+    else:
+        windows = load_kline_windows(kline_file_paths, start_date, end_date, cache_dir, minutes if native else 1,
+                                     use_cache, max_workers)
 
+    minute_windows = windows
+    if intrabar and native:
+        # 目标周期数据不含1分钟K线，另外读取并对齐
+        minute_windows = load_kline_windows(kline_file_paths, start_date, end_date, cache_dir, 1, use_cache,
+                                            max_workers)
 
+    for symbol, window in windows.items():
+        if native:
+            feed = NumpyData(dataname=window, timeframe=timeframe, compression=compression)
+            cerebro.adddata(feed, name=symbol)
+        else:
+            kline_data = NumpyData(dataname=window, timeframe=bt.TimeFrame.Minutes, compression=1)
+            feed = cerebro.resampledata(kline_data, timeframe=timeframe, compression=compression, name=symbol)
+        if intrabar:
+            feed.intrabar = IntrabarIndex(minute_windows[symbol], minutes)
 
 
+def configure_streaming(cerebro, exactbars=1):
+    """
+    流式回测设置：关闭数据预加载，数据源在回测推进时逐根读取；
+    exactbars=1 时各行情线只保留指标最小周期所需的K线，内存占用不随回测区间增长。
+    """
+    cerebro.p.preload = False
+    if not cerebro.p.exactbars:
+        cerebro.p.exactbars = exactbars
+
+
+def _streaming_feed(kline_file_path, start_date, end_date, timeframe, compression, use_cache, cache_dir,
+                    preresample):
+    """
+    构建流式数据源：分段在回测推进时由生成器逐段读取，use_cache 时为内存映射的月份分片，否则为CSV分块。
+    """
+    if use_cache and preresample:
+        segments = partial(iter_kline_segments, kline_file_path, start_date, end_date, cache_dir,
+                           _period_minutes(timeframe, compression))
+        return NumpyData(dataname=segments, timeframe=timeframe, compression=compression)
+    if use_cache:
+        segments = partial(iter_kline_segments, kline_file_path, start_date, end_date, cache_dir)
+    else:
+        segments = partial(iter_csv_window, kline_file_path, start_date, end_date, cache_dir)
+    return NumpyData(dataname=segments, timeframe=bt.TimeFrame.Minutes, compression=1)
+
+
+def _period_minutes(timeframe, compression):
+    """将 Backtrader 的周期设置换算为分钟数"""
+    if timeframe == bt.TimeFrame.Minutes:
+        return compression
+    if timeframe == bt.TimeFrame.Days:
+        return compression * 1440
+    raise ValueError("Only minute and day timeframes are supported.")
+
+
+def _feed_name(minutes):
+    """根据分钟数生成数据源名称，如 5M、1H、1D"""
+    if minutes % 1440 == 0:
+        return f'{minutes // 1440}D'
+    if minutes % 60 == 0:
+        return f'{minutes // 60}H'
+    return f'{minutes}M'
+
+
+def configure_data(cerebro, kline_file_path, start_date, end_date, timeframe=bt.TimeFrame.Minutes, compression=5,
+                   use_cache=True, cache_dir=None, preresample=False, shared=None, streaming=False, intrabar=False):
+    """
+    优化后的数据加载和重新采样函数，支持CSV文件输入，并通过时间范围过滤数据。
+    use_cache=True 时首次运行会建立按月分片的列式缓存，之后以内存映射方式只读取与时间范围重叠的分片；
+    use_cache=False 时通过稀疏字节偏移索引直接定位CSV中的起始行。
+    preresample=True 时直接加载向量化预聚合并缓存的目标周期K线，回测中不再逐根重新采样。
+    shared 为 share_kline_window 返回的描述信息时，直接挂载主进程发布的共享内存数据并截取时间范围，忽略文件参数。
+    kline_file_path 为文件路径列表时进行多品种组合回测，见 configure_portfolio_data。
+    streaming=True 时以流式数据源逐段读取缓存分片或CSV分块，并关闭预加载、启用 exactbars，
+    内存占用与回测区间长度无关（exactbars 模式下不能绘图，可在 cerebro.run 中显式传入 exactbars 覆盖）。
+    intrabar=True 时为数据源附加其1分钟K线索引（data.intrabar），FuturesBroker 按1分钟K线的先后顺序撮合订单，
+    策略仍然只看到目标周期的K线；预聚合或共享内存中为目标周期数据时从缓存另外读取1分钟K线。
+    """
+    minutes = _period_minutes(timeframe, compression)
+    if streaming and intrabar:
+        raise ValueError("Intrabar execution is not supported in streaming mode.")
+    if streaming:
+        configure_streaming(cerebro)
+    if not isinstance(kline_file_path, (str, os.PathLike)):
+        configure_portfolio_data(cerebro, kline_file_path, start_date, end_date, timeframe, compression,
+                                 use_cache, cache_dir, preresample, shared, streaming=streaming, intrabar=intrabar)
+        return
+
+    if shared is not None:
+        # 挂载共享内存中的数据，多个进程共用同一份数据，按时间范围截取视图
+        window = attach_kline_window(shared)
+        start, end = _to_epoch_ns([start_date, end_date])
+        lo = np.searchsorted(window['datetime'], start, side='left')
+        hi = np.searchsorted(window['datetime'], end, side='right')
+        window = {name: values[lo:hi] for name, values in window.items()}
+        if shared['minutes'] == minutes:
+            feed = NumpyData(dataname=window, timeframe=timeframe, compression=compression)
+            cerebro.adddata(feed, name=_feed_name(minutes))
+            if intrabar:
+                feed.intrabar = IntrabarIndex(
+                    load_kline_segments(kline_file_path, start_date, end_date, cache_dir), minutes)
+            return
+        if shared['minutes'] != 1:
+            raise ValueError("Shared data timeframe does not match the requested timeframe.")
+        kline_data = NumpyData(dataname=window, timeframe=bt.TimeFrame.Minutes, compression=1)
+        feed = cerebro.resampledata(kline_data, timeframe=timeframe, compression=compression,
+                                    name=_feed_name(minutes))
+        if intrabar:
+            feed.intrabar = IntrabarIndex(window, minutes)
+        return
+
+    if streaming:
+        feed = _streaming_feed(kline_file_path, start_date, end_date, timeframe, compression, use_cache, cache_dir,
+                               preresample)
+        if use_cache and preresample:
+            cerebro.adddata(feed, name=_feed_name(minutes))
+        else:
+            cerebro.resampledata(feed, timeframe=timeframe, compression=compression, name=_feed_name(minutes))
+        return
+
+    if use_cache and preresample:
+        # 预聚合数据以目标周期原生数据源加入，不再经过 Backtrader 的重新采样
+        segments = load_kline_segments(kline_file_path, start_date, end_date, cache_dir, minutes)
+        if not segments:
+            raise ValueError("No data loaded. Please check the file path and date range.")
+        feed = NumpyData(dataname=segments, timeframe=timeframe, compression=compression)
+        cerebro.adddata(feed, name=_feed_name(minutes))
+        if intrabar:
+            feed.intrabar = IntrabarIndex(
+                load_kline_segments(kline_file_path, start_date, end_date, cache_dir), minutes)
+        return
+
+    if use_cache:
+        # 直接使用内存映射的缓存分片，不构建 DataFrame
+        segments = load_kline_segments(kline_file_path, start_date, end_date, cache_dir)
+        if not segments:
+            raise ValueError("No data loaded. Please check the file path and date range.")
+        kline_data = NumpyData(
+            dataname=segments,
+            timeframe=bt.TimeFrame.Minutes,
+            compression=1,
+        )
+    else:
+        kline_data = _dataframe_feed(_read_csv_window(kline_file_path, start_date, end_date, cache_dir))
+        if intrabar:
+            frame = kline_data.p.dataname
+            segments = dict(datetime=_to_epoch_ns(frame.index),
+                            **{name: frame[name].to_numpy() for name in KLINE_COLUMNS})
+
+    # 添加1分钟数据到cerebro
+    # cerebro.adddata(kline_data, name='1M')
+
+    feed = cerebro.resampledata(kline_data, timeframe=timeframe, compression=compression, name=_feed_name(minutes))
+    if intrabar:
+        feed.intrabar = IntrabarIndex(segments, minutes)
+
+    # cerebro.resampledata(kline_data, timeframe=bt.TimeFrame.Minutes, compression=60, name='1H')
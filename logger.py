@@ -0,0 +1,122 @@
+"""
+异步结构化日志
+回测主线程只做级别判断并把 (级别, 时间, 事件, 字段) 放入队列，不做任何字符串格式化；
+后台线程批量取出记录，写入 JSONL 文件（时间为毫秒时间戳整数）或按原有文本格式输出到控制台。
+"""
+import datetime
+import json
+import math
+import queue
+import sys
+import threading
+
+# 日志级别，START 与 INFO 同级
+LEVELS = {'DEBUG': 10, 'INFO': 20, 'START': 20, 'WARNING': 30, 'ERROR': 40}
+
+# 控制台输出时各事件的文本模板
+MESSAGES = {
+    'message': '{message}',
+    'start': '回测开始，初始资金: {cash:.2f} USDT | 初始总值: {value:.2f} USDT',
+    'stop': '策略执行结束 | 最终现金: {cash:.4f} USDT | 最终账户总值: {value:.4f} | 当前持仓: {positions} | 总收益率: {return_pct:.2f}%',
+    'buy': '{label}开仓，价格: {price:.2f} USDT，成本: {value:.3f} USDT，佣金费用: {comm:.4f} USDT，成交量: {size:.4f} BTC',
+    'sell': '{label}平仓，价格: {price:.2f} USDT，成本: {value:.3f} USDT，佣金费用: {comm:.4f} USDT，成交量: {size:.4f} BTC',
+    'order': '订单被取消/保证金不足/拒绝，原因: {status}',
+    'trade': '{label}交易平仓 | 盈亏: {pnl:.2f} USDT | 净盈亏（含佣金）: {pnlcomm:.2f} USDT',
+    'pruned': '触发提前终止规则: {reason}，账户总值: {value:.2f} USDT',
+}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+# backtrader 的日期数值以 0001-01-01 为第1天，1970-01-01 对应 719163
+EPOCH_ORDINAL = 719163.0
+# json.dumps 带参数时每次调用都会新建编码器，这里复用同一个
+_encode = json.JSONEncoder(ensure_ascii=False, default=str).encode
+
+
+def to_timestamp(dt):
+    """backtrader 日期数值转换为毫秒时间戳整数"""
+    return round((dt - EPOCH_ORDINAL) * 86400000)
+
+
+class AsyncLogWriter:
+    """
+    后台线程批量写日志。path 为 None 时输出到控制台，否则追加写入 JSONL 文件；
+    level 为 None 时关闭日志，不启动线程，enabled 始终返回 False。
+    后台线程在 start 时才启动，此前放入队列的记录在启动后写出。
+    """
+
+    def __init__(self, path=None, level='INFO', batch_size=1024):
+        self.path = path
+        self.threshold = math.inf if level is None else LEVELS.get(level, LEVELS['INFO'])
+        self.batch_size = batch_size
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._last_dt = None  # 同一根K线的多条日志复用时间文本
+        self._last_time = ''
+
+    def start(self):
+        """启动后台写入线程，日志关闭或已启动时不做任何事"""
+        if self.threshold != math.inf and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='strategy-log-writer', daemon=True)
+            self._thread.start()
+
+    def enabled(self, level):
+        """调用方在构造日志字段之前先判断级别"""
+        return LEVELS.get(level, LEVELS['INFO']) >= self.threshold
+
+    def emit(self, level, dt, event, fields):
+        """放入一条记录，dt 为 backtrader 日期数值（没有K线时为 None）"""
+        self._queue.put((level, dt, event, fields))
+
+    def close(self):
+        """写完队列中剩余的记录后结束后台线程"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        out = open(self.path, 'a', encoding='utf-8') if self.path else sys.stdout
+        render = self._json if self.path else self._text
+        try:
+            while True:
+                batch = [self._queue.get()]
+                # 一次取出队列中已有的记录，合并为一次写入
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = batch[-1] is None
+                lines = [render(*record) for record in batch if record is not None]
+                if lines:
+                    out.write('\n'.join(lines) + '\n')
+                    out.flush()
+                if done:
+                    return
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+    @staticmethod
+    def _json(level, dt, event, fields):
+        record = {'ts': None if dt is None else to_timestamp(dt), 'level': level, 'event': event}
+        record.update(fields)
+        return _encode(record)
+
+    def _text(self, level, dt, event, fields):
+        if 'data' in fields:
+            # 多品种回测时以数据源名称作为前缀
+            fields = dict(fields, label=f"{fields['data']} | " if fields['data'] else '')
+        if 'positions' in fields:
+            positions = fields['positions']
+            if len(positions) == 1:
+                text = f'{next(iter(positions.values())):.4f} BTC'
+            else:
+                text = ', '.join(f'{name} {size:.4f}' for name, size in positions.items())
+            fields = dict(fields, positions=text)
+        message = MESSAGES.get(event, '{message}').format(**fields)
+        if dt != self._last_dt:
+            self._last_dt = dt
+            self._last_time = '' if dt is None else (
+                EPOCH + datetime.timedelta(milliseconds=to_timestamp(dt))).strftime('%Y-%m-%d %H:%M:%S')
+        return f'[{level}] - {self._last_time} - {message}'
@@ -5,6 +5,8 @@ from strategy import SystemOne, SystemTwo, PriceClusterStrategy
 from broker import configure_broker
 from sizer import configure_sizer
 from analyzer import add_analyzers, print_result
+from metrics import configure_equity_observer, equity_metrics
+from optimizer import run_optimization, walk_forward
 
 
 # 自定义 Trades 观察器
@@ -50,25 +52,37 @@ def initialize_backtest():
     # 数据文件路径
     kline_file_path = '/Users/prophetl/PycharmProjects/BackTrader/F-BTCUSDT-1m-202001-202408.csv'
     # kline_file_path = '/Users/prophetl/PycharmProjects/BackTrader/F-ETHUSDT-1m-202001-202408.csv'
+    # 多品种组合回测：传入文件路径列表，各品种以交易对名称作为数据源名称
+    # kline_file_path = [
+    #     '/Users/prophetl/PycharmProjects/BackTrader/F-BTCUSDT-1m-202001-202408.csv',
+    #     '/Users/prophetl/PycharmProjects/BackTrader/F-ETHUSDT-1m-202001-202408.csv',
+    # ]
     start_date = datetime.datetime(2024, 1, 1)
     end_date = datetime.datetime(2024, 2, 2)
     # end_date = start_date+ datetime.timedelta(hours=48)
 
     # 配置数据
     configure_data(cerebro, kline_file_path, start_date, end_date)
+    # 策略仍使用5分钟K线，Broker 按其中的1分钟K线撮合订单（同一根K线内止盈止损按触发先后成交）
+    # configure_data(cerebro, kline_file_path, start_date, end_date, intrabar=True)
 
     # 添加策略
     cerebro.addstrategy(SystemOne)
     # cerebro.addstrategy(PriceClusterStrategy)
 
-    # 配置 Broker
+    # 配置 Broker（可传入 data_loader.load_funding_rates 读取的历史资金费率，在每次结算时刻收付资金费）
     configure_broker(cerebro)
+    # configure_broker(cerebro, funding_rates=load_funding_rates('/Users/prophetl/PycharmProjects/BackTrader/BTCUSDT-fundingRate.csv'))
     # 配置 Sizer
     configure_sizer(cerebro)
-    # 添加分析器
+    # 添加分析器（传入 journal_path 时订单和交易明细写入列式文件，如 'journal.npz'）
     add_analyzers(cerebro)
+    # 以单个合并分析器代替叠加的分析器，逐K线开销更低，结果通过 collect_analysis 读取
+    # add_analyzers(cerebro, fused=True)
     # 添加观察者
     cerebro.addobserver(bt.observers.Broker)
+    # 记录权益数组，回测后向量化计算回撤、滚动夏普/索提诺、月度收益和持仓敞口
+    configure_equity_observer(cerebro)
     # cerebro.addobserver(bt.observers.TimeReturn)
     # cerebro.addobserver(bt.observers.DrawDown)
     # 配置自定义 Trades 观察器
@@ -86,6 +100,11 @@ def run_backtest():
     results = cerebro.run(stdstats=False)  # 选 False 的情况下，必须要手动添加 Broker
 
     print_result(results)
+    summary = equity_metrics(results[-1])
+    print(f"最大回撤: {summary['max_drawdown']:.2f}% | 最长回撤: {summary['max_drawdown_days']:.1f} 天 | "
+          f"夏普: {summary['sharpe']:.2f} | 索提诺: {summary['sortino']:.2f} | 持仓时间占比: {summary['time_in_market']:.1%}")
+    print(summary['monthly_returns'])
+    # 资金曲线和回撤曲线见 visualization.plot_combined_equity_and_drawdown(results[-1])
     cerebro.plot(
         strategy=results[-1],
         # style='line',
@@ -101,6 +120,49 @@ def run_backtest():
     )
 
 
+def run_optimize():
+    """运行参数优化"""
+    kline_file_path = '/Users/prophetl/PycharmProjects/BackTrader/F-BTCUSDT-1m-202001-202408.csv'
+    start_date = datetime.datetime(2024, 1, 1)
+    end_date = datetime.datetime(2024, 2, 2)
+
+    results = run_optimization(
+        kline_file_path, start_date, end_date,
+        strategy=SystemOne,
+        strategy_grid=dict(deque_length=[10, 15, 20]),
+        broker_grid=dict(leverage=[5, 10, 20], slippage=[0.1]),
+        sizer_grid=dict(percent=[0.05, 0.1]),
+        # 回撤超过30%或2000根K线内没有成交的参数组提前结束
+        stop_rules=dict(max_drawdown=30, no_trade_bars=2000),
+        progress=lambda completed, total: print(f'优化进度: {completed}/{total}'),
+    )
+    results.to_csv('optimization_results.csv', index=False)
+    print(results.head(10))
+
+
+def run_walk_forward():
+    """运行前进分析"""
+    kline_file_path = '/Users/prophetl/PycharmProjects/BackTrader/F-BTCUSDT-1m-202001-202408.csv'
+    start_date = datetime.datetime(2023, 1, 1)
+    end_date = datetime.datetime(2024, 8, 1)
+
+    equity, folds = walk_forward(
+        kline_file_path, start_date, end_date,
+        in_sample=datetime.timedelta(days=90),
+        out_of_sample=datetime.timedelta(days=30),
+        strategy=SystemOne,
+        broker_grid=dict(leverage=[5, 10, 20]),
+        sizer_grid=dict(percent=[0.05, 0.1]),
+    )
+    folds.to_csv('walk_forward_folds.csv', index=False)
+    print(folds)
+    print(f'样本外最终资金: {equity.iloc[-1]:.2f} USDT')
+
+
 if __name__ == '__main__':
     # 运行普通回测
     run_backtest()
+    # 运行参数优化
+    # run_optimize()
+    # 运行前进分析
+    # run_walk_forward()
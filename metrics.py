@@ -0,0 +1,240 @@
+"""
+回测后的向量化指标
+EquityObserver 每根K线只把时间、账户价值、现金和持仓名义价值写入预分配数组（exactbars 流式回测时按日采样），
+回撤曲线、最长回撤时间、滚动夏普/索提诺、月度收益和持仓敞口在回测结束后用 NumPy 一次计算。
+"""
+import numpy as np
+import pandas as pd
+import backtrader as bt
+from analyzer import ColumnBuffer
+from logger import to_timestamp
+
+EQUITY_COLUMNS = (
+    ('ts', np.int64),  # K线时间（毫秒时间戳）
+    ('value', np.float64),  # 账户价值
+    ('cash', np.float64),
+    ('exposure', np.float64),  # 各品种持仓名义价值绝对值之和
+)
+DAY_MS = 86400000
+
+
+class EquityObserver(bt.Observer):
+    """
+    记录逐K线的账户价值和持仓名义价值，数组按数据源长度预分配，
+    回测结束后通过 equity_arrays / equity_frame / equity_metrics 读取。
+    daily=True 时每天只保留最后一根K线，数组随天数而非K线数增长，回撤等指标按日终价值计算（不含日内回撤）；
+    默认在 exactbars 流式回测时启用。
+    backtrader 的观察者至少需要一条 line，value 线同时记录账户价值，默认不绘图。
+    """
+    lines = ('value',)
+    params = (
+        ('daily', None),
+    )
+
+    def start(self):
+        self._daily = self.p.daily
+        if self._daily is None:
+            self._daily = self._owner.cerebro.p.exactbars > 0
+        self._day = None
+        self._columns = ColumnBuffer(EQUITY_COLUMNS, capacity=1024 if self._daily else max(self.data.buflen(), 1024))
+
+    def next(self):
+        broker = self._owner.broker
+        exposure = 0.0
+        for data in self._owner.datas:
+            size = broker.getposition(data).size
+            if size:
+                exposure += abs(size * data.close[0])
+        self.lines.value[0] = value = broker.getvalue()
+        ts = to_timestamp(self._owner.datetime[0])
+        if self._daily:
+            day = ts // DAY_MS
+            if day == self._day:
+                # 同一天内覆盖当天的记录
+                self._columns.size -= 1
+            self._day = day
+        self._columns.append(ts, value, broker.getcash(), exposure)
+
+    def columns(self):
+        return self._columns.columns()
+
+
+def configure_equity_observer(cerebro):
+    # 记录权益曲线，供 metrics 和 visualization 使用
+    cerebro.addobserver(EquityObserver)
+
+
+def equity_arrays(strategy):
+    """
+    返回 EquityObserver 记录的 {列名: 数组}，没有添加该观察者时报错
+    """
+    for observer in strategy.stats:
+        if isinstance(observer, EquityObserver):
+            return observer.columns()
+    raise ValueError("Strategy has no EquityObserver; call configure_equity_observer(cerebro) before running.")
+
+
+def bar_returns(value):
+    """逐K线收益率，长度与 value 相同，第一根为0；账户价值为0之后的收益记为0"""
+    returns = np.zeros(len(value))
+    if len(value) > 1:
+        previous = value[:-1]
+        np.divide(value[1:] - previous, previous, out=returns[1:], where=previous != 0)
+    return returns
+
+
+def periods_per_year(ts):
+    """按K线时间间隔的中位数估算每年的K线数量（全年365天交易）"""
+    if len(ts) < 2:
+        return 1.0
+    return 365 * DAY_MS / float(np.median(np.diff(ts)))
+
+
+def drawdown_curve(value):
+    """
+    回撤曲线（自最高点回落的百分比，正数）和回撤金额
+    """
+    peak = np.maximum.accumulate(value)
+    moneydown = peak - value
+    drawdown = np.divide(moneydown * 100.0, peak, out=np.zeros(len(value)), where=peak > 0)
+    return drawdown, moneydown
+
+
+def drawdown_periods(drawdown):
+    """
+    连续处于回撤中的区间，返回 (起始下标, 结束下标) 数组，结束下标为回到最高点的K线（未恢复时为数据长度）
+    """
+    underwater = np.r_[False, drawdown > 0, False].astype(np.int8)
+    edges = np.diff(underwater)
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def max_drawdown_duration(ts, drawdown):
+    """
+    最长回撤：返回 (K线数, 天数)。K线数与 backtrader DrawDown 的 max.len 相同；
+    天数从回撤前的最高点算到恢复的K线，未恢复时算到最后一根K线
+    """
+    starts, ends = drawdown_periods(drawdown)
+    if not len(starts):
+        return 0, 0.0
+    lengths = ends - starts
+    longest = int(np.argmax(lengths))
+    begin = ts[max(starts[longest] - 1, 0)]
+    end = ts[min(ends[longest], len(ts) - 1)]
+    return int(lengths[longest]), (end - begin) / DAY_MS
+
+
+def _rolling_sum(values, window):
+    """长度为 window 的滑动窗口求和，前 window-1 个位置为 NaN"""
+    total = np.full(len(values), np.nan)
+    if window <= len(values):
+        cumsum = np.cumsum(np.r_[0.0, values])
+        total[window - 1:] = cumsum[window:] - cumsum[:-window]
+    return total
+
+
+def rolling_sharpe(returns, window, annualization=1.0):
+    """
+    滑动窗口夏普比率（无风险利率为0），用累计和一次计算所有窗口的均值和样本标准差
+    """
+    mean = _rolling_sum(returns, window) / window
+    square = _rolling_sum(returns * returns, window) / window
+    variance = np.maximum(square - mean * mean, 0.0) * window / max(window - 1, 1)
+    std = np.sqrt(variance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(std > 0, mean / std * np.sqrt(annualization), np.nan)
+
+
+def rolling_sortino(returns, window, annualization=1.0):
+    """
+    滑动窗口索提诺比率，下行偏差为窗口内负收益平方的均值再开方
+    """
+    mean = _rolling_sum(returns, window) / window
+    downside = np.minimum(returns, 0.0)
+    deviation = np.sqrt(_rolling_sum(downside * downside, window) / window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(deviation > 0, mean / deviation * np.sqrt(annualization), np.nan)
+
+
+def monthly_returns(ts, value):
+    """
+    月度收益：每月最后一根K线的账户价值相对上月最后一根（首月为第一根K线）的变化，索引为月份
+    """
+    if not len(value):
+        return pd.Series(dtype=np.float64)
+    months = ts.astype('datetime64[ms]').astype('datetime64[M]')
+    last = np.flatnonzero(np.r_[months[1:] != months[:-1], True])
+    month_end = value[last]
+    month_start = np.r_[value[0], month_end[:-1]]
+    returns = np.divide(month_end - month_start, month_start, out=np.zeros(len(last)), where=month_start != 0)
+    return pd.Series(returns, index=pd.PeriodIndex(months[last], freq='M'), name='monthly_return')
+
+
+def exposure_stats(value, exposure):
+    """
+    持仓敞口：有持仓的K线占比，以及持仓名义价值 / 账户价值（总杠杆）的均值和最大值
+    """
+    if not len(value):
+        return {'time_in_market': 0.0, 'average_leverage': 0.0, 'max_leverage': 0.0}
+    leverage = np.divide(exposure, value, out=np.zeros(len(value)), where=value > 0)
+    return {
+        'time_in_market': float(np.mean(exposure > 0)),
+        'average_leverage': float(leverage.mean()),
+        'max_leverage': float(leverage.max()),
+    }
+
+
+def _rolling_window(ts, window_days):
+    """滚动窗口包含的K线根数"""
+    return max(int(round(window_days * periods_per_year(ts) / 365)), 2)
+
+
+def equity_frame(strategy, window_days=30):
+    """
+    逐K线曲线：账户价值、现金、持仓名义价值、收益率、回撤百分比、回撤金额、
+    以及 window_days 天滚动窗口的年化夏普和索提诺比率，索引为K线时间
+    """
+    columns = equity_arrays(strategy)
+    ts, value = columns['ts'], columns['value']
+    returns = bar_returns(value)
+    drawdown, moneydown = drawdown_curve(value)
+    window = _rolling_window(ts, window_days)
+    annualization = periods_per_year(ts)
+    return pd.DataFrame({
+        'value': value,
+        'cash': columns['cash'],
+        'exposure': columns['exposure'],
+        'returns': returns,
+        'drawdown': drawdown,
+        'moneydown': moneydown,
+        'rolling_sharpe': rolling_sharpe(returns, window, annualization),
+        'rolling_sortino': rolling_sortino(returns, window, annualization),
+    }, index=pd.DatetimeIndex(ts.astype('datetime64[ms]'), name='datetime'))
+
+
+def equity_metrics(strategy):
+    """
+    由权益数组计算汇总指标：总收益、最大回撤（百分比/金额/K线数/天数）、全区间年化夏普和索提诺、
+    月度收益（pandas Series）和持仓敞口
+    """
+    columns = equity_arrays(strategy)
+    ts, value = columns['ts'], columns['value']
+    returns = bar_returns(value)[1:]
+    drawdown, moneydown = drawdown_curve(value)
+    bars, days = max_drawdown_duration(ts, drawdown)
+    scale = np.sqrt(periods_per_year(ts))
+    std = returns.std(ddof=1) if len(returns) > 1 else 0.0
+    deviation = np.sqrt(np.mean(np.minimum(returns, 0.0) ** 2)) if len(returns) else 0.0
+    sharpe = returns.mean() / std * scale if std > 0 else np.nan
+    sortino = returns.mean() / deviation * scale if deviation > 0 else np.nan
+    return {
+        'total_return': float(value[-1] / value[0] - 1) if len(value) and value[0] else 0.0,
+        'max_drawdown': float(drawdown.max()) if len(value) else 0.0,
+        'max_moneydown': float(moneydown.max()) if len(value) else 0.0,
+        'max_drawdown_bars': bars,
+        'max_drawdown_days': days,
+        'sharpe': float(sharpe),
+        'sortino': float(sortino),
+        'monthly_returns': monthly_returns(ts, value),
+        **exposure_stats(value, columns['exposure']),
+    }
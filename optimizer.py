@@ -0,0 +1,526 @@
+"""
+多进程参数优化
+数据只在主进程加载一次并发布到共享内存，工作进程按名称挂载同一份数据，不再逐任务序列化数据。
+每组参数的结果按参数哈希保存到本地 SQLite，中断后重跑只计算新的参数组合。
+除网格搜索外，还支持逐轮淘汰（successive halving）和 TPE 自适应搜索，减少完整区间回测的次数。
+walk_forward 提供滚动/锚定的样本内优化、样本外验证，各折并行运行。
+"""
+import contextlib
+import datetime
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+import backtrader as bt
+from data_loader import (configure_data, load_kline_segments, load_kline_windows, share_kline_window,
+                         release_kline_window)
+from strategy import BaseStrategy, SystemOne, StopRules
+from broker import configure_broker
+from sizer import configure_sizer
+from analyzer import add_analyzers, collect_analysis
+
+# 结果版本号，纳入任务哈希。回测逻辑或结果字段变化时递增，旧版本代码算出的结果不再被复用
+RESULT_VERSION = 9
+
+
+def expand_grid(grid):
+    """
+    将 {参数名: 候选值列表} 展开为所有参数组合的列表
+    """
+    if not grid:
+        return [{}]
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def make_tasks(strategy, data_config, candidates, stop_rules=None, journal_dir=None):
+    """
+    将 (策略参数, Broker参数, Sizer参数) 候选列表转换为任务。
+    stop_rules 为 StopRules 的参数字典，任务运行时据此提前终止无望的回测；
+    journal_dir 不为 None 时各任务的订单和交易明细写入该目录下以任务哈希命名的 .npz 文件。
+    """
+    return [
+        dict(strategy=strategy, data=data_config, stop_rules=stop_rules, journal_dir=journal_dir,
+             strategy_params=strategy_params, broker_params=broker_params, sizer_params=sizer_params)
+        for strategy_params, broker_params, sizer_params in candidates
+    ]
+
+
+def build_tasks(strategy, data_config, strategy_grid=None, broker_grid=None, sizer_grid=None, stop_rules=None,
+                journal_dir=None):
+    """
+    生成策略参数、Broker参数和Sizer参数的全部组合任务
+    """
+    candidates = itertools.product(expand_grid(strategy_grid), expand_grid(broker_grid), expand_grid(sizer_grid))
+    return make_tasks(strategy, data_config, candidates, stop_rules, journal_dir)
+
+
+def _hashable(value):
+    """
+    将参数值规范化为可稳定序列化的 JSON 值：NumPy 标量转为 Python 数值，日期时间转为 ISO 字符串，
+    时间间隔转为秒数，类和模块级函数转为限定名称；其他对象的 repr 可能包含内存地址，直接报错
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, (list, tuple)):
+        return [_hashable(item) for item in value]
+    if isinstance(value, dict) and all(isinstance(key, str) for key in value):
+        return {key: _hashable(item) for key, item in value.items()}
+    qualname = getattr(value, '__qualname__', None)
+    if (isinstance(value, type) or callable(value)) and qualname and '<' not in qualname:
+        return f'{value.__module__}.{qualname}'
+    raise TypeError(f"Cannot hash optimizer parameter {value!r} of type {type(value).__name__}; "
+                    "use JSON values, dates, classes or module-level functions.")
+
+
+def task_key(task):
+    """
+    根据结果版本、策略类、策略参数、数据区间、Broker和Sizer参数计算任务的唯一哈希，
+    参数值按 _hashable 规范化，不能稳定序列化的参数报错
+    """
+    data = {name: value for name, value in task['data'].items() if name != 'shared'}
+    paths = data['kline_file_path']
+    if isinstance(paths, (str, os.PathLike)):
+        source = os.path.abspath(paths)
+        stat = os.stat(source)
+        data.update(kline_file_path=source, source_stamp=[stat.st_size, stat.st_mtime_ns])
+    else:
+        sources = [os.path.abspath(path) for path in paths]
+        stats = [os.stat(source) for source in sources]
+        data.update(kline_file_path=sources, source_stamp=[[stat.st_size, stat.st_mtime_ns] for stat in stats])
+    payload = dict(
+        version=RESULT_VERSION,
+        strategy=task['strategy'],
+        strategy_params=task['strategy_params'],
+        broker_params=task['broker_params'],
+        sizer_params=task['sizer_params'],
+        data=data,
+        record_returns=task.get('record_returns', False),
+    )
+    if task.get('stop_rules'):
+        # 提前终止规则会改变结果，纳入哈希；未设置时保持原有哈希不变
+        payload['stop_rules'] = task['stop_rules']
+    return hashlib.sha256(json.dumps(_hashable(payload), sort_keys=True).encode()).hexdigest()
+
+
+class ResultStore:
+    """
+    基于 SQLite 的优化结果存储，以任务哈希为键，每完成一组参数立即落盘
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, row TEXT NOT NULL)')
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """批量读取已完成的结果，返回 {key: row}"""
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            cursor = self.conn.execute(
+                f'SELECT key, row FROM results WHERE key IN ({",".join("?" * len(batch))})', batch)
+            found.update((key, json.loads(row)) for key, row in cursor)
+        return found
+
+    def put(self, key, row):
+        self.conn.execute('INSERT OR REPLACE INTO results (key, row) VALUES (?, ?)', (key, json.dumps(row, default=str)))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def collect_metrics(strat):
+    """
+    汇总单次回测的分析器结果为一行扁平字典
+    """
+    analysis = collect_analysis(strat)
+    metrics = dict(analysis['TradingMetrics'])
+    drawdown = analysis['Drawdown']
+    returns = analysis['Returns']
+    sqn = analysis['SQN']
+    funding = analysis['Funding']
+    liquidations = analysis['Liquidation']['liquidations']
+    metrics.update(
+        max_drawdown=drawdown.max.drawdown,
+        max_moneydown=drawdown.max.moneydown,
+        max_drawdown_len=drawdown.max.len,
+        rtot=returns.get('rtot'),
+        rnorm100=returns.get('rnorm100'),
+        sqn=sqn.get('sqn'),
+        total_funding=funding['total_funding'],
+        total_interest=funding['total_interest'],
+        liquidations=liquidations,
+        liquidated=liquidations > 0,
+        pruned=getattr(strat, 'pruned', None),
+        bars=len(strat),
+        final_value=strat.broker.getvalue(),
+    )
+    return metrics
+
+
+def run_task(task):
+    """
+    在工作进程中运行一组参数的回测，返回参数与指标合并后的字典
+    """
+    cerebro = bt.Cerebro(stdstats=False)
+    configure_data(cerebro, **task['data'])
+    strategy_params = dict(task['strategy_params'])
+    if issubclass(task['strategy'], BaseStrategy):
+        # 工作进程关闭策略日志，日志调用只剩一次级别判断
+        strategy_params.setdefault('log_level', None)
+    if task.get('stop_rules'):
+        strategy_params['stop_rules'] = StopRules(**task['stop_rules'])
+    cerebro.addstrategy(task['strategy'], **strategy_params)
+    # 发生强平即结束回测，爆仓的参数组不必模拟到区间结束
+    configure_broker(cerebro, **{'stop_on_liquidation': True, **task['broker_params']})
+    configure_sizer(cerebro, **task['sizer_params'])
+    journal = os.path.join(task['journal_dir'], f'{task_key(task)}.npz') if task.get('journal_dir') else None
+    # 单个合并分析器，每根K线只处理一次账户价值，也不需要 Broker 观察者
+    add_analyzers(cerebro, journal_path=journal, fused=True)
+    if task.get('record_returns'):
+        cerebro.addanalyzer(bt.analyzers.TimeReturn, timeframe=bt.TimeFrame.Days, _name='DailyReturns')
+
+    # 屏蔽其余输出，避免多进程刷屏
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        strat = cerebro.run()[0]
+
+    row = {**task['strategy_params'], **task['broker_params'], **task['sizer_params']}
+    row.update(collect_metrics(strat))
+    if journal:
+        row['journal'] = journal
+    if task.get('record_returns'):
+        row['returns'] = {dt.isoformat(): value for dt, value in strat.analyzers.DailyReturns.get_analysis().items()}
+    return row
+
+
+def _run_indexed(item):
+    index, task = item
+    return index, run_task(task)
+
+
+def run_tasks(tasks, processes=None, store=None, progress=None):
+    """
+    使用进程池并行运行任务，processes=1 时在当前进程内顺序运行。
+    传入 store 时跳过已有结果的任务，并在每个任务完成后立即保存结果。
+    progress 为可选的回调 progress(已完成数, 待运行总数)，在主进程中每完成一个任务调用一次。
+    """
+    rows = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    if store is not None:
+        keys = [task_key(task) for task in tasks]
+        done = store.get_many(keys)
+        pending = []
+        for index, key in enumerate(keys):
+            if key in done:
+                rows[index] = done[key]
+            else:
+                pending.append(index)
+
+    def finish(completed, index, row):
+        rows[index] = row
+        if store is not None:
+            store.put(keys[index], row)
+        if progress is not None:
+            progress(completed, len(pending))
+
+    if processes == 1 or not pending:
+        for completed, index in enumerate(pending, 1):
+            finish(completed, index, run_task(tasks[index]))
+        return rows
+
+    with multiprocessing.Pool(processes) as pool:
+        for completed, (index, row) in enumerate(
+                pool.imap_unordered(_run_indexed, ((index, tasks[index]) for index in pending)), 1):
+            finish(completed, index, row)
+    return rows
+
+
+def _score(row, sort_by):
+    """取排序指标，缺失或无效值以及发生强平、被提前终止的参数组视为最差"""
+    if row.get('liquidated') or row.get('pruned'):
+        return -math.inf
+    value = row.get(sort_by)
+    if isinstance(value, (int, float)) and not math.isnan(value):
+        return value
+    return -math.inf
+
+
+def successive_halving(strategy, data_config, candidates, processes=None, store=None,
+                       sort_by='total_pnl_percent', eta=3, min_fraction=0.1, stop_rules=None, journal_dir=None,
+                       progress=None):
+    """
+    逐轮淘汰搜索：先在区间开头较短的窗口上评估全部候选，每轮只保留前 1/eta 晋级到 eta 倍长的窗口，
+    最后一轮使用完整的 start_date..end_date 区间。窗口最短不小于完整区间的 min_fraction。
+    返回最后一轮（完整区间）的结果。
+    """
+    candidates = list(candidates)
+    start, end = data_config['start_date'], data_config['end_date']
+    rounds = min(math.ceil(math.log(len(candidates), eta)) if len(candidates) > 1 else 0,
+                 int(math.floor(math.log(1 / min_fraction, eta))))
+
+    for rung in range(rounds, -1, -1):
+        window = dict(data_config, end_date=start + (end - start) * eta ** -rung)
+        rows = run_tasks(make_tasks(strategy, window, candidates, stop_rules, journal_dir), processes, store,
+                         progress)
+        if rung == 0:
+            return rows
+        order = sorted(range(len(rows)), key=lambda i: _score(rows[i], sort_by), reverse=True)
+        candidates = [candidates[i] for i in order[:math.ceil(len(candidates) / eta)]]
+
+
+def _random_points(sizes, exclude, count, rng):
+    """从离散参数空间中随机抽取 count 个未评估过的点（每个点为各维候选值下标的元组）"""
+    total = math.prod(sizes)
+    if total <= 10000:
+        remaining = [point for point in itertools.product(*(range(size) for size in sizes)) if point not in exclude]
+        chosen = rng.choice(len(remaining), size=min(count, len(remaining)), replace=False)
+        return [remaining[i] for i in chosen]
+
+    points = []
+    while len(points) < count:
+        point = tuple(int(rng.integers(size)) for size in sizes)
+        if point not in exclude and point not in points:
+            points.append(point)
+    return points
+
+
+def _tpe_propose(observed, sizes, count, rng, gamma, n_ei_candidates):
+    """
+    TPE 建议：按得分把已评估点分为好/差两组，分别估计各维的离散分布 l(x)、g(x)，
+    从 l(x) 抽样并选择 l(x)/g(x) 最大的未评估点。
+    """
+    points = np.array(list(observed), dtype=np.intp).reshape(len(observed), len(sizes))
+    scores = np.array(list(observed.values()))
+    order = np.argsort(-scores, kind='stable')
+    n_good = max(1, int(math.ceil(gamma * len(points))))
+    good, bad = points[order[:n_good]], points[order[n_good:]]
+
+    # 加一平滑的各维离散分布
+    good_density = [(np.bincount(good[:, d], minlength=size) + 1) / (len(good) + size) for d, size in enumerate(sizes)]
+    bad_density = [(np.bincount(bad[:, d], minlength=size) + 1) / (len(bad) + size) for d, size in enumerate(sizes)]
+
+    proposals = []
+    for _ in range(count * 10):
+        if len(proposals) >= count:
+            break
+        samples = np.column_stack([rng.choice(size, size=n_ei_candidates, p=good_density[d])
+                                   for d, size in enumerate(sizes)])
+        ratio = sum(np.log(good_density[d][samples[:, d]]) - np.log(bad_density[d][samples[:, d]])
+                    for d in range(len(sizes)))
+        for i in np.argsort(-ratio):
+            point = tuple(int(v) for v in samples[i])
+            if point not in observed and point not in proposals:
+                proposals.append(point)
+                break
+
+    if len(proposals) < count:
+        proposals += _random_points(sizes, set(observed) | set(proposals), count - len(proposals), rng)
+    return proposals
+
+
+def tpe_search(strategy, data_config, strategy_grid=None, broker_grid=None, sizer_grid=None, n_trials=50,
+               processes=None, store=None, sort_by='total_pnl_percent', n_startup=None, gamma=0.25,
+               n_ei_candidates=24, seed=None, stop_rules=None, journal_dir=None, progress=None):
+    """
+    基于 TPE（Tree-structured Parzen Estimator）的自适应搜索。
+    先随机评估 n_startup 组参数，之后每批按 TPE 建议的参数并行评估，共评估 n_trials 组。
+    """
+    space = [(group, name, list(values))
+             for group, grid in (('strategy', strategy_grid), ('broker', broker_grid), ('sizer', sizer_grid))
+             for name, values in (grid or {}).items()]
+    sizes = [len(values) for _, _, values in space]
+    n_trials = min(n_trials, math.prod(sizes))
+    batch_size = processes or os.cpu_count() or 1
+    n_startup = n_startup or max(batch_size, 10)
+    rng = np.random.default_rng(seed)
+
+    def to_candidate(point):
+        params = {'strategy': {}, 'broker': {}, 'sizer': {}}
+        for (group, name, values), index in zip(space, point):
+            params[group][name] = values[index]
+        return params['strategy'], params['broker'], params['sizer']
+
+    observed = {}
+    rows = []
+    while len(observed) < n_trials:
+        count = min(batch_size, n_trials - len(observed))
+        if len(observed) < n_startup:
+            points = _random_points(sizes, observed, min(count, n_startup - len(observed)), rng)
+        else:
+            points = _tpe_propose(observed, sizes, count, rng, gamma, n_ei_candidates)
+        batch = run_tasks(make_tasks(strategy, data_config, [to_candidate(point) for point in points], stop_rules,
+                                     journal_dir), processes, store, progress)
+        for point, row in zip(points, batch):
+            observed[point] = _score(row, sort_by)
+        rows += batch
+    return rows
+
+
+@contextlib.contextmanager
+def shared_data(kline_file_path, start_date, end_date, compression=5, preresample=True, cache_dir=None,
+                intrabar=False):
+    """
+    主进程加载一次数据并发布到共享内存，产出供任务使用的数据配置；退出时释放共享内存。
+    kline_file_path 为文件路径列表时，各品种对齐后分别发布，shared 为 {交易对名称: 描述信息} 字典。
+    intrabar=True 时各任务按1分钟K线撮合订单（见 configure_data）。
+    """
+    minutes = compression if preresample else 1
+    if isinstance(kline_file_path, (str, os.PathLike)):
+        segments = load_kline_segments(kline_file_path, start_date, end_date, cache_dir, minutes)
+        if not segments:
+            raise ValueError("No data loaded. Please check the file path and date range.")
+        published = {None: share_kline_window(segments, minutes)}
+        del segments
+    else:
+        windows = load_kline_windows(kline_file_path, start_date, end_date, cache_dir, minutes)
+        published = {symbol: share_kline_window(window, minutes) for symbol, window in windows.items()}
+        del windows
+    shared = {symbol: descriptor for symbol, (_, descriptor) in published.items()}
+    data_config = dict(kline_file_path=kline_file_path, start_date=start_date, end_date=end_date,
+                       timeframe=bt.TimeFrame.Minutes, compression=compression, preresample=preresample,
+                       shared=shared.get(None, shared))
+    if intrabar:
+        # 工作进程从缓存另外读取1分钟K线；只在启用时加入配置，保持未启用时的任务哈希不变
+        data_config.update(intrabar=True, cache_dir=cache_dir)
+    try:
+        yield data_config
+    finally:
+        for shm, descriptor in published.values():
+            release_kline_window(descriptor)
+            shm.close()
+            shm.unlink()
+
+
+def run_optimization(kline_file_path, start_date, end_date, strategy=SystemOne, strategy_grid=None,
+                     broker_grid=None, sizer_grid=None, processes=None, sort_by='total_pnl_percent',
+                     compression=5, preresample=True, cache_dir=None, store_path=None,
+                     search='grid', n_trials=50, eta=3, min_fraction=0.1, seed=None, stop_rules=None,
+                     intrabar=False, journal_dir=None, progress=None):
+    """
+    并行扫描策略参数（如 deque_length、period、bins）和 Broker/Sizer 参数（如 leverage、slippage、percent），
+    返回按 sort_by 降序排列的结果表。
+    指定 store_path 时结果保存到该 SQLite 文件，重跑时已完成的参数组合直接读取。
+    search 可选 'grid'（全部组合）、'halving'（逐轮淘汰）、'tpe'（TPE 自适应搜索，共 n_trials 组）。
+    stop_rules 为 StopRules 的参数字典（如 dict(max_drawdown=30, no_trade_bars=2000)），
+    触发规则的参数组提前结束，结果中 pruned 记录触发的规则，保留截至终止时的指标并排在最后。
+    intrabar=True 时按1分钟K线撮合订单。
+    journal_dir 不为 None 时各任务的订单和交易明细写入该目录，结果中 journal 列为文件路径，
+    可用 analyzer.load_journals(results['journal']) 一次读取全部任务的明细。
+    progress 为可选的进度回调 progress(已完成数, 本批任务数)，见 run_tasks。
+    """
+    if journal_dir is not None:
+        os.makedirs(journal_dir, exist_ok=True)
+    store = ResultStore(store_path) if store_path else None
+    try:
+        with shared_data(kline_file_path, start_date, end_date, compression, preresample, cache_dir,
+                         intrabar) as data_config:
+            if search == 'grid':
+                rows = run_tasks(build_tasks(strategy, data_config, strategy_grid, broker_grid, sizer_grid,
+                                             stop_rules, journal_dir), processes, store, progress)
+            elif search == 'halving':
+                candidates = itertools.product(expand_grid(strategy_grid), expand_grid(broker_grid),
+                                               expand_grid(sizer_grid))
+                rows = successive_halving(strategy, data_config, candidates, processes, store, sort_by, eta,
+                                          min_fraction, stop_rules, journal_dir, progress)
+            elif search == 'tpe':
+                rows = tpe_search(strategy, data_config, strategy_grid, broker_grid, sizer_grid, n_trials,
+                                  processes, store, sort_by, seed=seed, stop_rules=stop_rules,
+                                  journal_dir=journal_dir, progress=progress)
+            else:
+                raise ValueError(f"Unknown search mode: {search}")
+    finally:
+        if store is not None:
+            store.close()
+    # 按 _score 排序，发生强平和指标缺失的参数组排在最后
+    order = sorted(range(len(rows)), key=lambda i: _score(rows[i], sort_by), reverse=True)
+    return pd.DataFrame([rows[i] for i in order])
+
+
+def walk_forward_folds(start_date, end_date, in_sample, out_of_sample, anchored=False):
+    """
+    划分前进分析的各折，返回 [(样本内开始, 样本外开始, 样本外结束)]，样本内区间为 [样本内开始, 样本外开始)。
+    anchored=True 时样本内始终从 start_date 开始（锚定），否则按样本外长度滚动。
+    """
+    folds = []
+    in_sample_start = start_date
+    out_of_sample_start = start_date + in_sample
+    while out_of_sample_start + out_of_sample <= end_date:
+        folds.append((in_sample_start, out_of_sample_start, out_of_sample_start + out_of_sample))
+        out_of_sample_start += out_of_sample
+        if not anchored:
+            in_sample_start += out_of_sample
+    return folds
+
+
+def walk_forward(kline_file_path, start_date, end_date, in_sample, out_of_sample, strategy=SystemOne,
+                 strategy_grid=None, broker_grid=None, sizer_grid=None, anchored=False, processes=None,
+                 sort_by='total_pnl_percent', compression=5, preresample=True, cache_dir=None, store_path=None,
+                 initial_cash=10000.0, stop_rules=None, intrabar=False, progress=None):
+    """
+    前进分析：每折在样本内区间网格优化，取 sort_by 最优的参数在随后的样本外区间验证。
+    所有折的样本内任务一次性提交到进程池并行运行，数据只发布一次。
+    stop_rules 只作用于样本内优化，样本外验证始终完整运行。progress 为可选的进度回调，见 run_tasks。
+    返回 (拼接后的样本外资金曲线 Series, 各折指标 DataFrame)。
+    """
+    folds = walk_forward_folds(start_date, end_date, in_sample, out_of_sample, anchored)
+    if not folds:
+        raise ValueError("Date range is too short for the requested in-sample/out-of-sample windows.")
+    candidates = list(itertools.product(expand_grid(strategy_grid), expand_grid(broker_grid),
+                                        expand_grid(sizer_grid)))
+    # 样本内区间不包含样本外开始时刻的K线
+    just_before = datetime.timedelta(microseconds=1)
+
+    store = ResultStore(store_path) if store_path else None
+    try:
+        with shared_data(kline_file_path, start_date, end_date, compression, preresample, cache_dir,
+                         intrabar) as data_config:
+            in_sample_tasks = []
+            for fold_start, fold_split, _ in folds:
+                window = dict(data_config, start_date=fold_start, end_date=fold_split - just_before)
+                in_sample_tasks += make_tasks(strategy, window, candidates, stop_rules)
+            in_sample_rows = run_tasks(in_sample_tasks, processes, store, progress)
+
+            best = []
+            out_of_sample_tasks = []
+            for i, (_, fold_split, fold_end) in enumerate(folds):
+                fold_rows = in_sample_rows[i * len(candidates):(i + 1) * len(candidates)]
+                index = max(range(len(candidates)), key=lambda j: _score(fold_rows[j], sort_by))
+                best.append((candidates[index], fold_rows[index]))
+                window = dict(data_config, start_date=fold_split, end_date=fold_end - just_before)
+                task = make_tasks(strategy, window, [candidates[index]])[0]
+                task['record_returns'] = True
+                out_of_sample_tasks.append(task)
+            out_of_sample_rows = run_tasks(out_of_sample_tasks, processes, store, progress)
+    finally:
+        if store is not None:
+            store.close()
+
+    # 拼接各折样本外日收益为资金曲线
+    returns = pd.concat([pd.Series(row.pop('returns'), dtype=float) for row in out_of_sample_rows])
+    returns.index = pd.to_datetime(returns.index)
+    equity = initial_cash * (1 + returns.sort_index()).cumprod()
+
+    fold_rows = []
+    for i, ((fold_start, fold_split, fold_end), (candidate, in_sample_row), out_of_sample_row) in enumerate(
+            zip(folds, best, out_of_sample_rows)):
+        row = dict(fold=i, in_sample_start=fold_start, out_of_sample_start=fold_split, out_of_sample_end=fold_end,
+                   in_sample_score=_score(in_sample_row, sort_by))
+        for params in candidate:
+            row.update(params)
+        row.update((key, value) for key, value in out_of_sample_row.items() if key not in row)
+        fold_rows.append(row)
+    return equity, pd.DataFrame(fold_rows)
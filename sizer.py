@@ -1,8 +1,19 @@
 import backtrader as bt
 
+
+def portfolio_margin(strategy, broker):
+    """
+    计算所有数据源当前持仓按最新收盘价占用的保证金总额（由各品种佣金方案的 get_margin 计算），
+    多品种组合回测时用于控制总仓位
+    """
+    return sum(broker.getcommissioninfo(data).get_margin(data.close[0]) * abs(broker.getposition(data).size)
+               for data in strategy.datas)
+
+
 class FixedPercentSizer(bt.Sizer):
     params = (
         ('percent', 0.1),  # 使用账户总权益的10%
+        ('max_total_percent', 1.0),  # 所有品种持仓占用的保证金合计不超过账户总权益的100%
         ('min_stake', 0.001),  # 最小仓位单位 0.001BTC
         ('min_leverage', 1),   # 最小杠杆
         ('max_leverage', 125), # 最大杠杆（币安的最大杠杆为125倍）
@@ -19,7 +30,7 @@ class FixedPercentSizer(bt.Sizer):
         total_value = self.broker.getvalue()
 
         # 获取杠杆并进行上下限控制
-        leverage = comminfo.get_leverage()
+        leverage = comminfo.p.leverage
         leverage = max(self.p.min_leverage, min(self.p.max_leverage, leverage))
 
         # 动态获取维持保证金率
@@ -28,6 +39,13 @@ class FixedPercentSizer(bt.Sizer):
         # 计算账户可以用来交易的总资金，并考虑维持保证金率
         stake_value = total_value * self.p.percent * leverage
         price = data.close[0]
+        if isbuy:
+            # 多品种组合时，新开仓后所有持仓占用的保证金不超过 max_total_percent
+            available = total_value * self.p.max_total_percent - portfolio_margin(self.strategy, self.broker)
+            if available <= 0:
+                return 0
+            # 剩余保证金按该品种单位保证金折算为名义价值
+            stake_value = min(stake_value, available * price / comminfo.get_margin(price))
 
         # 计算交易量
         stake = stake_value / price
@@ -62,7 +80,7 @@ class FixedSizeSizer(bt.Sizer):
         total_value = self.broker.getvalue()
 
         # 获取杠杆，并根据杠杆计算维持保证金率
-        leverage = comminfo.get_leverage()
+        leverage = comminfo.p.leverage
         margin_rate = comminfo.leverage_margin_map.get(leverage, 0.5)
 
         # 计算账户允许的最大持仓量
@@ -87,7 +105,7 @@ class FixedSizeSizer(bt.Sizer):
 
 
 # 配置 Sizer
-def configure_sizer(cerebro):
-    # 使用自定义的 Sizer
-    cerebro.addsizer(FixedPercentSizer)
+def configure_sizer(cerebro, **kwargs):
+    # 使用自定义的 Sizer，kwargs 透传给 Sizer 参数（如 percent）
+    cerebro.addsizer(FixedPercentSizer, **kwargs)
     # cerebro.addsizer(FixedSizeSizer)
\ No newline at end of file
@@ -6,15 +6,80 @@ import numpy as np
 import backtrader as bt
 from datetime import timedelta
 from collections import deque
+from numpy.lib.stride_tricks import sliding_window_view
+from logger import AsyncLogWriter
+
+
+class StopRules:
+    """
+    提前终止规则，任一条件满足时结束回测，参数优化时用于尽早淘汰明显无望的参数组。
+    为 None 的规则不检查。
+    """
+
+    def __init__(self, max_drawdown=None, min_value=None, no_trade_bars=None, liquidation=False, min_sqn=None,
+                 min_trades=30):
+        self.max_drawdown = max_drawdown  # 账户价值自最高点回撤超过该百分比
+        self.min_value = min_value  # 账户价值低于该金额
+        self.no_trade_bars = no_trade_bars  # 开始后这么多根K线内没有任何成交
+        self.liquidation = liquidation  # 发生强平
+        self.min_sqn = min_sqn  # 平仓交易达到 min_trades 笔后 SQN 低于该值（需要 TradingMetrics 或 FusedAnalyzer）
+        self.min_trades = min_trades
+        self.peak: float = .0
+
+    def start(self):
+        self.peak = .0
+
+    def check(self, strategy, value):
+        """
+        每根K线检查一次，返回触发的规则名称，未触发时返回 None
+        """
+        self.peak = max(self.peak, value)
+        if self.max_drawdown is not None and self.peak > 0 and \
+                (self.peak - value) / self.peak * 100 >= self.max_drawdown:
+            return 'max_drawdown'
+        if self.min_value is not None and value < self.min_value:
+            return 'min_value'
+        if self.no_trade_bars is not None and strategy.bar_executed is None and len(strategy) >= self.no_trade_bars:
+            return 'no_trade'
+        if self.liquidation and getattr(strategy.broker, 'liquidations', None):
+            return 'liquidation'
+        if self.min_sqn is not None:
+            metrics = getattr(strategy.analyzers, 'TradingMetrics', None) or getattr(strategy.analyzers, 'Metrics', None)
+            if metrics is not None and metrics.trade_count >= self.min_trades:
+                sqn = metrics.trading_analysis()['sqn']
+                if sqn is not None and sqn < self.min_sqn:
+                    return 'sqn'
+        return None
 
 
 class BaseStrategy(bt.Strategy):
+    params = (
+        ('stop_rules', None),  # StopRules，满足任一规则时提前结束回测
+        ('log_level', 'INFO'),  # 低于该级别的日志在格式化之前直接丢弃，None 关闭日志
+        ('log_file', None),  # 日志写入该 JSONL 文件，None 时输出到控制台
+    )
+    # next 中直接回看的K线根数（data.close[-1] 为2），exactbars 模式下数据源至少保留这么多根
+    lookback = 1
+
     def __init__(self):
         self.last_cash: float
         self.last_value: float
         self.order: str
         self.openprice: float
         self.opencomm: float
+        self.bar_executed: int | None = None  # 最近一次成交时的K线序号
+        self.pruned: str | None = None  # 被提前终止时触发的规则名称
+        # 日志写入器在构造时创建，子类 __init__ 中（start 之前）记录的日志留在队列中，start 启动写入线程后写出
+        self.logger = AsyncLogWriter(self.p.log_file, self.p.log_level)
+
+    def qbuffer(self, savemem=0, replaying=False):
+        """
+        启用 exactbars 内存节省时，行情线只保留指标所需的K线，这里额外保证策略自身回看所需的K线
+        """
+        super().qbuffer(savemem, replaying)
+        if savemem > 0:
+            for data in self.datas:
+                data.minbuffer(self.lookback)
 
     def start(self):
         """
@@ -22,8 +87,22 @@ class BaseStrategy(bt.Strategy):
         """
         self.last_cash = self.broker.get_cash()
         self.last_value = self.broker.get_value()
-        self.log(f'回测开始，初始资金: {self.last_cash:.2f} USDT | 初始总值: {self.last_value:.2f} USDT', level='START',
-                 doprint=True)
+        self.logger.start()
+        self.log_event('start', level='START', cash=self.last_cash, value=self.last_value)
+        if self.p.stop_rules is not None:
+            self.p.stop_rules.start()
+
+    def notify_cashvalue(self, cash, value):
+        """
+        每根K线检查提前终止规则，触发后请求 cerebro 结束回测，分析器保留截至当前的结果
+        """
+        if self.p.stop_rules is None or self.pruned is not None:
+            return
+        reason = self.p.stop_rules.check(self, value)
+        if reason is not None:
+            self.pruned = reason
+            self.log_event('pruned', level='WARNING', reason=reason, value=value)
+            self.env.runstop()
 
     def stop(self):
         """
@@ -32,20 +111,36 @@ class BaseStrategy(bt.Strategy):
         final_cash = self.broker.get_cash()
         final_value = self.broker.get_value()
         overall_return = (final_value - self.last_value) / self.last_value * 100
-        current_position_size = self.broker.getposition(self.data).size
+        self.log_event('stop', cash=final_cash, value=final_value, return_pct=overall_return,
+                       positions={data._name: self.getposition(data).size for data in self.datas})
+        # 等待后台线程写完全部日志
+        self.logger.close()
 
-        self.log(
-            f'策略执行结束 | 最终现金: {final_cash:.4f} USDT | 最终账户总值: {final_value:.4f} | 当前持仓: {current_position_size:.4f} BTC | 总收益率: {overall_return:.2f}%',
-            level='INFO')
+    def log_time(self):
+        """
+        日志时间（backtrader 日期数值），尚未开始推进或 exactbars 模式下缓冲区已清空时为 None
+        """
+        return self.datas[0].datetime[0] if len(self) and self.datas[0].datetime.buflen() else None
 
     def log(self, message, level='INFO', doprint=True):
         """
-        日志记录，支持不同级别的日志和时间戳
+        文本日志，低于 log_level 的日志直接丢弃；格式化和输出在后台线程中完成
+        """
+        if doprint and self.logger.enabled(level):
+            self.logger.emit(level, self.log_time(), 'message', {'message': message})
+
+    def log_event(self, event, level='INFO', **fields):
+        """
+        结构化日志：事件名称加字段，控制台输出时按 logger.MESSAGES 中的模板格式化
         """
-        dt = self.datas[0].datetime.datetime(0) if len(self.data) else None
-        formatted_message = f'[{level}] - {dt.strftime("%Y-%m-%d %H:%M:%S") if dt else ""} - {message}'
-        if doprint:
-            print(formatted_message)
+        if self.logger.enabled(level):
+            self.logger.emit(level, self.log_time(), event, fields)
+
+    def data_name(self, data):
+        """
+        多品种回测时返回数据源名称作为日志前缀，单品种时为 None
+        """
+        return data._name if len(self.datas) > 1 else None
 
     def log_order(self, order):
         """
@@ -62,19 +157,18 @@ class BaseStrategy(bt.Strategy):
 
         if order.status in [order.Completed]:
             if order.isbuy():
-                self.log(
-                    f'开仓，价格: {order.executed.price:.2f} USDT，成本: {order.executed.value:.3f} USDT，佣金费用: {order.executed.comm:.4f} USDT，成交量: {order.executed.size:.4f} BTC')
                 self.buyprice = order.executed.price
                 self.commprice = order.executed.comm
-
-            elif order.issell():
-                self.log(
-                    f'平仓，价格: {order.executed.price:.2f} USDT，成本: {order.executed.value:.3f} USDT，佣金费用: {order.executed.comm:.4f} USDT，成交量: {order.executed.size:.4f} BTC')
+            # 先判断级别，日志关闭时不构造任何字段
+            if self.logger.enabled('INFO'):
+                self.logger.emit('INFO', self.log_time(), 'buy' if order.isbuy() else 'sell', dict(
+                    data=self.data_name(order.data), price=order.executed.price, value=order.executed.value,
+                    comm=order.executed.comm, size=order.executed.size))
 
             self.bar_executed = len(self)
 
         elif order.status in [order.Canceled, order.Margin, order.Rejected]:
-            self.log(f'订单被取消/保证金不足/拒绝，原因: {order.getstatusname()}', level='WARNING')
+            self.log_event('order', level='WARNING', status=order.getstatusname())
 
         # 清空订单
         self.order = None
@@ -83,9 +177,10 @@ class BaseStrategy(bt.Strategy):
         """
         交易完成通知
         """
-        if not trade.isclosed:
+        if not trade.isclosed or not self.logger.enabled('INFO'):
             return
-        self.log(f'交易平仓 | 盈亏: {trade.pnl:.2f} USDT | 净盈亏（含佣金）: {trade.pnlcomm:.2f} USDT')
+        self.logger.emit('INFO', self.log_time(), 'trade',
+                         dict(data=self.data_name(trade.data), pnl=trade.pnl, pnlcomm=trade.pnlcomm))
 
 
 def fibonacci_extension_custom(low, mid, multiple):
@@ -95,6 +190,48 @@ def fibonacci_extension_custom(low, mid, multiple):
     return fib_custom
 
 
+class FeatureRingBuffer:
+    """
+    预分配的 NumPy 环形缓冲区，按行存储多个特征，追加为 O(1)。
+    每个值同时写入 i 和 i+capacity 两个位置，最近 n 根数据总是一段连续切片，读取窗口不复制数据。
+    """
+
+    def __init__(self, fields, capacity, dtype=np.float64):
+        self.fields = tuple(fields)
+        self.capacity = capacity
+        self._rows = {name: i for i, name in enumerate(self.fields)}
+        self._buffer = np.zeros((len(self.fields), 2 * capacity), dtype=dtype)
+        self._head = 0  # 下一次写入的位置
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, *values):
+        """按 fields 的顺序追加一根K线的全部特征"""
+        head = self._head
+        self._buffer[:, head] = values
+        self._buffer[:, head + self.capacity] = values
+        self._head = head + 1 if head + 1 < self.capacity else 0
+        self._count += 1
+
+    def window(self, field=None, size=None):
+        """
+        返回最近 size 根（默认全部已有数据）的只读视图，时间从旧到新。
+        指定 field 时返回该特征的一维视图，否则返回 (特征数, size) 的二维视图。
+        """
+        size = len(self) if size is None else min(size, len(self))
+        end = self._head + self.capacity
+        view = self._buffer[:, end - size:end] if field is None else self._buffer[self._rows[field], end - size:end]
+        view = view.view()
+        view.flags.writeable = False
+        return view
+
+    def latest(self, field, ago=0):
+        """读取 ago 根之前的某个特征值，ago=0 为最新一根"""
+        return self._buffer[self._rows[field], self._head + self.capacity - 1 - ago]
+
+
 class SystemOne(BaseStrategy):
     """
     系统一在小级别时间框架下运行，主要目的是：
@@ -104,35 +241,40 @@ class SystemOne(BaseStrategy):
     params = (
         ('deque_length', 15),
     )
+    lookback = 2
 
     def __init__(self):
         super().__init__()
-        self.body = deque(maxlen=self.p.deque_length)  # 实体长度
-        self.uppershadow = deque(maxlen=self.p.deque_length)  # 上影线长度
-        self.lowershadow = deque(maxlen=self.p.deque_length)  # 下影线长度
-        self.direction = deque(maxlen=self.p.deque_length)  # Bar的涨跌方向
-        self.bar_type = deque(maxlen=self.p.deque_length)  # 柱体的类型
-        self.volume = deque(maxlen=self.p.deque_length)  # 交易量
-        self.range = deque(maxlen=self.p.deque_length)  # 价格波动范围
+        # 每个数据源各自维护：实体长度、上影线长度、下影线长度、Bar的涨跌方向、交易量、价格波动范围
+        self.features = [
+            FeatureRingBuffer(('body', 'uppershadow', 'lowershadow', 'direction', 'volume', 'range'),
+                              self.p.deque_length)
+            for _ in self.datas
+        ]
         self.low_price: float = .0  # 底部价格
         self.mid_price: float = .0  # 中部价格
 
     def next(self):
+        # 多品种组合回测时逐个数据源独立判断信号
+        for features, data in zip(self.features, self.datas):
+            self.next_data(data, features)
+
+    def next_data(self, data, features):
         # 获取当前的价格数据
-        open_ = self.datas[0].open[0]
-        close = self.datas[0].close[0]
-        high = self.datas[0].high[0]
-        low = self.datas[0].low[0]
-        vol = self.datas[0].volume[0]
+        open_ = data.open[0]
+        close = data.close[0]
+        high = data.high[0]
+        low = data.low[0]
+        vol = data.volume[0]
         range = high - low
 
         # 获取前一个Bar数据
-        if len(self) > 1:
-            prev_open = self.datas[0].open[-1]
-            prev_close = self.datas[0].close[-1]
-            prev_high = self.datas[0].high[-1]
-            prev_low = self.datas[0].low[-1]
-            prev_vol = self.datas[0].volume[-1]
+        if len(data) > 1:
+            prev_open = data.open[-1]
+            prev_close = data.close[-1]
+            prev_high = data.high[-1]
+            prev_low = data.low[-1]
+            prev_vol = data.volume[-1]
         else:
             return  # 确保有足够的历史数据
 
@@ -149,15 +291,10 @@ class SystemOne(BaseStrategy):
         else:
             direction = -1
 
-        # 更新deque数据
-        self.body.append(body_length)
-        self.uppershadow.append(upper_shadow)
-        self.lowershadow.append(lower_shadow)
-        self.direction.append(direction)
-        self.volume.append(vol)
-        self.range.append(range)
+        # 更新特征缓冲区
+        features.append(body_length, upper_shadow, lower_shadow, direction, vol, range)
 
-        if self.position:
+        if self.getposition(data):
             return
 
         # 判断是否是两根连续的上涨 Bar，且成交量放大
@@ -171,8 +308,13 @@ class SystemOne(BaseStrategy):
             # 根据斐波那契回撤计算盈亏比的止盈价格
             fib_x = fibonacci_extension_custom(prev_low, buy_price, 1.5)
 
+            # 资金不足（如强平后）时 Sizer 返回0，不下单
+            if not self.getsizing(data, isbuy=True):
+                return
+
             # 使用Bracket Order一次性创建订单
             self.order = self.buy_bracket(
+                data=data,
                 price=buy_price,  # 买入触发价格
                 exectype=bt.Order.Stop,
                 valid=timedelta(minutes=5),
@@ -186,6 +328,46 @@ class SystemOne(BaseStrategy):
             )
 
 
+def scan_system_one(columns):
+    """
+    系统一的向量化预扫描：一次性计算整段K线的特征和入场候选，不经过事件循环。
+    columns 为 {列名: 数组} 字典（open/high/low/close/volume，如 load_kline_window 的返回值）。
+    signal 与 SystemOne.next 的入场条件逐根一致（不考虑持仓状态），
+    triggered 按下一根K线最高价估计止损买单是否会成交，可用于在完整回测前快速筛选。
+    """
+    open_ = np.asarray(columns['open'], dtype=np.float64)
+    high = np.asarray(columns['high'], dtype=np.float64)
+    low = np.asarray(columns['low'], dtype=np.float64)
+    close = np.asarray(columns['close'], dtype=np.float64)
+    volume = np.asarray(columns['volume'], dtype=np.float64)
+
+    # K线特征，与 SystemOne.next 的计算方式一致
+    features = dict(
+        body=np.abs(open_ - close),
+        uppershadow=high - np.maximum(open_, close),
+        lowershadow=np.minimum(open_, close) - low,
+        direction=np.sign(open_ - close).astype(np.int8),
+        range=high - low,
+    )
+
+    # 两根连续的上涨 Bar，且成交量放大（第一根Bar没有前值，不产生信号）
+    up = close > open_
+    signal = np.zeros(len(close), dtype=bool)
+    signal[1:] = up[1:] & up[:-1] & (volume[1:] > volume[:-1])
+
+    prev_low = np.r_[np.nan, low[:-1]]
+    buy_price = high + 0.1
+    stop_price = 0.9 * prev_low
+    take_profit = fibonacci_extension_custom(prev_low, buy_price, 1.5)
+
+    triggered = np.zeros(len(close), dtype=bool)
+    triggered[:-1] = signal[:-1] & (high[1:] >= buy_price[:-1])
+
+    features.update(signal=signal, triggered=triggered, buy_price=buy_price, stop_price=stop_price,
+                    take_profit=take_profit)
+    return features
+
+
 class SystemTwo(SystemOne):
     """
     系统二，主要目的是：
@@ -201,65 +383,183 @@ class SystemTwo(SystemOne):
         super().next()
 
 
+class WindowIndicator(bt.Indicator):
+    """
+    滑动窗口指标基类：子类声明一条指标线并实现 compute(windows)，输入 (行数, period) 的窗口矩阵，返回每行的指标值。
+    runonce 模式下 once() 在底层数据数组上构造滑动窗口视图分块批量计算，逐根模式下 next() 用同一函数计算单个窗口。
+    """
+    params = dict(
+        period=14,  # 窗口长度
+    )
+    source = 'close'  # 计算所用的数据线
+    chunk_size = 2 ** 20  # 每块窗口矩阵的最大元素数，限制临时内存
+
+    def __init__(self):
+        self.addminperiod(self.p.period)
+
+    def compute(self, windows):
+        raise NotImplementedError
+
+    def next(self):
+        window = np.array(getattr(self.data, self.source).get(size=self.p.period), dtype=np.float64)
+        self.lines[0][0] = self.compute(window[None, :])[0]
+
+    def once(self, start, end):
+        period = self.p.period
+        values = np.frombuffer(getattr(self.data, self.source).array, dtype=np.float64)
+        # 指标线的 array.array 已按数据长度预分配，直接以 NumPy 视图写入
+        dst = np.frombuffer(self.lines[0].array, dtype=np.float64)
+        step = max(1, self.chunk_size // period)
+        for chunk_start in range(start, end, step):
+            chunk_end = min(chunk_start + step, end)
+            windows = sliding_window_view(values[chunk_start - period + 1:chunk_end], period)
+            dst[chunk_start:chunk_end] = self.compute(windows)
+
+
 # 定义价格密集区指标
-class PriceCluster(bt.Indicator):
+class PriceCluster(WindowIndicator):
+    """
+    价格密集区指标：统计过去 period 根收盘价的直方图，取频数最高区间的中心价格。
+    逐根模式下增量维护各区间计数（窗口最高/最低价不变时只移入/移出一个值，变化时才重新分箱），
+    批量模式（runonce）下由 WindowIndicator 在滑动窗口视图上向量化计算，结果与 np.histogram 逐根计算完全一致。
+    """
     lines = ('cluster', )
     params = dict(
         period=100,  # 统计过去多少根K线的数据
         bins=20      # 将价格划分为多少个区间
     )
 
-    def __init__(self):
-        self.addminperiod(self.p.period)
+    def compute(self, windows):
+        return cluster_prices(windows, self.p.bins)
 
-    def next(self):
-        # 获取过去period周期内的收盘价
+    def nextstart(self):
+        # 首个完整窗口：初始化滑动窗口、单调队列和直方图
         prices = self.data.close.get(size=self.p.period)
-        # 如果数据不足，跳过
-        if len(prices) < self.p.period:
-            return
-        # 计算价格直方图
-        hist, bin_edges = np.histogram(prices, bins=self.p.bins)
-        # 找到出现频率最高的价格区间
-        max_bin_index = np.argmax(hist)
-        # 计算密集区的中心价格
-        cluster_price = (bin_edges[max_bin_index] + bin_edges[max_bin_index + 1]) / 2
-        # 将结果赋值给指标线
-        self.lines.cluster[0] = cluster_price
+        self._window = deque(prices, maxlen=self.p.period)
+        self._bar = self.p.period - 1
+        self._mins = deque()  # 单调递增队列 (序号, 价格)，队首为窗口最低价
+        self._maxs = deque()  # 单调递减队列 (序号, 价格)，队首为窗口最高价
+        for i, price in enumerate(prices):
+            self._push_extremes(i, price)
+        self._rebin()
+        self.lines.cluster[0] = self._cluster_price()
+
+    def next(self):
+        price = self.data.close[0]
+        leaving = self._window[0]
+        self._window.append(price)
+        self._bar += 1
+        self._push_extremes(self._bar, price)
+
+        if (self._mins[0][1], self._maxs[0][1]) != self._range:
+            # 窗口最高/最低价变化，分箱边界改变，重新分箱
+            self._rebin()
+        else:
+            self._counts[self._bin_index(leaving)] -= 1
+            self._counts[self._bin_index(price)] += 1
+        self.lines.cluster[0] = self._cluster_price()
+
+    def _push_extremes(self, index, price):
+        mins, maxs = self._mins, self._maxs
+        while mins and mins[-1][1] >= price:
+            mins.pop()
+        mins.append((index, price))
+        while maxs and maxs[-1][1] <= price:
+            maxs.pop()
+        maxs.append((index, price))
+        # 移除已滑出窗口的极值
+        oldest = index - self.p.period
+        if mins[0][0] <= oldest:
+            mins.popleft()
+        if maxs[0][0] <= oldest:
+            maxs.popleft()
+
+    def _rebin(self):
+        hist, bin_edges = np.histogram(np.fromiter(self._window, dtype=np.float64), bins=self.p.bins)
+        self._counts = hist.tolist()
+        self._edges = bin_edges.tolist()
+        self._range = (self._mins[0][1], self._maxs[0][1])
+
+    def _bin_index(self, price):
+        # 与 np.histogram 等宽分箱的下标计算方式一致（最后一个区间包含右边界）
+        edges, bins = self._edges, self.p.bins
+        index = int((price - edges[0]) / (edges[-1] - edges[0]) * bins)
+        if index == bins:
+            index -= 1
+        if price < edges[index]:
+            index -= 1
+        if price >= edges[index + 1] and index != bins - 1:
+            index += 1
+        return index
+
+    def _cluster_price(self):
+        # 找到出现频率最高的价格区间，计算密集区的中心价格
+        max_bin_index = self._counts.index(max(self._counts))
+        return (self._edges[max_bin_index] + self._edges[max_bin_index + 1]) / 2
+
+
+def cluster_prices(windows, bins):
+    """
+    对二维窗口矩阵（每行一个窗口）逐行计算价格密集区中心价格，与逐行调用 np.histogram 的结果一致。
+    """
+    rows = len(windows)
+    first = windows.min(axis=1)
+    last = windows.max(axis=1)
+    # 最高价等于最低价时扩展区间，避免除零
+    flat = first == last
+    first = np.where(flat, first - 0.5, first)
+    last = np.where(flat, last + 0.5, last)
+    edges = np.linspace(first, last, bins + 1, axis=1)
+
+    indices = (((windows - first[:, None]) / (last - first)[:, None]) * bins).astype(np.intp)
+    indices[indices == bins] -= 1
+    indices -= windows < np.take_along_axis(edges, indices, axis=1)
+    indices += (windows >= np.take_along_axis(edges, indices + 1, axis=1)) & (indices != bins - 1)
+
+    counts = np.bincount((indices + np.arange(rows)[:, None] * bins).ravel(), minlength=rows * bins)
+    max_bin_index = counts.reshape(rows, bins).argmax(axis=1)
+    row = np.arange(rows)
+    return (edges[row, max_bin_index] + edges[row, max_bin_index + 1]) / 2
+
 
 # 定义策略，使用价格密集区指标
-class PriceClusterStrategy(bt.Strategy):
+class PriceClusterStrategy(BaseStrategy):
     params = dict(
         period=100,
         bins=20
     )
 
     def __init__(self):
-        self.cluster_indicator = PriceCluster(
-            period=self.p.period,
-            bins=self.p.bins
-        )
-        self.dataclose = self.data.close
+        super().__init__()
+        # 每个数据源各自计算价格密集区
+        self.cluster_indicators = [
+            PriceCluster(data, period=self.p.period, bins=self.p.bins)
+            for data in self.datas
+        ]
 
     def next(self):
-        cluster_price = self.cluster_indicator.cluster[0]
+        for cluster_indicator, data in zip(self.cluster_indicators, self.datas):
+            self.next_data(data, cluster_indicator)
+
+    def next_data(self, data, cluster_indicator):
+        cluster_price = cluster_indicator.cluster[0]
         # 检查指标是否有有效值
-        if self.position:
+        if self.getposition(data):
             return
 
         if not np.isnan(cluster_price):
-            if not self.position:
-                if self.dataclose[0] < cluster_price:
+            if not self.getposition(data):
+                if data.close[0] < cluster_price:
                     self.buy(
+                        data=data,
                         exectype=bt.Order.Stop,
                         valid=timedelta(minutes=5),
                     )
 
             else:
-                if self.dataclose[0] > cluster_price:
+                if data.close[0] > cluster_price:
                     self.sell(
+                        data=data,
                         exectype=bt.Order.Stop,
                         valid=timedelta(minutes=5),
                     )
-
-
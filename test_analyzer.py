@@ -0,0 +1,75 @@
+"""
+分析器和权益观察者的检查：exactbars 流式回测时按日采样的结果与逐K线结果在每天最后一根K线上一致；
+订单和交易日志在各文件格式下读写一致
+"""
+import numpy as np
+import pytest
+import backtrader as bt
+from benchmark import _AlternatingTrader, synthetic_klines
+from broker import configure_broker
+from sizer import configure_sizer
+from data_loader import NumpyData
+from analyzer import add_analyzers, collect_analysis, load_journal, write_journal
+from metrics import DAY_MS, configure_equity_observer, equity_arrays
+
+BARS = 3 * 1440 + 300  # 最后一天不完整
+
+
+def _run(fused, exactbars, journal_path=None):
+    cerebro = bt.Cerebro(stdstats=False, preload=not exactbars, exactbars=exactbars)
+    cerebro.adddata(NumpyData(dataname=synthetic_klines(bars=BARS, seed=4)))
+    cerebro.addstrategy(_AlternatingTrader, hold=100)
+    configure_broker(cerebro)
+    configure_sizer(cerebro)
+    add_analyzers(cerebro, journal_path=journal_path, fused=fused)
+    if not fused:
+        # AnnualReturn 分析器依赖 Broker 观察者
+        cerebro.addobserver(bt.observers.Broker)
+    configure_equity_observer(cerebro)
+    return cerebro.run()[0]
+
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_streaming_samples_leverage_and_equity_daily(fused):
+    full = _run(fused, exactbars=0)
+    streaming = _run(fused, exactbars=1)
+
+    leverage = collect_analysis(full)['GrossLeverage']
+    daily = collect_analysis(streaming)['GrossLeverage']
+    assert len(leverage) == BARS
+    last_of_day = {}
+    for dt, value in leverage.items():
+        last_of_day[dt.date()] = value
+    assert list(daily.keys()) == list(last_of_day.keys())
+    np.testing.assert_allclose(list(daily.values()), list(last_of_day.values()))
+
+    bars = equity_arrays(full)
+    days = equity_arrays(streaming)
+    assert len(bars['ts']) == BARS and len(days['ts']) == 4
+    day_end = np.flatnonzero(np.r_[np.diff(bars['ts'] // DAY_MS) != 0, True])
+    for name in bars:
+        np.testing.assert_array_equal(days[name], bars[name][day_end], err_msg=name)
+
+
+@pytest.mark.parametrize('suffix', ['.npz', '.parquet', '.arrow'])
+def test_journal_round_trip(tmp_path, suffix):
+    if suffix != '.npz':
+        pytest.importorskip('pyarrow')
+    strat = _run(fused=True, exactbars=0, journal_path=str(tmp_path / f'run{suffix}'))
+    journal = strat.analyzers.Journal.get_analysis()
+    orders, trades = journal['orders'], journal['trades']
+    assert len(orders['ts']) and len(trades['ts_open'])
+
+    tables = load_journal(str(tmp_path / f'run{suffix}'))
+    np.testing.assert_array_equal(tables['orders']['executed_price'], orders['executed_price'])
+    np.testing.assert_array_equal(tables['trades']['pnlcomm'], trades['pnlcomm'])
+    np.testing.assert_array_equal(tables['orders']['ts'].to_numpy().astype('datetime64[ms]').astype(np.int64), orders['ts'])
+    assert (tables['orders']['data'] == journal['data_names'][0]).all()
+    assert set(tables['orders']['status']) <= set(bt.Order.Status)
+
+    # 不属于策略的数据源编码为 -1，读取后为空值
+    orders = dict(orders, data=np.r_[np.int16(-1), orders['data'][1:]])
+    path = str(tmp_path / f'unknown{suffix}')
+    write_journal(path, orders, trades, journal['data_names'])
+    data = load_journal(path)['orders']['data']
+    assert data.isna().tolist() == [True] + [False] * (len(data) - 1)
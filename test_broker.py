@@ -0,0 +1,179 @@
+"""
+FuturesBroker 的检查：在手工构造的K线上开仓、移动价格，核对账户价值、资金费、利息和强平
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import backtrader as bt
+from analyzer import add_analyzers, collect_analysis
+from broker import configure_broker
+from data_loader import NumpyData
+
+START = np.datetime64('2024-01-01', 'ns').astype(np.int64)
+
+
+def _feed(close, open_=None, high=None, low=None, minutes=1):
+    """每根K线间隔 minutes 分钟，开高低默认等于收盘价"""
+    close = np.asarray(close, dtype=np.float64)
+    open_ = close if open_ is None else np.asarray(open_, dtype=np.float64)
+    high = np.maximum(open_, close) if high is None else np.asarray(high, dtype=np.float64)
+    low = np.minimum(open_, close) if low is None else np.asarray(low, dtype=np.float64)
+    return NumpyData(dataname={
+        'datetime': START + np.arange(len(close), dtype=np.int64) * minutes * 60 * 10 ** 9,
+        'open': open_, 'high': high, 'low': low, 'close': close, 'volume': np.ones(len(close)),
+    }, timeframe=bt.TimeFrame.Minutes, compression=minutes)
+
+
+class _Scripted(bt.Strategy):
+    """在第一根K线按 size 下市价单（正数买入，负数卖出），记录每根K线结束时的现金和账户价值"""
+    params = dict(size=1)
+
+    def __init__(self):
+        self.values = []
+        self.cash = []
+        self.orders = []
+
+    def notify_order(self, order):
+        if order.status in (order.Completed, order.Canceled):
+            self.orders.append(order)
+
+    def next(self):
+        if len(self) == 1:
+            if self.p.size > 0:
+                self.buy(size=self.p.size)
+            else:
+                self.sell(size=-self.p.size)
+        self.values.append(self.broker.getvalue())
+        self.cash.append(self.broker.getcash())
+
+
+def _run(feed, strategy=_Scripted, **params):
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(feed)
+    cerebro.addstrategy(strategy, **params.pop('strategy_params', {}))
+    configure_broker(cerebro, **{'slippage': 0, **params})
+    return cerebro.run()[0]
+
+
+@pytest.mark.parametrize('leverage', [1, 10])
+@pytest.mark.parametrize('size, close', [(1, 200.0), (-1, 50.0)])
+def test_value_counts_price_move_once(leverage, size, close):
+    strat = _run(_feed([100, 100, close]), leverage=leverage, liquidation=False,
+                 strategy_params=dict(size=size))
+    comminfo = strat.broker.getcommissioninfo(strat.data)
+    position = strat.broker.getposition(strat.data)
+    assert position.size == size and position.price == 100
+    commission = 100 * comminfo.p.maker_commission
+    pnl = size * (close - 100)
+    # 账户价值 = 现金 + 按开仓均价占用的保证金；现金已逐根计入浮动盈亏
+    margin = comminfo.get_margin(100) * abs(size)
+    assert strat.values[-1] == pytest.approx(strat.cash[-1] + margin)
+    assert strat.values[-1] == pytest.approx(10000 - commission + pnl)
+
+
+HOURLY = [100.0] * 30  # 2024-01-01 00:00 至 01-02 05:00 的1小时K线，01:00 开仓后经过 08、16、00 点三次结算
+
+
+@pytest.mark.parametrize('size', [1, -1])
+def test_funding_sign_and_schedule_after_series_ends(size):
+    # 资金费率数据只到 01-01 16:00，之后按8小时间隔继续结算，没有费率的结算只计息
+    rates = pd.Series([0.001, -0.0005], index=pd.to_datetime(['2024-01-01 08:00', '2024-01-01 16:00']))
+    strat = _run(_feed(HOURLY, minutes=60), funding_rates=rates, strategy_params=dict(size=size))
+    broker = strat.broker
+    assert broker.settlements == 3
+    # 费率为正时多头支付、空头收取
+    assert broker.funding_paid == pytest.approx(size * 100 * (0.001 - 0.0005))
+    assert broker.interest_paid == 0
+    commission = 100 * broker.getcommissioninfo(strat.data).p.maker_commission
+    assert broker.getcash() + broker.getcommissioninfo(strat.data).get_margin(100) == pytest.approx(
+        10000 - commission - broker.funding_paid)
+
+
+@pytest.mark.parametrize('size, interest_long, charged', [(-1, False, True), (1, False, False), (1, True, True)])
+def test_interest_accrues_only_when_configured(size, interest_long, charged):
+    assert _run(_feed(HOURLY, minutes=60), strategy_params=dict(size=size)).broker.interest_paid == 0
+    strat = _run(_feed(HOURLY, minutes=60), interest=0.1, interest_long=interest_long,
+                 strategy_params=dict(size=size))
+    # 年化利率按365天折算，三次结算共计提一天的利息
+    expected = 100 * 0.1 / 365 if charged else 0
+    assert strat.broker.settlements == 3
+    assert strat.broker.interest_paid == pytest.approx(expected)
+
+
+SIZE = 1000  # 10倍杠杆下名义价值 100000，占用保证金 5000，维持保证金落在 0.5% 档（速算扣除数 50）
+
+
+def _liquidation_price(comminfo, size=SIZE):
+    """按100开多 size 后账户权益为 10000 减去开仓佣金，强平时权益恰好等于维持保证金"""
+    equity = 10000 - size * 100 * comminfo.p.maker_commission
+    return (size * 100 - equity - 50) / (size * (1 - 0.005))
+
+
+def _crash(open_, low, bars_after=5):
+    """第0根K线下单、第1根按100开仓，第2根最低91未触及强平价，第3根按 open_ 开盘、最低 low"""
+    opens = [100, 100, 100, open_] + [low] * bars_after
+    closes = [100, 100, 95, low] + [low] * bars_after
+    lows = [100, 100, 91, low] + [low] * bars_after
+    return _feed(closes, open_=opens, high=np.maximum(opens, closes), low=lows)
+
+
+def test_liquidation_at_liquidation_price():
+    strat = _run(_crash(open_=95, low=85), strategy_params=dict(size=SIZE))
+    broker = strat.broker
+    expected = _liquidation_price(broker.getcommissioninfo(strat.data))
+    assert 91 > expected > 85
+    assert len(broker.liquidations) == 1
+    assert broker.liquidations[0]['size'] == SIZE
+    assert broker.liquidations[0]['price'] == pytest.approx(expected)
+    assert not broker.getposition(strat.data)
+    # 按强平价格平仓后剩余的权益约为维持保证金减去平仓佣金
+    maintenance = SIZE * expected * 0.005 - 50
+    assert strat.values[3] == pytest.approx(maintenance - SIZE * expected * 0.0002)
+
+
+@pytest.mark.parametrize('fused, exactbars', [(True, 0), (False, 0), (False, 1)])
+def test_gap_fills_at_open_and_floors_equity(fused, exactbars):
+    # 跳空开盘价 80 低于强平价格，按开盘价平仓，亏损超过账户权益，权益归零后分析器不应除以0
+    cerebro = bt.Cerebro(stdstats=False, preload=not exactbars, exactbars=exactbars)
+    cerebro.adddata(_crash(open_=80, low=79))
+    cerebro.addstrategy(_Scripted, size=SIZE)
+    configure_broker(cerebro, slippage=0)
+    add_analyzers(cerebro, fused=fused)
+    if not fused:
+        cerebro.addobserver(bt.observers.Broker)
+    strat = cerebro.run()[0]
+
+    assert strat.broker.liquidations[0]['price'] == 80
+    assert strat.values[3:] == [0.0] * 6
+    leverage = list(collect_analysis(strat)['GrossLeverage'].values())
+    assert leverage[-1] == 0.0
+
+
+class _Bracket(_Scripted):
+    def next(self):
+        if len(self) == 1:
+            self.buy_bracket(size=self.p.size, exectype=bt.Order.Market, stopprice=50, limitprice=150)
+        self.values.append(self.broker.getvalue())
+
+
+def test_liquidation_cancels_bracket_children():
+    # backtrader 检查括号单资金时把止盈止损子单也按开仓计算保证金，600 的三条腿共占用 9000
+    strat = _run(_crash(open_=95, low=80), strategy=_Bracket, strategy_params=dict(size=600))
+    assert len(strat.broker.liquidations) == 1
+    main, *rest = strat.orders
+    assert main.status == main.Completed and main.isbuy()
+    children = [order for order in rest if order.status == order.Canceled]
+    liquidation = [order for order in rest if order.status == order.Completed]
+    # 止损和止盈子单都被撤销，强平单按强平价格卖出
+    assert sorted(order.exectype for order in children) == sorted([bt.Order.Stop, bt.Order.Limit])
+    assert len(liquidation) == 1 and liquidation[0].info.liquidation
+    assert liquidation[0].executed.price == pytest.approx(_liquidation_price(strat.broker.getcommissioninfo(strat.data), 600))
+    assert not strat.broker.pending
+
+
+@pytest.mark.parametrize('stop', [False, True])
+def test_stop_on_liquidation(stop):
+    strat = _run(_crash(open_=95, low=85), stop_on_liquidation=stop, strategy_params=dict(size=SIZE))
+    assert len(strat.broker.liquidations) == 1
+    # 策略收到强平K线的通知后，下一根K线开始前结束回测
+    assert len(strat.values) == (4 if stop else 9)
@@ -0,0 +1,161 @@
+"""
+预聚合K线与 cerebro.resampledata 的一致性检查：对同一份1分钟K线，逐根比较两种方式得到的目标周期K线；
+多品种K线的对齐；共享内存K线数据在主进程与工作进程之间的挂载和释放
+"""
+import datetime
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import backtrader as bt
+from benchmark import synthetic_klines
+from data_loader import IntrabarIndex, align_kline_windows, configure_data, load_kline_segments, load_kline_windows
+
+# build_resampled_cache 支持的周期（能整除一天的分钟数）
+PERIODS = (5, 15, 60, 240, 1440)
+WINDOWS = (
+    (datetime.datetime(2023, 12, 30), datetime.datetime(2024, 1, 3)),  # 起止都在周期边界
+    (datetime.datetime(2023, 12, 30, 7, 3), datetime.datetime(2024, 1, 2, 13, 37)),  # 首尾周期不完整
+    (datetime.datetime(2024, 1, 1, 10, 1), datetime.datetime(2024, 1, 1, 10, 2)),  # 区间短于一个周期
+)
+
+
+@pytest.fixture(scope='module')
+def kline_file(tmp_path_factory):
+    """跨越月份和年份的1分钟K线CSV"""
+    columns = synthetic_klines(bars=5 * 1440, seed=1)
+    columns['datetime'] = (np.datetime64('2023-12-29', 'ns').astype(np.int64)
+                           + np.arange(5 * 1440, dtype=np.int64) * 60 * 10 ** 9)
+    frame = pd.DataFrame({name: values for name, values in columns.items() if name != 'datetime'})
+    frame.insert(0, 'open_time', pd.to_datetime(columns['datetime']).strftime('%Y-%m-%d %H:%M:%S'))
+    path = tmp_path_factory.mktemp('klines') / 'F-TESTUSDT-1m.csv'
+    frame.to_csv(path, index=False)
+    return str(path)
+
+
+class _Recorder(bt.Strategy):
+    def __init__(self):
+        self.bars = []
+
+    def next(self):
+        data = self.data
+        self.bars.append((data.datetime[0], data.open[0], data.high[0], data.low[0], data.close[0], data.volume[0]))
+
+
+def _bars(kline_file, start, end, minutes, preresample):
+    cerebro = bt.Cerebro(stdstats=False)
+    timeframe, compression = (bt.TimeFrame.Days, 1) if minutes == 1440 else (bt.TimeFrame.Minutes, minutes)
+    configure_data(cerebro, kline_file, start, end, timeframe=timeframe, compression=compression,
+                   cache_dir=kline_file + '.cache', preresample=preresample)
+    cerebro.addstrategy(_Recorder)
+    return np.array(cerebro.run()[0].bars)
+
+
+@pytest.mark.parametrize('minutes', PERIODS)
+@pytest.mark.parametrize('start, end', WINDOWS)
+def test_preresample_matches_resampledata(kline_file, start, end, minutes):
+    expected = _bars(kline_file, start, end, minutes, preresample=False)
+    actual = _bars(kline_file, start, end, minutes, preresample=True)
+    assert actual.shape == expected.shape
+    # 日期数值相差不超过1微秒，价格和成交量完全一致
+    np.testing.assert_allclose(actual[:, 0], expected[:, 0], rtol=0, atol=1e-6 / 86400)
+    np.testing.assert_allclose(actual[:, 1:], expected[:, 1:], rtol=1e-12)
+
+
+@pytest.mark.parametrize('minutes', PERIODS)
+def test_intrabar_index_locates_resampled_bars(kline_file, minutes):
+    start, end = WINDOWS[1]
+    bars = _bars(kline_file, start, end, minutes, preresample=False)
+    index = IntrabarIndex(load_kline_segments(kline_file, start, end, kline_file + '.cache'), minutes)
+    for dt, _, high, low, _, volume in bars:
+        lo, hi = index.locate(dt)
+        assert index.high[lo:hi].max() == high
+        assert index.low[lo:hi].min() == low
+
+
+
+def _minute_window(minutes, offset):
+    """指定分钟序号的K线，价格按序号和 offset 生成，便于检查补齐的值"""
+    minutes = np.asarray(minutes, dtype=np.int64)
+    close = offset + minutes.astype(np.float64)
+    return {'datetime': minutes * 60 * 10 ** 9, 'open': close - 0.5, 'high': close + 1, 'low': close - 1,
+            'close': close, 'volume': np.ones(len(minutes))}
+
+
+def test_align_kline_windows_fills_partial_overlap():
+    # A 缺少第3分钟，B 从第3分钟开始且缺少第5、7分钟，重叠区间为第3至9分钟
+    a = _minute_window([0, 1, 2, 4, 5, 6, 7, 8, 9], 100)
+    b = _minute_window([3, 4, 6, 8, 9, 10, 11, 12], 200)
+    aligned = align_kline_windows({'A': a, 'B': b})
+
+    index = np.arange(3, 10) * 60 * 10 ** 9
+    for window in aligned.values():
+        np.testing.assert_array_equal(window['datetime'], index)
+    # 重叠区间开头缺失的K线用第一根K线的开盘价补齐，其余缺失的K线用前一根收盘价补齐，成交量为0
+    np.testing.assert_array_equal(aligned['A']['close'], [103.5, 104, 105, 106, 107, 108, 109])
+    np.testing.assert_array_equal(aligned['A']['volume'], [0, 1, 1, 1, 1, 1, 1])
+    np.testing.assert_array_equal(aligned['B']['close'], [203, 204, 204, 206, 206, 208, 209])
+    np.testing.assert_array_equal(aligned['B']['high'], [204, 205, 204, 207, 206, 209, 210])
+    np.testing.assert_array_equal(aligned['B']['volume'], [1, 1, 0, 1, 0, 1, 1])
+
+    with pytest.raises(ValueError):
+        align_kline_windows({'A': _minute_window([0, 1], 0), 'B': _minute_window([2, 3], 0)})
+
+
+@pytest.mark.parametrize('use_cache', [True, False])
+def test_load_kline_windows_aligns_symbols(tmp_path, use_cache):
+    paths = []
+    for symbol, minutes in (('AUSDT', [0, 1, 2, 4, 5, 6, 7, 8, 9]), ('BUSDT', [3, 4, 6, 8, 9, 10, 11, 12])):
+        window = _minute_window(minutes, 0)
+        frame = pd.DataFrame({name: window[name] for name in ('open', 'high', 'low', 'close', 'volume')})
+        frame.insert(0, 'open_time', pd.to_datetime(window['datetime'] + np.datetime64('2024-01-01', 'ns').astype(
+            np.int64)).strftime('%Y-%m-%d %H:%M:%S'))
+        path = tmp_path / f'F-{symbol}-1m.csv'
+        frame.to_csv(path, index=False)
+        paths.append(str(path))
+
+    windows = load_kline_windows(paths, datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 2),
+                                 cache_dir=str(tmp_path / 'cache'), use_cache=use_cache)
+    assert list(windows) == ['AUSDT', 'BUSDT']
+    for window in windows.values():
+        assert len(window['datetime']) == 7
+    np.testing.assert_array_equal(windows['BUSDT']['volume'], [1, 1, 0, 1, 0, 1, 1])
+
+# 主进程发布共享内存，进程池工作进程和独立启动的进程分别挂载、读取并释放，最后主进程读取并删除
+SHARED_MEMORY_CYCLE = '''
+import json, multiprocessing, subprocess, sys
+import numpy as np
+from data_loader import attach_kline_window, release_kline_window, share_kline_window
+
+def read(descriptor):
+    total = float(attach_kline_window(descriptor)['close'].sum())
+    release_kline_window(descriptor)
+    return total
+
+if __name__ == '__main__':
+    columns = {name: np.arange(100, dtype=np.int64 if name == 'datetime' else np.float64)
+               for name in ('datetime', 'open', 'high', 'low', 'close', 'volume')}
+    shm, descriptor = share_kline_window(columns)
+    with multiprocessing.get_context(sys.argv[1]).Pool(2) as pool:
+        assert pool.map(read, [descriptor] * 4) == [4950.0] * 4
+    code = 'import sys, json; from data_loader import attach_kline_window, release_kline_window; ' \\
+           'd = json.loads(sys.argv[1]); print(attach_kline_window(d)["close"].sum()); release_kline_window(d)'
+    assert subprocess.check_output([sys.executable, '-c', code, json.dumps(descriptor)]).strip() == b'4950.0'
+    assert read(descriptor) == 4950.0
+    shm.close()
+    shm.unlink()
+'''
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_shared_window_survives_worker_processes(tmp_path, method):
+    script = tmp_path / 'cycle.py'
+    script.write_text(SHARED_MEMORY_CYCLE)
+    result = subprocess.run([sys.executable, str(script), method], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    # 工作进程不能删除或报告泄漏主进程仍在使用的共享内存，主进程删除时 resource_tracker 也不应报错
+    assert result.stderr == ''
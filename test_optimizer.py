@@ -0,0 +1,193 @@
+"""
+参数优化的检查：在合成1分钟K线上运行少量任务
+"""
+import datetime
+import numpy as np
+import pandas as pd
+import pytest
+from benchmark import synthetic_klines
+import optimizer
+from optimizer import (ResultStore, build_tasks, run_tasks, successive_halving, task_key, tpe_search,
+                       walk_forward, walk_forward_folds)
+from strategy import SystemOne
+
+
+@pytest.fixture(scope='module')
+def kline_file(tmp_path_factory):
+    """2024-01-01 起两天的1分钟K线CSV"""
+    columns = synthetic_klines(bars=2 * 1440, seed=5)
+    frame = pd.DataFrame({name: values for name, values in columns.items() if name != 'datetime'})
+    frame.insert(0, 'open_time', pd.to_datetime(columns['datetime']).strftime('%Y-%m-%d %H:%M:%S'))
+    path = tmp_path_factory.mktemp('klines') / 'F-TESTUSDT-1m.csv'
+    frame.to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture
+def data_config(kline_file, tmp_path):
+    return dict(kline_file_path=kline_file, start_date=datetime.datetime(2024, 1, 1),
+                end_date=datetime.datetime(2024, 1, 2), compression=5, cache_dir=str(tmp_path / 'cache'))
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_run_tasks_reports_progress(data_config, processes):
+    tasks = build_tasks(SystemOne, data_config, strategy_grid=dict(deque_length=[10, 15]))
+    calls = []
+    rows = run_tasks(tasks, processes=processes, progress=lambda done, total: calls.append((done, total)))
+    assert calls == [(1, 2), (2, 2)]
+    assert [row['deque_length'] for row in rows] == [10, 15]
+    assert all(np.isfinite(row['final_value']) for row in rows)
+
+
+def test_result_store_reuses_rows_until_version_changes(data_config, tmp_path, monkeypatch):
+    tasks = build_tasks(SystemOne, data_config, strategy_grid=dict(deque_length=[10, 15]))
+    store = ResultStore(str(tmp_path / 'results.db'))
+    try:
+        first = run_tasks(tasks, processes=1, store=store)
+        calls = []
+        # 相同任务重跑全部命中，不再运行回测
+        again = run_tasks(build_tasks(SystemOne, dict(data_config), strategy_grid=dict(deque_length=[10, 15])),
+                          processes=1, store=store, progress=lambda done, total: calls.append(done))
+        assert calls == [] and again == first
+
+        old_key = task_key(tasks[0])
+        monkeypatch.setattr(optimizer, 'RESULT_VERSION', optimizer.RESULT_VERSION + 1)
+        assert task_key(tasks[0]) != old_key
+        assert store.get_many([task_key(task) for task in tasks]) == {}
+        run_tasks(tasks, processes=1, store=store, progress=lambda done, total: calls.append(done))
+        assert calls == [1, 2]
+    finally:
+        store.close()
+
+
+class _Marker:
+    pass
+
+
+def test_task_key_normalizes_params(data_config):
+    def key(**broker_params):
+        return task_key(build_tasks(SystemOne, data_config, broker_grid={
+            name: [value] for name, value in broker_params.items()})[0])
+
+    # NumPy 标量与 Python 数值、类与其限定名称、日期与其 ISO 字符串的哈希相同
+    assert key(leverage=np.int64(10)) == key(leverage=10)
+    assert key(kind=_Marker) == key(kind=f'{__name__}._Marker')
+    assert key(since=datetime.date(2024, 1, 1)) == key(since='2024-01-01')
+    # repr 含内存地址或无法定位的对象直接报错
+    for value in (object(), lambda: None, {1: 2}):
+        with pytest.raises(TypeError):
+            key(value=value)
+
+
+class _FakeRunner:
+    """代替 optimizer.run_tasks：不运行回测，按参数计算确定的得分，并记录每次调用的任务"""
+
+    def __init__(self, score):
+        self.score = score
+        self.calls = []
+
+    def __call__(self, tasks, processes=None, store=None, progress=None):
+        self.calls.append(tasks)
+        return [{**task['strategy_params'], **task['broker_params'], **task['sizer_params'],
+                 **self.score(task)} for task in tasks]
+
+
+def test_successive_halving_rungs(monkeypatch):
+    start, end = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 1, 28)
+    # 得分为 deque_length，但最大的两个分别发生强平和指标缺失，按 _score 视为最差
+    runner = _FakeRunner(lambda task: dict(
+        total_pnl_percent=float('nan') if task['strategy_params']['deque_length'] == 26
+        else task['strategy_params']['deque_length'],
+        liquidated=task['strategy_params']['deque_length'] == 27))
+    monkeypatch.setattr(optimizer, 'run_tasks', runner)
+    candidates = [(dict(deque_length=n), {}, {}) for n in range(1, 28)]
+    rows = successive_halving(SystemOne, dict(start_date=start, end_date=end), candidates, eta=3,
+                              min_fraction=0.01)
+
+    assert [len(tasks) for tasks in runner.calls] == [27, 9, 3, 1]
+    assert [tasks[0]['data']['end_date'] for tasks in runner.calls] == [
+        start + (end - start) / 27, start + (end - start) / 9, start + (end - start) / 3, end]
+    promoted = [sorted(task['strategy_params']['deque_length'] for task in tasks) for tasks in runner.calls[1:]]
+    assert promoted == [list(range(17, 26)), [23, 24, 25], [25]]
+    assert rows == [dict(deque_length=25, total_pnl_percent=25, liquidated=False)]
+
+
+def test_successive_halving_stops_at_min_fraction(monkeypatch):
+    runner = _FakeRunner(lambda task: dict(total_pnl_percent=task['strategy_params']['deque_length']))
+    monkeypatch.setattr(optimizer, 'run_tasks', runner)
+    candidates = [(dict(deque_length=n), {}, {}) for n in range(27)]
+    successive_halving(SystemOne, dict(start_date=datetime.datetime(2024, 1, 1),
+                                       end_date=datetime.datetime(2024, 2, 1)), candidates, eta=3, min_fraction=0.1)
+    # 窗口不短于完整区间的 1/10，只能淘汰两轮
+    assert [len(tasks) for tasks in runner.calls] == [27, 9, 3]
+
+
+def _tpe_run(monkeypatch, seed):
+    grids = dict(strategy_grid=dict(deque_length=[10, 15, 20, 25]),
+                 broker_grid=dict(leverage=[5, 10], liquidity=['maker', 'taker']),
+                 sizer_grid=dict(percent=[0.05, 0.1, 0.2]))
+    # 得分在 deque_length=20、leverage=5 处最高
+    runner = _FakeRunner(lambda task: dict(total_pnl_percent=-abs(task['strategy_params']['deque_length'] - 20)
+                                           - task['broker_params']['leverage']))
+    monkeypatch.setattr(optimizer, 'run_tasks', runner)
+    rows = tpe_search(SystemOne, {}, n_trials=30, processes=3, n_startup=6, seed=seed, **grids)
+    return grids, runner, rows
+
+
+def test_tpe_search_proposes_only_domain_values(monkeypatch):
+    grids, runner, rows = _tpe_run(monkeypatch, seed=7)
+    assert len(rows) == 30 and [len(tasks) for tasks in runner.calls] == [3] * 10
+    domain = {name: values for grid in grids.values() for name, values in grid.items()}
+    points = set()
+    for row in rows:
+        assert all(row[name] in values for name, values in domain.items())
+        points.add(tuple(row[name] for name in domain))
+    # 不重复评估同一组参数
+    assert len(points) == 30
+    # 相同随机种子得到相同的建议序列
+    _, _, again = _tpe_run(monkeypatch, seed=7)
+    assert again == rows
+
+
+@pytest.mark.parametrize('anchored', [False, True])
+def test_walk_forward_folds(anchored):
+    start, end = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 4, 15)
+    in_sample, out_of_sample = datetime.timedelta(days=30), datetime.timedelta(days=20)
+    folds = walk_forward_folds(start, end, in_sample, out_of_sample, anchored)
+
+    # 30 天样本内之后还剩 75 天，放得下 3 个完整的 20 天样本外区间，不完整的最后一段舍弃
+    assert len(folds) == 3
+    for i, (fold_start, split, fold_end) in enumerate(folds):
+        assert split == start + in_sample + i * out_of_sample
+        assert fold_end == split + out_of_sample <= end
+        assert fold_start == (start if anchored else split - in_sample)
+        assert fold_start < split
+    # 样本外区间首尾相接、互不重叠
+    assert all(previous[2] == current[1] for previous, current in zip(folds, folds[1:]))
+    assert walk_forward_folds(start, start + in_sample + out_of_sample / 2, in_sample, out_of_sample) == []
+
+
+def test_walk_forward_windows_do_not_overlap(kline_file, tmp_path, monkeypatch):
+    def score(task):
+        row = dict(total_pnl_percent=task['broker_params']['leverage'])
+        if task.get('record_returns'):
+            row['returns'] = {task['data']['start_date'].isoformat(): 0.01}
+        return row
+
+    runner = _FakeRunner(score)
+    monkeypatch.setattr(optimizer, 'run_tasks', runner)
+    start = datetime.datetime(2024, 1, 1)
+    equity, folds = walk_forward(kline_file, start, start + datetime.timedelta(hours=40),
+                                 in_sample=datetime.timedelta(hours=16), out_of_sample=datetime.timedelta(hours=8),
+                                 broker_grid=dict(leverage=[5, 10]), cache_dir=str(tmp_path / 'cache'))
+
+    in_sample_tasks, out_of_sample_tasks = runner.calls
+    assert len(in_sample_tasks) == 3 * 2 and len(out_of_sample_tasks) == 3
+    for i, task in enumerate(out_of_sample_tasks):
+        fold_in_sample = in_sample_tasks[2 * i:2 * i + 2]
+        # 样本内区间在样本外开始之前结束，样本外验证使用样本内得分最高的参数
+        assert all(other['data']['end_date'] < task['data']['start_date'] for other in fold_in_sample)
+        assert task['data']['end_date'] < task['data']['start_date'] + datetime.timedelta(hours=8)
+        assert task['broker_params'] == dict(leverage=10)
+    assert folds['out_of_sample_start'].tolist() == [start + datetime.timedelta(hours=h) for h in (16, 24, 32)]
+    np.testing.assert_allclose(equity.to_numpy(), 10000 * 1.01 ** np.arange(1, 4))
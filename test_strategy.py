@@ -0,0 +1,178 @@
+"""
+策略与指标的向量化实现和事件驱动实现的一致性检查，使用 benchmark 的合成K线
+"""
+import json
+import numpy as np
+import pytest
+import backtrader as bt
+from numpy.lib.stride_tricks import sliding_window_view
+from benchmark import synthetic_klines
+from analyzer import add_analyzers
+from broker import configure_broker
+from data_loader import NumpyData
+from strategy import BaseStrategy, PriceCluster, StopRules, SystemOne, scan_system_one
+
+
+class _SignalProbe(SystemOne):
+    """记录 SystemOne 发出的每个入场信号而不下单，始终空仓，与 scan_system_one 一样不考虑持仓状态"""
+
+    def __init__(self):
+        super().__init__()
+        self.signals = []
+        self.feature_rows = []
+
+    def next_data(self, data, features):
+        super().next_data(data, features)
+        if len(data) > 1:
+            self.feature_rows.append(features.window(size=1)[:, 0].copy())
+
+    def buy_bracket(self, data=None, price=None, stopprice=None, limitprice=None, **kwargs):
+        self.signals.append((len(data) - 1, price, stopprice, limitprice))
+
+
+def test_scan_system_one_matches_event_driven_signals():
+    columns = synthetic_klines(bars=3000, seed=2)
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(NumpyData(dataname=columns))
+    cerebro.addstrategy(_SignalProbe, log_level=None)
+    probe = cerebro.run()[0]
+
+    scan = scan_system_one(columns)
+    index = np.array([row[0] for row in probe.signals])
+    assert len(index) > 100
+    np.testing.assert_array_equal(index, np.flatnonzero(scan['signal']))
+    prices = np.array([row[1:] for row in probe.signals])
+    np.testing.assert_allclose(prices[:, 0], scan['buy_price'][index])
+    np.testing.assert_allclose(prices[:, 1], scan['stop_price'][index])
+    np.testing.assert_allclose(prices[:, 2], scan['take_profit'][index])
+
+    # 特征逐根一致（第一根K线没有前值，SystemOne 不记录）
+    rows = np.array(probe.feature_rows)
+    for i, name in enumerate(probe.features[0].fields):
+        expected = columns['volume'] if name == 'volume' else scan[name]
+        np.testing.assert_allclose(rows[:, i], expected[1:], err_msg=name)
+
+
+class _ClusterHolder(bt.Strategy):
+    params = dict(period=100, bins=20)
+
+    def __init__(self):
+        self.cluster = PriceCluster(period=self.p.period, bins=self.p.bins)
+
+
+def _histogram_clusters(close, period, bins):
+    """逐个窗口调用 np.histogram 计算密集区中心价格"""
+    result = []
+    for window in sliding_window_view(close, period):
+        hist, edges = np.histogram(window, bins=bins)
+        index = hist.argmax()
+        result.append((edges[index] + edges[index + 1]) / 2)
+    return np.array(result)
+
+
+@pytest.mark.parametrize('period,bins', [(20, 5), (100, 20), (50, 37)])
+@pytest.mark.parametrize('rounded', [False, True])
+@pytest.mark.parametrize('runonce', [False, True])
+def test_price_cluster_matches_full_histogram(period, bins, rounded, runonce):
+    columns = synthetic_klines(bars=2000, seed=3)
+    if rounded:
+        # 价格取整到100，窗口内大量重复值和落在分箱边界上的值
+        columns['close'] = np.round(columns['close'], -2)
+    cerebro = bt.Cerebro(runonce=runonce, stdstats=False)
+    cerebro.adddata(NumpyData(dataname=columns))
+    cerebro.addstrategy(_ClusterHolder, period=period, bins=bins)
+    holder = cerebro.run()[0]
+
+    values = np.asarray(holder.cluster.lines.cluster.array)
+    np.testing.assert_array_equal(values[period - 1:], _histogram_clusters(columns['close'], period, bins))
+
+
+class _EarlyLogger(BaseStrategy):
+    def __init__(self):
+        super().__init__()
+        self.log('initialized')
+        # 写入线程在 start 中才启动
+        self.started_early = self.logger._thread is not None
+
+
+def test_log_before_start(tmp_path):
+    path = tmp_path / 'log.jsonl'
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(NumpyData(dataname=synthetic_klines(bars=10)))
+    cerebro.addstrategy(_EarlyLogger, log_file=str(path))
+    assert not cerebro.run()[0].started_early
+    events = [json.loads(line) for line in path.read_text().splitlines()]
+    assert events[0] == {'ts': None, 'level': 'INFO', 'event': 'message', 'message': 'initialized'}
+    assert [event['event'] for event in events[1:]] == ['start', 'stop']
+
+
+class _TargetTrader(BaseStrategy):
+    """在指定K线（len(self)）把持仓调整到目标数量，记录每根K线的账户价值"""
+    params = (('targets', {}),)
+
+    def __init__(self):
+        super().__init__()
+        self.values = []
+
+    def next(self):
+        self.values.append(self.broker.getvalue())
+        if len(self) in self.p.targets:
+            self.order_target_size(target=self.p.targets[len(self)])
+
+
+def _run_rules(close, stop_rules, targets=None, fused=False):
+    """开高低收都等于 close，第 n 根K线下的订单按第 n+1 根的收盘价成交"""
+    columns = synthetic_klines(bars=len(close))
+    for name in ('open', 'high', 'low', 'close'):
+        columns[name] = np.asarray(close, dtype=np.float64)
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(NumpyData(dataname=columns))
+    cerebro.addstrategy(_TargetTrader, targets=targets or {}, stop_rules=stop_rules, log_level=None)
+    configure_broker(cerebro, slippage=0)
+    if fused:
+        add_analyzers(cerebro, fused=True)
+    return cerebro.run()[0]
+
+
+# 第2根K线按100开多100，之后每根下跌1，最后横盘
+FALLING = [100.0] * 3 + list(np.arange(99, 79, -1.0)) + [80.0] * 10
+
+
+def test_stop_rule_max_drawdown():
+    strat = _run_rules(FALLING, StopRules(max_drawdown=10), targets={1: 100})
+    assert strat.pruned == 'max_drawdown' and len(strat) < len(FALLING)
+    peak = max(strat.values)
+    # 在回撤首次达到10%的K线上结束
+    assert (peak - strat.values[-1]) / peak >= 0.1 > (peak - strat.values[-2]) / peak
+
+
+def test_stop_rule_min_value():
+    strat = _run_rules(FALLING, StopRules(min_value=9500), targets={1: 100})
+    assert strat.pruned == 'min_value' and len(strat) < len(FALLING)
+    assert strat.values[-1] < 9500 <= strat.values[-2]
+
+
+def test_stop_rule_no_trade_bars():
+    strat = _run_rules(FALLING, StopRules(no_trade_bars=5))
+    assert strat.pruned == 'no_trade' and len(strat) == 5
+    # 期限内有成交时不触发
+    strat = _run_rules(FALLING, StopRules(no_trade_bars=5), targets={3: 1})
+    assert strat.pruned is None and len(strat) == len(FALLING)
+
+
+def test_stop_rule_liquidation():
+    # 10倍杠杆开多1000，跌到约90.4时强平
+    strat = _run_rules(FALLING, StopRules(liquidation=True), targets={1: 1000})
+    liquidation = strat.broker.liquidations
+    assert strat.pruned == 'liquidation' and len(liquidation) == 1
+    assert len(strat) < len(FALLING) and strat.data.datetime.datetime(0) == liquidation[0]['datetime']
+
+
+def test_stop_rule_min_sqn():
+    # 每3根K线一笔多头交易，前三笔分别亏 1、2、1 个价格单位
+    close = [100, 100, 99, 99, 99, 97, 97, 97, 96, 96, 96, 95] + [95] * 10
+    targets = {n: 10 for n in (1, 4, 7, 10)} | {n: 0 for n in (2, 5, 8, 11)}
+    strat = _run_rules(close, StopRules(min_sqn=0, min_trades=3), targets=targets, fused=True)
+    assert strat.pruned == 'sqn' and len(strat) < len(close)
+    # 第三笔交易在第9根K线平仓，当根K线即结束
+    assert len(strat) == 9 and strat.analyzers.Metrics.trade_count == 3
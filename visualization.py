@@ -1,12 +1,14 @@
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
+from analyzer import collect_analysis
+from metrics import equity_frame
 
 def plot_equity_curve(strategy):
     """
-    绘制资金曲线图
+    绘制资金曲线图（需要 EquityObserver，见 metrics.configure_equity_observer）
     """
-    equity_curve = strategy.equity_curve
+    equity_curve = equity_frame(strategy)['value']
     plt.figure(figsize=(10, 6))
     plt.plot(equity_curve, label='Equity Curve')
     plt.title('Equity Curve')
@@ -20,8 +22,8 @@ def plot_drawdown_curve(strategy):
     """
     绘制回撤曲线
     """
-    # 使用策略记录的 drawdown_curve 列表
-    drawdown_curve = strategy.drawdown_curve
+    # 由 EquityObserver 记录的账户价值计算回撤曲线
+    drawdown_curve = equity_frame(strategy)['drawdown']
 
     # 绘制回撤曲线
     plt.figure(figsize=(16, 10))
@@ -37,7 +39,7 @@ def plot_trade_analysis(strategy):
     """
     绘制交易分析，包括盈利和亏损交易数量的柱状图
     """
-    trade_analyzer = strategy.analyzers.TradeAnalyzer.get_analysis()
+    trade_analyzer = collect_analysis(strategy)['TradeAnalyzer']
 
     # 获取交易数据
     trade_data = {
@@ -64,8 +66,9 @@ def plot_combined_equity_and_drawdown(strategy):
     """
     绘制资金曲线和回撤曲线在同一图像中
     """
-    equity_curve = strategy.equity_curve
-    drawdown_curve = strategy.drawdown_curve
+    frame = equity_frame(strategy)
+    equity_curve = frame['value']
+    drawdown_curve = frame['drawdown']
 
     # 创建图像和双Y轴
     fig, ax1 = plt.subplots(figsize=(16, 10))